@@ -5,14 +5,19 @@ from telegram.ext import (
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
+    ChatMemberHandler,
     ContextTypes,
     filters,
 )
-from telegram.error import TelegramError
-from database import Database
+from telegram.error import BadRequest, Forbidden, TelegramError
+from cache import SubscriberIndex
+from outbox import EditCoalescer, Priority, SendScheduler
+from database import db, SubmitOutcome
 import config
+import metrics
 import asyncio
 from datetime import datetime, timedelta
+import time
 import pytz
 
 logging.basicConfig(
@@ -21,20 +26,263 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-db = Database()
-
-# Глобальная переменная для приза
-CURRENT_PRIZE = "777₽ или 350⭐"
-
 # Часовой пояс Москвы
 MSK = pytz.timezone('Europe/Moscow')
 
+
+def is_channel_member(member) -> bool:
+    """Считается ли участник чата подписчиком"""
+    if member.status == ChatMember.RESTRICTED:
+        return member.is_member
+    return member.status in [ChatMember.MEMBER, ChatMember.ADMINISTRATOR, ChatMember.OWNER]
+
+
 class PhotoBattleBot:
     def __init__(self):
-        self.app = Application.builder().token(config.BOT_TOKEN).build()
+        self.app = (
+            Application.builder()
+            .token(config.BOT_TOKEN)
+            .rate_limiter(SendScheduler(
+                overall_rate=config.TG_RATE_OVERALL,
+                private_rate=config.TG_RATE_PRIVATE,
+                group_per_minute=config.TG_GROUP_PER_MINUTE,
+                max_retries=config.TG_MAX_RETRIES,
+                chat_limits={config.CHANNEL_ID: config.TG_CHANNEL_PER_MINUTE}
+            ))
+            .post_init(self.post_init)
+            .post_shutdown(self.post_shutdown)
+            .build()
+        )
         self.setup_handlers()
         self.round_tasks = {}
         self.round_end_times = {}
+        # Фоновые циклы на все время работы и разовые задачи (удаление
+        # сообщений раунда, рассылки) - вторые убираются по завершении
+        self.background_tasks = []
+        self.one_shot_tasks = set()
+        self.subscribers = SubscriberIndex(
+            ttl=config.SUBSCRIPTION_TTL_SECONDS,
+            event_ttl=config.SUBSCRIPTION_EVENT_TTL_SECONDS,
+            max_size=config.SUBSCRIBER_INDEX_SIZE
+        )
+        self.button_edits = EditCoalescer(
+            config.BUTTON_EDIT_INTERVAL_SECONDS,
+            render=self.battle_buttons,
+            edit=self.edit_battle_buttons,
+            rate=config.TG_CHANNEL_PER_MINUTE / 60 * config.BUTTON_EDIT_SHARE
+        )
+    
+    async def post_init(self, application: Application):
+        """
+        Подключение к БД и прогрев кэшей до начала обработки апдейтов:
+        polling стартует только после выхода из post_init
+        """
+        await db.connect()
+        
+        # Кэши прогревает слушатель уведомлений сразу после LISTEN:
+        # изменения других процессов во время прогрева не теряются
+        started = time.monotonic()
+        hydrated = asyncio.get_running_loop().create_future()
+        self.background_tasks.append(asyncio.create_task(db.listen(hydrated)))
+        current_round = await hydrated
+        if current_round:
+            self.restore_round(current_round)
+        await db.refresh_stats()
+        elapsed_ms = round((time.monotonic() - started) * 1000)
+        metrics.set_gauge('startup.hydration_ms', elapsed_ms)
+        logger.info(
+            f"Прогрев за {elapsed_ms} мс: раунд {current_round['number'] if current_round else '-'}, "
+            f"батлов {len(db.tallies.battles)}, голосов {db.voters.size()}"
+        )
+        
+        self.background_tasks.append(asyncio.create_task(self.stats_loop()))
+        self.background_tasks.append(asyncio.create_task(self.tally_loop()))
+        self.start_one_shot(self.archive_rounds())
+        self.notifications_ready = asyncio.Event()
+        self.background_tasks.append(asyncio.create_task(self.notification_loop()))
+        for round_id in await db.get_uncleaned_rounds():
+            self.delete_round_messages(round_id)
+        for broadcast_id in await db.get_running_broadcasts():
+            self.start_one_shot(self.run_broadcast(broadcast_id))
+        if db.replica:
+            self.background_tasks.append(asyncio.create_task(db.watch_replica()))
+    
+    def start_one_shot(self, coro):
+        """Разовая фоновая задача: хранится, пока выполняется"""
+        task = asyncio.create_task(coro)
+        self.one_shot_tasks.add(task)
+        task.add_done_callback(self.one_shot_tasks.discard)
+        return task
+    
+    def restore_round(self, current_round: dict):
+        """Восстановить время окончания и таймер активного раунда после перезапуска"""
+        round_id = current_round['id']
+        ends_at = current_round['ends_at']
+        if not ends_at:
+            # Батлы еще не публиковались - таймер с начала, как при старте раунда
+            self.round_tasks[round_id] = asyncio.create_task(self.round_timer(round_id, hours=2))
+            return
+        
+        end_time = ends_at.astimezone(MSK)
+        self.round_end_times[round_id] = end_time
+        remaining = max((end_time - datetime.now(MSK)).total_seconds(), 0)
+        self.round_tasks[round_id] = asyncio.create_task(self.round_timer(round_id, hours=remaining / 3600))
+        logger.info(f"Раунд {round_id} восстановлен, окончание в {end_time.strftime('%H:%M')} МСК")
+    
+    async def post_shutdown(self, application: Application):
+        """Остановка фоновых задач и закрытие пула соединений"""
+        for task in [*self.background_tasks, *self.one_shot_tasks]:
+            task.cancel()
+        self.button_edits.close()
+        await db.close()
+    
+    async def archive_rounds(self):
+        """Архивация завершенных раундов: журнал голосов и ID сообщений уходят из горячих таблиц"""
+        try:
+            archived = await db.archive_ended_rounds()
+            if archived:
+                self.button_edits.forget()
+                logger.info(f"Заархивированы раунды: {', '.join(map(str, archived))}")
+        except Exception as e:
+            logger.error(f"Ошибка архивации раундов: {e}")
+    
+    async def notify_users(self, kind: str, round_id: int, messages: list):
+        """
+        Поставить личные сообщения в очередь и разбудить рассылку.
+        messages - список (chat_id, text, reply_markup.to_dict() или None)
+        """
+        batch_id = await db.enqueue_notifications(kind, round_id, messages)
+        if batch_id:
+            self.notifications_ready.set()
+            logger.info(f"Рассылка #{batch_id} ({kind}): {len(messages)} сообщений в очереди")
+        return batch_id
+    
+    async def notification_loop(self):
+        """
+        Разбор очереди личных сообщений: до NOTIFY_BATCH_SIZE отправок
+        одновременно, темп задает планировщик отправки. Очередь в БД, так
+        что после перезапуска рассылка продолжается
+        """
+        while True:
+            self.notifications_ready.clear()
+            try:
+                jobs = await db.claim_notifications(config.NOTIFY_BATCH_SIZE)
+                if jobs:
+                    results = await asyncio.gather(*(self.deliver_notification(job) for job in jobs))
+                    await db.finish_notifications(results)
+                    continue
+            except Exception as e:
+                logger.error(f"Ошибка рассылки: {e}")
+            
+            try:
+                await asyncio.wait_for(self.notifications_ready.wait(), config.NOTIFY_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+    
+    async def deliver_notification(self, job: dict):
+        """Отправить сообщение из очереди. Возвращает (job_id, sent, error), sent=None - повторить"""
+        reply_markup = job['reply_markup']
+        if reply_markup:
+            markup_class = InlineKeyboardMarkup if 'inline_keyboard' in reply_markup else ReplyKeyboardMarkup
+            reply_markup = markup_class.de_json(reply_markup, self.app.bot)
+        
+        try:
+            await self.app.bot.send_message(
+                chat_id=job['chat_id'],
+                text=job['text'],
+                reply_markup=reply_markup,
+                rate_limit_args=Priority.BULK
+            )
+            metrics.inc('notifications.sent')
+            return job['id'], True, None
+        except (Forbidden, BadRequest) as e:
+            # Бот заблокирован или чата нет - повтор не поможет
+            metrics.inc('notifications.failed')
+            return job['id'], False, str(e)
+        except TelegramError as e:
+            metrics.inc('notifications.retry')
+            return job['id'], None, str(e)
+    
+    async def run_broadcast(self, broadcast_id: int):
+        """
+        Рассылка всем пользователям: пачками по BROADCAST_CHUNK_SIZE,
+        отправки пачки идут одновременно, темп - общий лимит планировщика.
+        После каждой пачки прогресс сохраняется, так что после перезапуска
+        рассылка продолжится со следующей пачки (текущая может уйти повторно)
+        """
+        broadcast = await db.get_broadcast(broadcast_id)
+        if not broadcast or broadcast['status'] != 'running':
+            return
+        
+        logger.info(f"Рассылка #{broadcast_id} запущена с пользователя {broadcast['last_user_id']}")
+        recipients = db.broadcast_recipients(broadcast_id, config.BROADCAST_CHUNK_SIZE)
+        try:
+            async for user_ids in recipients:
+                results = await asyncio.gather(*(
+                    self.send_broadcast_message(user_id, broadcast['text']) for user_id in user_ids
+                ))
+                blocked_ids = [user_id for user_id, result in zip(user_ids, results) if result == 'blocked']
+                await db.checkpoint_broadcast(
+                    broadcast_id,
+                    user_ids[-1],
+                    sent=results.count('sent'),
+                    failed=results.count('failed'),
+                    blocked_ids=blocked_ids
+                )
+        except Exception as e:
+            logger.error(f"Ошибка рассылки #{broadcast_id}: {e}", exc_info=True)
+            return
+        finally:
+            await recipients.aclose()
+        
+        broadcast = await db.get_broadcast(broadcast_id)
+        if broadcast['status'] != 'done':
+            # Рассылку ведет другой процесс
+            return
+        
+        report = (
+            f"✅ Рассылка #{broadcast_id} завершена\n\n"
+            f"Доставлено: {broadcast['sent']}\n"
+            f"Заблокировали бота: {broadcast['blocked']}\n"
+            f"Ошибок: {broadcast['failed']}"
+        )
+        logger.info(report.replace("\n\n", ": ").replace("\n", ", "))
+        if broadcast['created_by']:
+            try:
+                await self.app.bot.send_message(chat_id=broadcast['created_by'], text=report)
+            except TelegramError as e:
+                logger.warning(f"Не удалось отправить отчет о рассылке: {e}")
+    
+    async def send_broadcast_message(self, user_id: int, text: str) -> str:
+        """Сообщение рассылки одному пользователю: 'sent', 'blocked' или 'failed'"""
+        try:
+            await self.app.bot.send_message(chat_id=user_id, text=text, rate_limit_args=Priority.BULK)
+            return 'sent'
+        except Forbidden:
+            return 'blocked'
+        except TelegramError as e:
+            logger.warning(f"Не удалось отправить сообщение пользователю {user_id}: {e}")
+            return 'failed'
+    
+    async def stats_loop(self):
+        """Периодическое обновление снимка статистики"""
+        while True:
+            await asyncio.sleep(config.STATS_REFRESH_SECONDS)
+            try:
+                await db.refresh_stats()
+            except Exception as e:
+                logger.error(f"Ошибка обновления статистики: {e}")
+    
+    async def tally_loop(self):
+        """Периодическая сверка кэша голосов с БД"""
+        while True:
+            await asyncio.sleep(config.TALLY_RECONCILE_SECONDS)
+            try:
+                drift = await db.reconcile_tallies()
+                if drift:
+                    logger.warning(f"Кэш голосов разошелся с БД на {drift}")
+            except Exception as e:
+                logger.error(f"Ошибка сверки голосов: {e}")
     
     def setup_handlers(self):
         # Команды
@@ -45,6 +293,15 @@ class PhotoBattleBot:
         self.app.add_handler(CommandHandler("end_battle", self.end_battle))
         self.app.add_handler(CommandHandler("stats", self.stats))
         self.app.add_handler(CommandHandler("set_prize", self.set_prize))
+        self.app.add_handler(CommandHandler("metrics", self.show_metrics))
+        self.app.add_handler(CommandHandler("backfill_stats", self.backfill_stats))
+        self.app.add_handler(CommandHandler("check_tallies", self.check_tallies))
+        self.app.add_handler(CommandHandler("plans", self.check_plans))
+        self.app.add_handler(CommandHandler("notifications", self.show_notifications))
+        self.app.add_handler(CommandHandler("broadcast", self.broadcast))
+        
+        # Подписки на канал
+        self.app.add_handler(ChatMemberHandler(self.handle_channel_member, ChatMemberHandler.CHAT_MEMBER))
         
         # Обработка фото
         self.app.add_handler(MessageHandler(filters.PHOTO, self.handle_photo))
@@ -76,14 +333,31 @@ class PhotoBattleBot:
         return InlineKeyboardMarkup(keyboard)
     
     async def check_subscription(self, user_id: int) -> bool:
-        """Проверка подписки на канал"""
+        """Проверка подписки на канал (обычно из индекса, без API)"""
         try:
-            member = await self.app.bot.get_chat_member(config.CHANNEL_ID, user_id)
-            return member.status in [ChatMember.MEMBER, ChatMember.ADMINISTRATOR, ChatMember.OWNER]
+            return await self.subscribers.check(user_id, self.fetch_subscription)
         except TelegramError as e:
             logger.error(f"Ошибка проверки подписки для {user_id}: {e}")
             return False
     
+    async def fetch_subscription(self, user_id: int) -> bool:
+        """Запрос подписки через get_chat_member"""
+        member = await self.app.bot.get_chat_member(config.CHANNEL_ID, user_id)
+        return is_channel_member(member)
+    
+    async def handle_channel_member(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Подписка/отписка от канала (приходит, если бот - админ канала)"""
+        change = update.chat_member
+        channel = str(config.CHANNEL_ID)
+        if channel.startswith('@'):
+            if (change.chat.username or '').lower() != channel[1:].lower():
+                return
+        elif str(change.chat.id) != channel:
+            return
+        
+        member = change.new_chat_member
+        self.subscribers.on_event(member.user.id, is_channel_member(member))
+    
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Команда /start с реферальной системой"""
         user = update.effective_user
@@ -98,7 +372,7 @@ class PhotoBattleBot:
             except ValueError:
                 pass
         
-        db.add_user(user.id, user.username, referrer_id)
+        await db.add_user(user.id, user.username, referrer_id)
         
         ref_link = f"https://t.me/{config.BOT_USERNAME}?start=ref{user.id}"
         
@@ -132,7 +406,7 @@ class PhotoBattleBot:
         
         elif text == "🎤 получить голоса":
             ref_link = f"https://t.me/{config.BOT_USERNAME}?start=ref{user_id}"
-            user_stats = db.get_user_stats(user_id)
+            user_stats = await db.get_profile(user_id)
             
             votes_text = f"""
 🎤 Голоса для фотобатла можно получить двумя способами:
@@ -157,16 +431,11 @@ class PhotoBattleBot:
             )
         
         elif text == "👤 профиль":
-            user_stats = db.get_user_stats(user_id)
+            user_stats = await db.get_profile(user_id)
             ref_link = f"https://t.me/{config.BOT_USERNAME}?start=ref{user_id}"
             
-            # Проверяем есть ли активное участие в раунде
-            current_round = db.get_current_round()
-            can_use_votes = False
-            if current_round:
-                user_photo = db.get_user_photo_in_round(user_id, current_round['id'])
-                if user_photo and user_photo['status'] == 'approved' and user_stats['extra_votes'] > 0:
-                    can_use_votes = True
+            # Голоса можно использовать, если фото участвует в активном раунде
+            can_use_votes = user_stats['photo_approved'] and user_stats['extra_votes'] > 0
             
             profile_text = f"""
 👤 Твой профиль:
@@ -220,76 +489,43 @@ class PhotoBattleBot:
         user = update.effective_user
         photo = update.message.photo[-1]
         
-        # Проверяем, есть ли активный раунд
-        current_round = db.get_current_round()
+        outcome, photo_id = await db.submit_photo(user.id, user.username, photo.file_id)
         
-        # Если раунд есть и это не первый раунд - сохраняем фото для следующего первого раунда
-        if current_round and current_round['number'] > 1:
-            # Сохраняем фото в очередь для следующего первого раунда
-            photo_id = db.add_photo_to_queue(user.id, photo.file_id)
+        if outcome == SubmitOutcome.ALREADY_IN_QUEUE:
             await update.message.reply_text(
-                "✅ Фотография сохранена!\n\n"
-                "🏁 Твое фото будет участвовать в следующем батле (первый раунд)",
+                "❌ Ты уже отправил фото! Дождись начала батла.",
                 reply_markup=self.get_main_menu()
             )
-            await self.send_photo_to_admins(photo_id, photo.file_id, user, is_queue=True)
             return
         
-        # Если нет раунда - создаем очередь фото
-        if not current_round:
-            # Проверяем, не отправлял ли уже пользователь фото в очередь
-            if db.user_has_photo_in_queue(user.id):
-                await update.message.reply_text(
-                    "❌ Ты уже отправил фото! Дождись начала батла.",
-                    reply_markup=self.get_main_menu()
-                )
-                return
-            
-            photo_id = db.add_photo_to_queue(user.id, photo.file_id)
+        if outcome == SubmitOutcome.ALREADY_IN_ROUND:
             await update.message.reply_text(
-                "✅ Фотография отправлена на модерацию!\n\n"
-                "🏁 Бот сообщит о начале фотобатла, так что не блокируй его",
+                "❌ Ты уже отправил фото в этом раунде!",
                 reply_markup=self.get_main_menu()
             )
-            await self.send_photo_to_admins(photo_id, photo.file_id, user, is_queue=True)
-            
-            # Начисляем голоса рефереру
-            user_data = db.get_user(user.id)
-            if user_data and user_data['referrer_id']:
-                user_photos_count = db.count_user_photos(user.id)
-                if user_photos_count == 1:
-                    db.add_referral_votes(user_data['referrer_id'], config.VOTES_PER_REFERRAL)
             return
         
-        # Первый раунд активен
-        if db.user_has_photo_in_round(user.id, current_round['id']):
+        if outcome == SubmitOutcome.QUEUED_NEXT_BATTLE:
+            # Идет не первый раунд - фото будет в следующем первом раунде
             await update.message.reply_text(
-                "❌ Ты уже отправил фото в этом раунде!",
+                "✅ Фотография сохранена!\n\n"
+                "🏁 Твое фото будет участвовать в следующем батле (первый раунд)",
+                reply_markup=self.get_main_menu()
+            )
+        else:
+            if outcome == SubmitOutcome.SUBMITTED:
+                logger.info(f"Фото #{photo_id} от пользователя {user.id} добавлено на модерацию")
+            
+            await update.message.reply_text(
+                "✅ Фотография отправлена на модерацию!\n\n"
+                "🏁 Бот сообщит о начале фотобатла, так что не блокируй его",
                 reply_markup=self.get_main_menu()
             )
-            return
-        
-        photo_id = db.add_photo(
-            user_id=user.id,
-            file_id=photo.file_id,
-            round_id=current_round['id']
-        )
-        
-        logger.info(f"Фото #{photo_id} от пользователя {user.id} добавлено на модерацию")
-        
-        user_data = db.get_user(user.id)
-        if user_data and user_data['referrer_id']:
-            user_photos_count = db.count_user_photos(user.id)
-            if user_photos_count == 1:
-                db.add_referral_votes(user_data['referrer_id'], config.VOTES_PER_REFERRAL)
         
-        await update.message.reply_text(
-            "✅ Фотография отправлена на модерацию!\n\n"
-            "🏁 Бот сообщит о начале фотобатла, так что не блокируй его",
-            reply_markup=self.get_main_menu()
+        await self.send_photo_to_admins(
+            photo_id, photo.file_id, user,
+            is_queue=outcome != SubmitOutcome.SUBMITTED
         )
-        
-        await self.send_photo_to_admins(photo_id, photo.file_id, user)
     
     async def send_photo_to_admins(self, photo_id: int, file_id: str, user, is_queue: bool = False):
         """Отправка фото админам для модерации"""
@@ -309,7 +545,7 @@ class PhotoBattleBot:
 Модерация фото:
 """
         
-        admin_ids = db.get_all_admins()
+        admin_ids = await db.get_all_admins()
         for admin_id in admin_ids:
             try:
                 await self.app.bot.send_photo(
@@ -324,54 +560,53 @@ class PhotoBattleBot:
     async def check_and_publish_battles(self, round_id: int):
         """Проверка и автоматическая публикация батлов"""
         try:
-            unpaired_photos = db.get_unpaired_photos(round_id)
-            logger.info(f"Раунд {round_id}: найдено {len(unpaired_photos)} фото без пары")
-            
-            pairs_count = len(unpaired_photos) // 2
-            if pairs_count == 0:
+            battles = await db.create_battles_from_pool(round_id)
+            if not battles:
                 return
             
-            logger.info(f"Создаем {pairs_count} новых пар")
-            
-            import random
-            random.shuffle(unpaired_photos)
+            logger.info(f"Раунд {round_id}: создано {len(battles)} новых пар")
             
             # Устанавливаем время окончания раунда при публикации первого батла
             if round_id not in self.round_end_times:
-                end_time = datetime.now(MSK) + timedelta(hours=2)
+                end_time = await db.set_round_deadline(round_id, datetime.now(MSK) + timedelta(hours=2))
+                end_time = end_time.astimezone(MSK)
                 self.round_end_times[round_id] = end_time
                 logger.info(f"Установлено время окончания раунда {round_id}: {end_time.strftime('%H:%M')} МСК")
             
-            for i in range(pairs_count):
-                photo1 = unpaired_photos[i * 2]
-                photo2 = unpaired_photos[i * 2 + 1]
-                
-                battle_id = db.create_battle(round_id, photo1['id'], photo2['id'])
-                logger.info(f"Создан батл #{battle_id}")
-                
-                success = await self.publish_battle(battle_id, photo1, photo2, round_id)
-                if success:
-                    logger.info(f"✅ Батл #{battle_id} опубликован")
+            # Номер раунда - из кэша активного раунда, без запроса на каждый вызов
+            current_round = await db.get_current_round()
+            if not current_round or current_round['id'] != round_id:
+                current_round = await db.get_round_by_id(round_id)
+            round_number = current_round['number'] if current_round else 1
+            
+            published = []
+            notifications = []
+            try:
+                for battle_id, photo1, photo2 in battles:
+                    messages = await self.publish_battle(battle_id, photo1, photo2, round_id, round_number)
+                    if messages:
+                        published.append((battle_id, *messages))
                     
-                    # Отправляем уведомления пользователям с кнопкой "найти себя"
-                    current_round = db.get_round_by_id(round_id)
-                    if current_round and current_round['number'] == 1:
+                    # Уведомления участникам с кнопкой "найти себя" - через очередь
+                    if messages and round_number == 1:
+                        battle_link = f"{config.CHANNEL_LINK}/{battle_id}"
+                        keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("🔍 найти себя", url=battle_link)]])
                         for photo in [photo1, photo2]:
-                            try:
-                                battle_link = f"{config.CHANNEL_LINK}/{battle_id}"
-                                keyboard = [[InlineKeyboardButton("🔍 найти себя", url=battle_link)]]
-                                
-                                await self.app.bot.send_message(
-                                    chat_id=photo['user_id'],
-                                    text=f"▶️ 1 раунд фотобатла начался\n\n"
-                                         f"❗️ нужно собрать минимум 8 голосов и обогнать соперника, чтобы пройти в следующий раунд\n\n"
-                                         f"📝 Чтобы увеличить свои шансы на победу, попроси друзей проголосовать за тебя",
-                                    reply_markup=InlineKeyboardMarkup(keyboard)
-                                )
-                            except:
-                                pass
-                
-                await asyncio.sleep(2)
+                            notifications.append((
+                                photo['user_id'],
+                                "▶️ 1 раунд фотобатла начался\n\n"
+                                "❗️ нужно собрать минимум 8 голосов и обогнать соперника, чтобы пройти в следующий раунд\n\n"
+                                "📝 Чтобы увеличить свои шансы на победу, попроси друзей проголосовать за тебя",
+                                keyboard.to_dict()
+                            ))
+            finally:
+                # ID сообщений пишем одной транзакцией, даже если публикация оборвалась.
+                # Уведомления ставятся в очередь отдельно: ошибка записи ID
+                # не должна оставить участников опубликованных батлов без них
+                try:
+                    await db.save_battle_messages(published)
+                finally:
+                    await self.notify_users('battle_started', round_id, notifications)
         
         except Exception as e:
             logger.error(f"Ошибка в check_and_publish_battles: {e}", exc_info=True)
@@ -407,23 +642,26 @@ class PhotoBattleBot:
         if data == 'use_votes':
             await query.answer()
             
-            current_round = db.get_current_round()
+            current_round = await db.get_current_round()
             if not current_round:
                 await query.answer("Нет активного раунда", show_alert=True)
                 return
             
-            user_photo = db.get_user_photo_in_round(user_id, current_round['id'])
+            user_photo = await db.get_user_photo_in_round(user_id, current_round['id'])
             if not user_photo or user_photo['status'] != 'approved':
                 await query.answer("Ваше фото не участвует в батле", show_alert=True)
                 return
             
-            user_stats = db.get_user_stats(user_id)
+            user_stats = await db.get_user_stats(user_id, replica=False)
             if user_stats['extra_votes'] <= 0:
                 await query.answer("У вас нет дополнительных голосов", show_alert=True)
                 return
             
             votes_to_use = user_stats['extra_votes']
-            db.use_extra_votes(user_id, user_photo['id'], votes_to_use)
+            battle_id = await db.use_extra_votes(user_id, user_photo['id'], votes_to_use)
+            if not battle_id:
+                await query.answer("Ваше фото еще не в батле, голоса сохранены", show_alert=True)
+                return
             
             await query.answer(
                 f"✨ Использовано {votes_to_use} дополнительных голосов!",
@@ -431,13 +669,9 @@ class PhotoBattleBot:
             )
             
             # Обновляем кнопки в канале
-            battle = db.get_battle_by_photo(user_photo['id'])
-            if battle and battle['message_id']:
-                try:
-                    votes = db.get_battle_votes(battle['id'])
-                    await self.update_battle_buttons(battle['id'], battle['message_id'], votes, battle['photo1_id'], battle['photo2_id'])
-                except Exception as e:
-                    logger.error(f"Ошибка обновления кнопок: {e}")
+            tally = await db.get_battle_tally(battle_id)
+            if tally and tally['message_id']:
+                self.update_battle_buttons(battle_id, tally['message_id'])
             
             return
         
@@ -445,7 +679,7 @@ class PhotoBattleBot:
         if data.startswith('admin_'):
             await query.answer()
             
-            if not db.is_admin(user_id):
+            if not await db.is_admin(user_id):
                 await query.answer("❌ Доступно только админам!", show_alert=True)
                 return
             
@@ -464,7 +698,7 @@ class PhotoBattleBot:
             elif data == 'admin_stats':
                 await self.stats(update, context)
             elif data == 'admin_list':
-                admins = db.get_all_admins()
+                admins = await db.get_all_admins()
                 admin_list = "\n".join([f"• {admin_id}" for admin_id in admins])
                 await query.message.reply_text(f"👑 Список админов:\n\n{admin_list}")
             return
@@ -473,7 +707,7 @@ class PhotoBattleBot:
         if data.startswith(('approve_', 'reject_')):
             await query.answer()
             
-            if not db.is_admin(user_id):
+            if not await db.is_admin(user_id):
                 await query.answer("❌ Доступно только админам!", show_alert=True)
                 return
             
@@ -481,12 +715,12 @@ class PhotoBattleBot:
             photo_id = int(photo_id)
             
             if action == 'approve':
-                photo = db.get_photo_by_id(photo_id)
+                photo = await db.get_photo_by_id(photo_id)
                 if not photo:
                     await query.answer("Фото не найдено", show_alert=True)
                     return
                 
-                db.update_photo_status(photo_id, 'approved')
+                await db.update_photo_status(photo_id, 'approved')
                 await query.edit_message_caption(
                     caption=query.message.caption + "\n\n✅ ОДОБРЕНО"
                 )
@@ -498,8 +732,8 @@ class PhotoBattleBot:
                              "Следите за каналом - скоро начнется голосование!",
                         reply_markup=self.get_main_menu()
                     )
-                except:
-                    pass
+                except TelegramError as e:
+                    logger.warning(f"Не удалось отправить сообщение пользователю {photo['user_id']}: {e}")
                 
                 logger.info(f"Фото #{photo_id} одобрено")
                 
@@ -507,7 +741,7 @@ class PhotoBattleBot:
                     await self.check_and_publish_battles(photo['round_id'])
                 
             else:
-                db.update_photo_status(photo_id, 'rejected')
+                await db.update_photo_status(photo_id, 'rejected')
                 await query.edit_message_caption(
                     caption=query.message.caption + "\n\n❌ ОТКЛОНЕНО"
                 )
@@ -515,6 +749,19 @@ class PhotoBattleBot:
         
         # Голосование
         if data.startswith('vote_'):
+            parts = data.split('_')
+            battle_id = int(parts[1])
+            photo_id = int(parts[2])
+            
+            # Повторное нажатие отсекаем по индексу, без БД и get_chat_member
+            if db.voters.has(battle_id, user_id):
+                metrics.inc('voters.duplicate')
+                await query.answer(
+                    "❌ Вы уже проголосовали в этом батле!",
+                    show_alert=True
+                )
+                return
+            
             is_subscribed = await self.check_subscription(user_id)
             if not is_subscribed:
                 await query.answer(
@@ -523,24 +770,17 @@ class PhotoBattleBot:
                 )
                 return
             
-            parts = data.split('_')
-            battle_id = int(parts[1])
-            photo_id = int(parts[2])
+            result = await db.cast_vote(user_id, battle_id, photo_id)
             
-            if db.user_voted_in_battle(user_id, battle_id):
+            if result and not result[0]:
                 await query.answer(
                     "❌ Вы уже проголосовали в этом батле!",
                     show_alert=True
                 )
                 return
             
-            success = db.add_vote(user_id, battle_id, photo_id)
-            
-            if success:
-                votes = db.get_battle_votes(battle_id)
-                
-                battle = db.get_battle_by_id(battle_id)
-                await self.update_battle_buttons(battle_id, query.message.message_id, votes, battle['photo1_id'], battle['photo2_id'])
+            if result:
+                self.update_battle_buttons(battle_id, query.message.message_id)
                 
                 await query.answer(
                     "🔥 Голос учтён!\n\n"
@@ -554,30 +794,40 @@ class PhotoBattleBot:
                     show_alert=True
                 )
     
-    async def update_battle_buttons(self, battle_id: int, message_id: int, votes: dict, photo1_id: int, photo2_id: int):
-        """Обновление кнопок с количеством голосов"""
-        try:
-            keyboard = [
-                [
-                    InlineKeyboardButton(f"лево {votes['photo1']}", callback_data=f"vote_{battle_id}_{photo1_id}"),
-                    InlineKeyboardButton(f"право {votes['photo2']}", callback_data=f"vote_{battle_id}_{photo2_id}")
-                ]
-            ]
-            
-            await self.app.bot.edit_message_reply_markup(
-                chat_id=config.CHANNEL_ID,
-                message_id=message_id,
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
-        except Exception as e:
-            logger.error(f"Ошибка обновления кнопок: {e}")
+    def update_battle_buttons(self, battle_id: int, message_id: int):
+        """
+        Обновление кнопок с количеством голосов: батл отмечается, правка
+        уходит с последним счетом не чаще BUTTON_EDIT_INTERVAL_SECONDS, а при
+        многих батлах - настолько реже, чтобы все правки укладывались
+        в BUTTON_EDIT_SHARE лимита канала
+        """
+        self.button_edits.mark(battle_id, message_id)
+    
+    async def battle_buttons(self, battle_id: int):
+        """Кнопки голосования по текущему счету (из кэша): ((текст, callback_data), ...)"""
+        tally = await db.get_battle_tally(battle_id)
+        if not tally:
+            return None
+        return (
+            (f"лево {tally['photo1']}", f"vote_{battle_id}_{tally['photo1_id']}"),
+            (f"право {tally['photo2']}", f"vote_{battle_id}_{tally['photo2_id']}"),
+        )
+    
+    async def edit_battle_buttons(self, battle_id: int, message_id: int, buttons: tuple):
+        """Заменить кнопки поста батла в канале"""
+        keyboard = [[InlineKeyboardButton(text, callback_data=data) for text, data in buttons]]
+        await self.app.bot.edit_message_reply_markup(
+            chat_id=config.CHANNEL_ID,
+            message_id=message_id,
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
     
-    async def publish_battle(self, battle_id: int, photo1: dict, photo2: dict, round_id: int) -> bool:
-        """Публикация батла в канал"""
+    async def publish_battle(self, battle_id: int, photo1: dict, photo2: dict, round_id: int, round_number: int):
+        """
+        Публикация батла в канал.
+        Возвращает (message_id поста с кнопками, все message_id батла) или None
+        """
         try:
-            current_round = db.get_round_by_id(round_id)
-            round_number = current_round['number'] if current_round else 1
-            
             min_votes_required = config.MIN_VOTES * round_number
             
             end_time = self.round_end_times.get(round_id)
@@ -597,9 +847,6 @@ class PhotoBattleBot:
                 media=media
             )
             
-            for msg in messages:
-                db.add_battle_message(battle_id, msg.message_id)
-            
             # Кнопка "лево" = photo1, "право" = photo2
             keyboard = [
                 [
@@ -608,11 +855,12 @@ class PhotoBattleBot:
                 ]
             ]
             
+            prize = await db.get_prize()
             caption = f"""
 🔥 МОНСТРЫ ТТ
 
 ⚜️ {round_number} раунд
-💰 ПРИЗ: {CURRENT_PRIZE}
+💰 ПРИЗ: {prize}
 
 👉<a href="https://t.me/{config.BOT_USERNAME}">ссылка для голосования</a>👈
 
@@ -631,37 +879,34 @@ class PhotoBattleBot:
                 disable_web_page_preview=True
             )
             
-            db.update_battle_message_id(battle_id, msg.message_id)
-            db.add_battle_message(battle_id, msg.message_id)
-            
             logger.info(f"✅ Батл #{battle_id} опубликован")
-            return True
+            return msg.message_id, [m.message_id for m in messages] + [msg.message_id]
             
         except Exception as e:
             logger.error(f"❌ Ошибка публикации батла #{battle_id}: {e}", exc_info=True)
-            return False
+            return None
     
     async def admin_panel(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Админ-панель"""
         user_id = update.effective_user.id
         
-        if not db.is_admin(user_id):
+        if not await db.is_admin(user_id):
             await update.message.reply_text("❌ Доступ запрещен!")
             return
         
-        current_round = db.get_current_round()
-        pending = db.count_photos_by_status('pending', current_round['id'] if current_round else None)
-        approved = db.count_photos_by_status('approved', current_round['id'] if current_round else None)
-        battles = db.count_battles_in_round(current_round['id']) if current_round else 0
+        stats = db.stats
+        round_number = stats.get('round_number', None)
+        prize = await db.get_prize()
         
         admin_text = f"""
 👑 АДМИН-ПАНЕЛЬ
 
-📊 Текущий раунд: {current_round['number'] if current_round else 'Не создан'}
-📸 На модерации: {pending}
-✅ Одобрено: {approved}
-⚔️ Батлов: {battles}
-💰 Текущий приз: {CURRENT_PRIZE}
+📊 Текущий раунд: {round_number or 'Не создан'}
+📸 На модерации: {stats.get('pending')}
+✅ Одобрено: {stats.get('approved')}
+⚔️ Батлов: {stats.get('battles')}
+💰 Текущий приз: {prize}
+🕐 Данные на {stats.refreshed_at:%H:%M:%S}
 
 Используйте кнопки ниже для управления:
 """
@@ -672,10 +917,10 @@ class PhotoBattleBot:
         """Начать новый раунд"""
         user_id = update.effective_user.id if update.effective_user else None
         
-        if user_id and not db.is_admin(user_id):
+        if user_id and not await db.is_admin(user_id):
             return
         
-        current_round = db.get_current_round()
+        current_round = await db.get_current_round()
         if current_round:
             msg = "❌ Уже есть активный раунд!"
             if update.message:
@@ -685,8 +930,8 @@ class PhotoBattleBot:
             return
         
         # Переносим фото из очереди в новый раунд
-        round_id = db.create_round(round_number=1)
-        db.move_queue_to_round(round_id)
+        round_id = await db.create_round(round_number=1)
+        await db.move_queue_to_round(round_id)
         
         logger.info(f"Создан раунд #{round_id}")
         
@@ -706,72 +951,72 @@ class PhotoBattleBot:
         """Таймер раунда"""
         try:
             await asyncio.sleep(hours * 3600)
-            current_round = db.get_round_by_id(round_id)
+            current_round = await db.get_round_by_id(round_id)
             if current_round and current_round['status'] == 'active':
                 logger.info(f"Таймер раунда {round_id} истек")
         except asyncio.CancelledError:
             logger.info(f"Таймер раунда {round_id} отменен")
     
-    def get_battle_winners(self, round_id: int):
-        """Получить победителей батлов в раунде"""
-        battles = db.get_round_battles(round_id)
-        winners = []
-        losers = []
-        
-        for battle in battles:
-            votes = db.get_battle_votes(battle['id'])
-            photo1 = db.get_photo_by_id(battle['photo1_id'])
-            photo2 = db.get_photo_by_id(battle['photo2_id'])
-            
-            # Получаем username для обоих фото
-            user1 = db.get_user(photo1['user_id'])
-            user2 = db.get_user(photo2['user_id'])
-            
-            photo1_with_username = {**photo1, 'username': user1['username'] if user1 else None}
-            photo2_with_username = {**photo2, 'username': user2['username'] if user2 else None}
-            
-            if votes['photo1'] > votes['photo2']:
-                winners.append({**photo1_with_username, 'votes': votes['photo1']})
-                losers.append({**photo2_with_username, 'votes': votes['photo2']})
-            elif votes['photo2'] > votes['photo1']:
-                winners.append({**photo2_with_username, 'votes': votes['photo2']})
-                losers.append({**photo1_with_username, 'votes': votes['photo1']})
-            else:
-                import random
-                if random.choice([True, False]):
-                    winners.append({**photo1_with_username, 'votes': votes['photo1']})
-                    losers.append({**photo2_with_username, 'votes': votes['photo2']})
-                else:
-                    winners.append({**photo2_with_username, 'votes': votes['photo2']})
-                    losers.append({**photo1_with_username, 'votes': votes['photo1']})
-        
+    async def get_battle_winners(self, round_id: int):
+        """
+        Получить победителей батлов в раунде. Кто проходит дальше, решает
+        счет из основной БД, а не кэш, который догоняет ее с задержкой
+        """
+        results = await db.fetch_battle_results(round_id)
+        winners = [photo for photo in results if photo['is_winner']]
+        losers = [photo for photo in results if not photo['is_winner']]
         return winners, losers
     
-    async def delete_round_messages(self, round_id: int):
-        """Удаление сообщений раунда"""
+    def delete_round_messages(self, round_id: int):
+        """Удаление сообщений раунда из канала в фоне"""
+        self.start_one_shot(self.cleanup_round_messages(round_id))
+    
+    async def cleanup_round_messages(self, round_id: int):
+        """
+        Удаление сообщений раунда пачками по 100 (deleteMessages).
+        Подтвержденные пачки сразу убираются из battle_messages, неудачные
+        повторяются с растущей паузой до CLEANUP_MAX_ATTEMPTS раз. Оставшиеся
+        ID остаются в БД и пробуются снова после перезапуска
+        """
         try:
-            messages = db.get_round_messages(round_id)
-            for msg_id in messages:
-                try:
-                    await self.app.bot.delete_message(
-                        chat_id=config.CHANNEL_ID,
-                        message_id=msg_id
-                    )
-                    await asyncio.sleep(0.1)
-                except:
-                    pass
-            logger.info(f"Удалено {len(messages)} сообщений")
+            pending = await db.get_round_messages(round_id)
+            deleted = 0
+            for attempt in range(config.CLEANUP_MAX_ATTEMPTS):
+                if attempt:
+                    await asyncio.sleep(config.CLEANUP_RETRY_SECONDS * attempt)
+                
+                failed = []
+                for i in range(0, len(pending), 100):
+                    chunk = pending[i:i + 100]
+                    try:
+                        await self.app.bot.delete_messages(chat_id=config.CHANNEL_ID, message_ids=chunk)
+                    except TelegramError as e:
+                        logger.warning(f"Не удалось удалить {len(chunk)} сообщений раунда {round_id}: {e}")
+                        failed.extend(chunk)
+                        continue
+                    await db.delete_battle_messages(chunk)
+                    deleted += len(chunk)
+                    metrics.inc('cleanup.deleted', len(chunk))
+                
+                pending = failed
+                if not pending:
+                    break
+            
+            logger.info(f"Раунд {round_id}: удалено {deleted} сообщений")
+            if pending:
+                metrics.inc('cleanup.failed', len(pending))
+                logger.error(f"Раунд {round_id}: не удалось удалить сообщения {pending}")
         except Exception as e:
-            logger.error(f"Ошибка удаления сообщений: {e}")
+            logger.error(f"Ошибка удаления сообщений раунда {round_id}: {e}", exc_info=True)
     
     async def next_round(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Следующий раунд"""
         user_id = update.effective_user.id if update.effective_user else None
         
-        if user_id and not db.is_admin(user_id):
+        if user_id and not await db.is_admin(user_id):
             return
         
-        current_round = db.get_current_round()
+        current_round = await db.get_current_round()
         if not current_round:
             msg = "❌ Нет активного раунда!"
             if update.message:
@@ -781,67 +1026,66 @@ class PhotoBattleBot:
             return
         
         try:
-            winners, losers = self.get_battle_winners(current_round['id'])
+            winners, losers = await self.get_battle_winners(current_round['id'])
+            await db.end_round_battles(current_round['id'])
             
-            for winner in winners:
-                try:
-                    await self.app.bot.send_message(
-                        chat_id=winner['user_id'],
-                        text=f"✅ Поздравляем! Твое фото прошло в следующий раунд!\n\n"
-                             f"📊 Ты набрал {winner['votes']} голосов и победил в своей паре!",
-                        reply_markup=self.get_main_menu()
-                    )
-                except:
-                    pass
-            
-            for loser in losers:
-                try:
-                    await self.app.bot.send_message(
-                        chat_id=loser['user_id'],
-                        text=f"😔 К сожалению, твое фото не прошло в следующий раунд\n\n"
-                             f"📊 Ты набрал {loser['votes']} голосов, но соперник набрал больше\n\n"
-                             f"💪 Не расстраивайся! Участвуй в следующем батле!",
-                        reply_markup=self.get_main_menu()
-                    )
-                except:
-                    pass
+            # Итоги участникам уходят через очередь, команда их не ждет
+            main_menu = self.get_main_menu().to_dict()
+            await self.notify_users('round_results', current_round['id'], [
+                (
+                    winner['user_id'],
+                    f"✅ Поздравляем! Твое фото прошло в следующий раунд!\n\n"
+                    f"📊 Ты набрал {winner['votes']} голосов и победил в своей паре!",
+                    main_menu
+                )
+                for winner in winners
+            ] + [
+                (
+                    loser['user_id'],
+                    f"😔 К сожалению, твое фото не прошло в следующий раунд\n\n"
+                    f"📊 Ты набрал {loser['votes']} голосов, но соперник набрал больше\n\n"
+                    f"💪 Не расстраивайся! Участвуй в следующем батле!",
+                    main_menu
+                )
+                for loser in losers
+            ])
             
-            await self.delete_round_messages(current_round['id'])
+            self.delete_round_messages(current_round['id'])
             
             if len(winners) == 1:
                 winner = winners[0]
-                db.end_round(current_round['id'])
+                await db.end_round(current_round['id'])
+                prize = await db.get_prize()
                 
-                try:
-                    await self.app.bot.send_message(
-                        chat_id=winner['user_id'],
-                        text=f"🏆 ПОЗДРАВЛЯЕМ! ТЫ ПОБЕДИТЕЛЬ ФОТОБАТЛА!\n\n"
-                             f"💰 Твой приз: {CURRENT_PRIZE}\n\n"
-                             f"🎉 Свяжись с админом @lixxxer для получения приза!",
-                        reply_markup=self.get_main_menu()
-                    )
-                except:
-                    pass
+                await self.notify_users('winner', current_round['id'], [(
+                    winner['user_id'],
+                    f"🏆 ПОЗДРАВЛЯЕМ! ТЫ ПОБЕДИТЕЛЬ ФОТОБАТЛА!\n\n"
+                    f"💰 Твой приз: {prize}\n\n"
+                    f"🎉 Свяжись с админом @lixxxer для получения приза!",
+                    main_menu
+                )])
                 
                 username = f"@{winner['username']}" if winner.get('username') else "Аноним"
                 msg = f"✅ Батл завершен! Победитель: {username} ({winner['votes']} голосов)"
             
             elif len(winners) < 2:
-                db.end_round(current_round['id'])
+                await db.end_round(current_round['id'])
                 msg = "⚠️ Недостаточно победителей для следующего раунда. Батл завершен."
             
             else:
                 next_round_number = current_round['number'] + 1
-                new_round_id = db.create_round(round_number=next_round_number)
-                db.update_round_status(current_round['id'], 'completed')
+                new_round_id = await db.create_round(round_number=next_round_number)
+                await db.update_round_status(current_round['id'], 'completed')
                 
                 task = asyncio.create_task(self.round_timer(new_round_id, hours=2))
                 self.round_tasks[new_round_id] = task
                 
-                await self.publish_battles_from_winners(new_round_id, winners)
+                await self.publish_battles_from_winners(new_round_id, next_round_number, winners)
                 
                 msg = f"✅ Раунд {next_round_number} начат! Участников: {len(winners)}"
             
+            await self.archive_rounds()
+            
             if update.message:
                 await update.message.reply_text(msg)
             elif update.callback_query:
@@ -850,27 +1094,31 @@ class PhotoBattleBot:
         except Exception as e:
             logger.error(f"Ошибка в next_round: {e}", exc_info=True)
     
-    async def publish_battles_from_winners(self, round_id: int, winners: list):
+    async def publish_battles_from_winners(self, round_id: int, round_number: int, winners: list):
         """Публикация батлов из победителей"""
         import random
         random.shuffle(winners)
         
-        for i in range(0, len(winners) - 1, 2):
-            photo1 = winners[i]
-            photo2 = winners[i + 1]
-            
-            battle_id = db.create_battle(round_id, photo1['id'], photo2['id'])
-            await self.publish_battle(battle_id, photo1, photo2, round_id)
-            await asyncio.sleep(2)
+        pairs = [(winners[i], winners[i + 1]) for i in range(0, len(winners) - 1, 2)]
+        battle_ids = await db.create_battles(round_id, [(p1['id'], p2['id']) for p1, p2 in pairs])
+        
+        published = []
+        try:
+            for battle_id, (photo1, photo2) in zip(battle_ids, pairs):
+                messages = await self.publish_battle(battle_id, photo1, photo2, round_id, round_number)
+                if messages:
+                    published.append((battle_id, *messages))
+        finally:
+            await db.save_battle_messages(published)
     
     async def end_battle(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Завершить батл"""
         user_id = update.effective_user.id if update.effective_user else None
         
-        if user_id and not db.is_admin(user_id):
+        if user_id and not await db.is_admin(user_id):
             return
         
-        current_round = db.get_current_round()
+        current_round = await db.get_current_round()
         if not current_round:
             msg = "❌ Нет активного раунда!"
             if update.message:
@@ -883,7 +1131,7 @@ class PhotoBattleBot:
             if current_round['id'] in self.round_tasks:
                 self.round_tasks[current_round['id']].cancel()
             
-            round_photos = db.get_round_photos_with_votes(current_round['id'])
+            round_photos = await db.get_round_photos_with_votes(current_round['id'])
             
             if not round_photos:
                 msg = "❌ Нет фото в текущем раунде"
@@ -896,20 +1144,20 @@ class PhotoBattleBot:
             round_photos.sort(key=lambda x: x['votes'], reverse=True)
             winner = round_photos[0]
             
-            db.end_round(current_round['id'])
-            await self.delete_round_messages(current_round['id'])
+            await db.end_round_battles(current_round['id'])
+            await db.end_round(current_round['id'])
+            self.delete_round_messages(current_round['id'])
+            await self.archive_rounds()
+            prize = await db.get_prize()
             
-            try:
-                await self.app.bot.send_message(
-                    chat_id=winner['user_id'],
-                    text=f"🏆 ПОЗДРАВЛЯЕМ! ТЫ ПОБЕДИТЕЛЬ ФОТОБАТЛА!\n\n"
-                         f"💰 Твой приз: {CURRENT_PRIZE}\n\n"
-                         f"📊 Ты набрал {winner['votes']} голосов!\n\n"
-                         f"🎉 Свяжись с админом @lixxxer для получения приза!",
-                    reply_markup=self.get_main_menu()
-                )
-            except:
-                pass
+            await self.notify_users('winner', current_round['id'], [(
+                winner['user_id'],
+                f"🏆 ПОЗДРАВЛЯЕМ! ТЫ ПОБЕДИТЕЛЬ ФОТОБАТЛА!\n\n"
+                f"💰 Твой приз: {prize}\n\n"
+                f"📊 Ты набрал {winner['votes']} голосов!\n\n"
+                f"🎉 Свяжись с админом @lixxxer для получения приза!",
+                self.get_main_menu().to_dict()
+            )])
             
             username = f"@{winner['username']}" if winner.get('username') else "Аноним"
             result_text = f"🏆 Фотобатл завершен!\n\n"
@@ -932,16 +1180,20 @@ class PhotoBattleBot:
             logger.error(f"Ошибка в end_battle: {e}", exc_info=True)
     
     async def stats(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Статистика"""
-        stats = db.get_bot_stats()
+        """Статистика (/stats exact - точный пересчет, только для админов)"""
+        stats = db.stats
+        if context.args and context.args[0] == 'exact' and await db.is_admin(update.effective_user.id):
+            stats = await db.refresh_stats(exact=True)
         
         stats_text = f"""
 📊 СТАТИСТИКА:
 
-👥 Пользователей: {stats['total_users']}
-📸 Фото: {stats['total_photos']}
-⚔️ Батлов: {stats['total_battles']}
-🗳 Голосов: {stats['total_votes']}
+👥 Пользователей: {stats.get('total_users')}
+📸 Фото: {stats.get('total_photos')}
+⚔️ Батлов: {stats.get('total_battles')}
+🗳 Голосов: {stats.get('total_votes')}
+
+🕐 Обновлено: {stats.refreshed_at:%H:%M:%S}{' (точно)' if stats.exact else ''}
 """
         
         if update.message:
@@ -949,11 +1201,99 @@ class PhotoBattleBot:
         elif update.callback_query:
             await update.callback_query.message.reply_text(stats_text)
     
-    async def set_prize(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Изменить приз"""
-        global CURRENT_PRIZE
+    async def show_metrics(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Метрики процесса (по умолчанию - счетчики SQL-запросов)"""
+        if not await db.is_admin(update.effective_user.id):
+            await update.message.reply_text("❌ Доступ запрещен!")
+            return
+        
+        prefix = context.args[0] if context.args else 'sql.'
+        await update.message.reply_text(f"📈 Метрики {prefix}\n\n{metrics.render(prefix)}")
+    
+    async def backfill_stats(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Пересчитать статистику пользователей по всей истории"""
+        if not await db.is_admin(update.effective_user.id):
+            await update.message.reply_text("❌ Доступ запрещен!")
+            return
+        
+        rows = await db.rebuild_user_stats()
+        await update.message.reply_text(f"✅ Статистика пересчитана для {rows} пользователей")
+    
+    async def check_tallies(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Сверить счетчики голосов с журналом (/check_tallies fix - исправить)"""
+        if not await db.is_admin(update.effective_user.id):
+            await update.message.reply_text("❌ Доступ запрещен!")
+            return
+        
+        current_round = await db.get_current_round()
+        if not current_round:
+            await update.message.reply_text("❌ Нет активного раунда!")
+            return
         
-        if not db.is_admin(update.effective_user.id):
+        repair = bool(context.args) and context.args[0] == 'fix'
+        drift = await db.check_tallies(current_round['id'], repair=repair)
+        if not drift:
+            await update.message.reply_text("✅ Счетчики совпадают с журналом голосов")
+            return
+        
+        lines = [
+            f"Батл #{row['battle_id']}, фото {row['side']}: журнал {row['ledger_votes']}, счетчик {row['tally_votes']}"
+            for row in drift[:20]
+        ]
+        status = "🔧 Исправлено" if repair else "⚠️ Расхождения (/check_tallies fix - исправить)"
+        await update.message.reply_text(f"{status}: {len(drift)}\n\n" + "\n".join(lines))
+    
+    async def check_plans(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Проверить планы запросов бота на текущих данных"""
+        if not await db.is_admin(update.effective_user.id):
+            await update.message.reply_text("❌ Доступ запрещен!")
+            return
+        
+        problems = await db.check_plans()
+        if not problems:
+            await update.message.reply_text("✅ Планы запросов в норме")
+            return
+        
+        await update.message.reply_text(f"⚠️ Проблемы в планах: {len(problems)}\n\n" + "\n".join(problems[:30]))
+    
+    async def show_notifications(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Статистика доставки последних рассылок"""
+        if not await db.is_admin(update.effective_user.id):
+            await update.message.reply_text("❌ Доступ запрещен!")
+            return
+        
+        batches = await db.get_notification_batches()
+        if not batches:
+            await update.message.reply_text("Рассылок еще не было")
+            return
+        
+        lines = []
+        for batch in batches:
+            status = "✅" if batch['finished_at'] else "⏳"
+            lines.append(
+                f"{status} #{batch['id']} {batch['kind']} (раунд {batch['round_id'] or '-'}): "
+                f"доставлено {batch['sent']}, ошибок {batch['failed']} из {batch['total']}"
+            )
+        await update.message.reply_text("📨 Рассылки:\n\n" + "\n".join(lines))
+    
+    async def broadcast(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Рассылка всем пользователям (/broadcast текст)"""
+        if not await db.is_admin(update.effective_user.id):
+            await update.message.reply_text("❌ Доступ запрещен!")
+            return
+        
+        text = update.message.text.partition(' ')[2].strip()
+        if not text:
+            await update.message.reply_text("Использование: /broadcast Текст сообщения")
+            return
+        
+        broadcast_id = await db.create_broadcast(text, update.effective_user.id)
+        self.start_one_shot(self.run_broadcast(broadcast_id))
+        await update.message.reply_text(f"📣 Рассылка #{broadcast_id} запущена, отчет придет по завершении")
+    
+    async def set_prize(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Изменить приз (сохраняется в БД)"""
+        if not await db.is_admin(update.effective_user.id):
             await update.message.reply_text("❌ Доступ запрещен!")
             return
         
@@ -961,8 +1301,9 @@ class PhotoBattleBot:
             await update.message.reply_text("Использование: /set_prize Ваш приз\nПример: /set_prize 1000₽")
             return
         
-        CURRENT_PRIZE = " ".join(context.args)
-        await update.message.reply_text(f"✅ Приз изменен на: {CURRENT_PRIZE}")
+        prize = " ".join(context.args)
+        await db.set_prize(prize)
+        await update.message.reply_text(f"✅ Приз изменен на: {prize}")
     
     def run(self):
         """Запуск бота"""
@@ -0,0 +1,357 @@
+"""
+In-memory состояние бота, которое Database держит рядом с БД
+"""
+import asyncio
+from collections import OrderedDict
+from datetime import datetime
+import time
+
+import metrics
+
+
+class StatsSnapshot:
+    """
+    Последний снимок статистики бота. /stats и /admin отвечают из него,
+    не трогая БД; обновляется фоновой задачей
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.exact = False
+        self.refreshed_at = None
+
+    def update(self, data: dict, exact: bool = False):
+        """Заменить снимок свежими данными"""
+        self.data = data
+        self.exact = exact
+        self.refreshed_at = datetime.now()
+
+    def get(self, key: str, default=0):
+        """Значение из снимка"""
+        return self.data.get(key, default)
+
+
+class StateCache:
+    """
+    Редко меняющееся состояние: активный раунд, админы и приз.
+    Каждое поле сбрасывается методами Database, которые его меняют,
+    и загружается заново при следующем чтении. version растет при любом
+    сбросе: загрузка, начатая до сброса, свой результат не сохраняет
+    """
+
+    def __init__(self):
+        self.version = 0
+        self.round = None
+        self.round_loaded = False
+        self.admins = None
+        self.prize = None
+
+    def invalidate_round(self):
+        """Активный раунд изменился"""
+        self.version += 1
+        self.round = None
+        self.round_loaded = False
+
+    def invalidate_admins(self):
+        """Список админов изменился"""
+        self.version += 1
+        self.admins = None
+
+    def invalidate_prize(self):
+        """Приз изменился"""
+        self.version += 1
+        self.prize = None
+
+
+class TallyCache:
+    """
+    Голоса батлов активного раунда в памяти: кнопки и итоги раунда
+    берутся отсюда без запросов к БД. Голоса только растут, поэтому
+    свежие значения применяются как поэлементный максимум и порядок,
+    в котором приходят ответы БД, не важен
+    """
+
+    def __init__(self):
+        self.round_id = None
+        self.battles = {}
+
+    @staticmethod
+    def entry(row: dict) -> dict:
+        """Запись кэша из строки battle_scores"""
+        return {
+            'photo1_id': row['photo1_id'],
+            'photo2_id': row['photo2_id'],
+            'photo1': row['photo1_votes'],
+            'photo2': row['photo2_votes'],
+            'message_id': row.get('message_id'),
+        }
+
+    def load(self, round_id: int, rows: list):
+        """Заменить кэш батлами раунда"""
+        self.round_id = round_id
+        self.battles = {row['battle_id']: self.entry(row) for row in rows}
+
+    def clear(self):
+        """Сбросить кэш (раунд завершен)"""
+        self.round_id = None
+        self.battles = {}
+
+    def add(self, round_id: int, battle_id: int, photo1_id: int, photo2_id: int):
+        """Новый батл без голосов, если он из закэшированного раунда"""
+        if round_id == self.round_id:
+            self.battles.setdefault(battle_id, {
+                'photo1_id': photo1_id,
+                'photo2_id': photo2_id,
+                'photo1': 0,
+                'photo2': 0,
+                'message_id': None,
+            })
+
+    def update(self, battle_id: int, votes1: int, votes2: int):
+        """Принять счет батла, прочитанный из БД"""
+        entry = self.battles.get(battle_id)
+        if entry:
+            entry['photo1'] = max(entry['photo1'], votes1)
+            entry['photo2'] = max(entry['photo2'], votes2)
+
+    def set_message(self, battle_id: int, message_id: int):
+        """Запомнить message_id поста батла с кнопками"""
+        entry = self.battles.get(battle_id)
+        if entry:
+            entry['message_id'] = message_id
+
+    def bump(self, battle_id: int, side: int, weight: int):
+        """Добавить голоса стороне батла (1 или 2)"""
+        entry = self.battles.get(battle_id)
+        if entry:
+            entry[f'photo{side}'] += weight
+
+    def get(self, battle_id: int):
+        """Запись батла или None, если батла нет в кэше"""
+        return self.battles.get(battle_id)
+
+    def reconcile(self, rows: list) -> int:
+        """
+        Сверить кэш со строками battle_scores раунда и принять их тем же
+        поэлементным максимумом, что и update(): строки прочитаны раньше,
+        чем применяются, и голоса, добавленные после чтения, не теряются.
+        Батлы, которых в строках нет (созданы после чтения), остаются.
+        Возвращает расхождение - сумму модулей разниц по всем сторонам
+        """
+        drift = 0
+        for row in rows:
+            entry = self.battles.get(row['battle_id'])
+            if entry:
+                drift += abs(entry['photo1'] - row['photo1_votes'])
+                drift += abs(entry['photo2'] - row['photo2_votes'])
+                self.update(row['battle_id'], row['photo1_votes'], row['photo2_votes'])
+                if row.get('message_id') is not None:
+                    entry['message_id'] = row['message_id']
+            else:
+                drift += row['photo1_votes'] + row['photo2_votes']
+                self.battles[row['battle_id']] = self.entry(row)
+        return drift
+
+
+class VoterIndex:
+    """
+    Кто уже голосовал в батлах активного раунда: точное множество
+    telegram_id на батл. Повторное нажатие отсекается без БД и без
+    get_chat_member. Для батла, которого нет в индексе, ответа нет (None)
+    и решает БД.
+
+    Память: 70-100 байт на голос (int telegram_id - 32 байта, остальное -
+    слоты хеш-таблиц set с запасом на рост), то есть 7-10 МБ на 100 тыс.
+    голосов в зависимости от числа батлов. Проверка - в __main__ модуля
+    """
+
+    def __init__(self):
+        self.round_id = None
+        self.battles = {}
+
+    def load(self, round_id: int, battle_ids: list, votes: list):
+        """Заменить индекс: батлы раунда и пары (battle_id, user_id)"""
+        self.round_id = round_id
+        self.battles = {battle_id: set() for battle_id in battle_ids}
+        for battle_id, user_id in votes:
+            self.battles.setdefault(battle_id, set()).add(user_id)
+
+    def clear(self):
+        """Сбросить индекс (раунд завершен)"""
+        self.round_id = None
+        self.battles = {}
+
+    def track(self, round_id: int, battle_id: int):
+        """Новый батл без голосов, если он из проиндексированного раунда"""
+        if round_id == self.round_id:
+            self.battles.setdefault(battle_id, set())
+
+    def add(self, battle_id: int, user_id: int):
+        """Отметить голос пользователя в батле"""
+        voters = self.battles.get(battle_id)
+        if voters is not None:
+            voters.add(user_id)
+
+    def has(self, battle_id: int, user_id: int):
+        """True/False - точный ответ, None - батла нет в индексе"""
+        voters = self.battles.get(battle_id)
+        if voters is None:
+            return None
+        return user_id in voters
+
+    def size(self) -> int:
+        """Всего голосов в индексе"""
+        return sum(len(voters) for voters in self.battles.values())
+
+
+class ProfileCache:
+    """
+    Данные профиля по пользователям (статистика, голоса, участие в раунде)
+    с вытеснением давно не читанных сверх max_size. Запись сбрасывается,
+    когда меняется что-то, что в ней показано; version - как в StateCache
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.version = 0
+        self.entries = OrderedDict()
+
+    def get(self, user_id: int):
+        """Профиль из кэша или None"""
+        profile = self.entries.get(user_id)
+        if profile is not None:
+            self.entries.move_to_end(user_id)
+        return profile
+
+    def put(self, user_id: int, profile: dict):
+        """Сохранить профиль, вытеснив самые старые записи"""
+        self.entries[user_id] = profile
+        self.entries.move_to_end(user_id)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, *user_ids):
+        """Сбросить профили пользователей"""
+        self.version += 1
+        for user_id in user_ids:
+            self.entries.pop(user_id, None)
+
+    def clear(self):
+        """Сбросить все профили (сменился раунд)"""
+        self.version += 1
+        self.entries.clear()
+
+
+class SubscriberIndex:
+    """
+    Подписан ли пользователь на канал. Заполняется событиями chat_member
+    (бот - админ канала), для тех, по кому событий не было, - результатом
+    get_chat_member с TTL. Одновременные нажатия одного пользователя ждут
+    один и тот же запрос к API. Сверх max_size вытесняются давно не читанные
+    """
+
+    def __init__(self, ttl: float, event_ttl: float, max_size: int):
+        self.ttl = ttl
+        self.event_ttl = event_ttl
+        self.max_size = max_size
+        self.members = OrderedDict()
+        self.inflight = {}
+
+    def set(self, user_id: int, is_member: bool, ttl: float = None):
+        """Запомнить статус подписки на ttl секунд, вытеснив самые старые записи"""
+        self.members[user_id] = (is_member, time.monotonic() + (ttl or self.ttl))
+        self.members.move_to_end(user_id)
+        while len(self.members) > self.max_size:
+            self.members.popitem(last=False)
+            metrics.inc('subscribers.evicted')
+
+    def on_event(self, user_id: int, is_member: bool):
+        """Статус из события chat_member"""
+        metrics.inc('subscribers.event')
+        self.set(user_id, is_member, self.event_ttl)
+
+    def get(self, user_id: int):
+        """True/False из индекса или None, если статус неизвестен или устарел"""
+        entry = self.members.get(user_id)
+        if entry is None:
+            return None
+        is_member, expires_at = entry
+        if expires_at < time.monotonic():
+            del self.members[user_id]
+            return None
+        self.members.move_to_end(user_id)
+        return is_member
+
+    async def check(self, user_id: int, fetch):
+        """
+        Статус подписки: из индекса, иначе через fetch(user_id).
+        Ошибка fetch не кэшируется и достается всем ждущим
+        """
+        is_member = self.get(user_id)
+        if is_member is not None:
+            metrics.inc('subscribers.hit')
+            return is_member
+        
+        task = self.inflight.get(user_id)
+        if task is None:
+            metrics.inc('subscribers.miss')
+            task = asyncio.ensure_future(self.lookup(user_id, fetch))
+            self.inflight[user_id] = task
+        else:
+            metrics.inc('subscribers.shared')
+        # shield: отмена одного ждущего не отменяет запрос для остальных
+        return await asyncio.shield(task)
+
+    async def lookup(self, user_id: int, fetch):
+        """Запрос статуса с записью в индекс"""
+        try:
+            is_member = await fetch(user_id)
+            known = self.get(user_id)
+            if known is not None:
+                # Пока шел запрос, пришло событие chat_member - оно свежее
+                return known
+            self.set(user_id, is_member)
+            return is_member
+        finally:
+            self.inflight.pop(user_id, None)
+
+
+if __name__ == "__main__":
+    # Проверка памяти VoterIndex на 100 тыс. голосов
+    import tracemalloc
+    
+    tracemalloc.start()
+    index = VoterIndex()
+    index.load(1, list(range(50)), [
+        (n % 50, 5_000_000_000 + n) for n in range(100_000)
+    ])
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    
+    assert index.size() == 100_000
+    assert index.has(0, 5_000_000_000) is True
+    assert index.has(0, 5_000_000_001) is False
+    assert index.has(999, 5_000_000_000) is None
+    mb = current / 1024 / 1024
+    print(f"VoterIndex: 100 тыс. голосов = {mb:.1f} МБ")
+    assert mb < 11, "VoterIndex занимает больше заявленного"
+    
+    # Сверка счета не откатывает голоса и батлы, появившиеся после чтения строк
+    tallies = TallyCache()
+    row = {'battle_id': 1, 'photo1_id': 10, 'photo2_id': 11, 'photo1_votes': 2, 'photo2_votes': 0, 'message_id': 5}
+    tallies.load(1, [row])
+    tallies.bump(1, 1, 1)
+    tallies.add(1, 2, 12, 13)
+    tallies.reconcile([dict(row, photo2_votes=1)])
+    assert (tallies.get(1)['photo1'], tallies.get(1)['photo2']) == (3, 1)
+    assert tallies.get(2) is not None, "батл, созданный после чтения, пропал из кэша"
+    
+    # Индекс подписчиков не растет сверх max_size, читаемые записи остаются
+    subscribers = SubscriberIndex(ttl=60, event_ttl=60, max_size=100)
+    subscribers.on_event(0, True)
+    for user_id in range(1, 1000):
+        subscribers.set(user_id, True)
+        subscribers.get(0)
+    assert len(subscribers.members) == 100
+    assert subscribers.get(0) is True and subscribers.get(1) is None
+    print("✅ Все тесты пройдены!")
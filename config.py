@@ -20,7 +20,49 @@ DB_PORT = os.getenv('DB_PORT', '5432')
 DB_NAME = os.getenv('DB_NAME', 'photobattle')
 DB_USER = os.getenv('DB_USER', 'postgres')
 DB_PASSWORD = os.getenv('DB_PASSWORD', 'postgres')
+DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', '2'))  # Соединений в пуле минимум
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', '10'))  # Соединений в пуле максимум
+DB_CONNECT_TIMEOUT = float(os.getenv('DB_CONNECT_TIMEOUT', '30'))  # Секунд на первое подключение
+DB_RECONNECT_TIMEOUT = float(os.getenv('DB_RECONNECT_TIMEOUT', '300'))  # Секунд попыток переподключения
+DB_NOTIFY_CHANNEL = os.getenv('DB_NOTIFY_CHANNEL', 'photobattle_state')  # Канал LISTEN/NOTIFY между процессами бота
+DB_NOTIFY_RECONNECT_SECONDS = int(os.getenv('DB_NOTIFY_RECONNECT_SECONDS', '5'))  # Пауза перед переподключением слушателя
+PLAN_COST_BUDGET = float(os.getenv('PLAN_COST_BUDGET', '1000'))  # Максимальная стоимость плана горячего запроса (/plans)
+PLAN_SEQSCAN_MIN_ROWS = int(os.getenv('PLAN_SEQSCAN_MIN_ROWS', '1000'))  # С какого размера таблицы Seq Scan считается проблемой
+VOTES_ARCHIVE_SCHEMA = os.getenv('VOTES_ARCHIVE_SCHEMA', 'votes_archive')  # Схема для журналов голосов завершенных раундов
+DB_REPLICA_DSN = os.getenv('DB_REPLICA_DSN', '')  # Строка подключения к реплике для чтений (пусто - все в основную БД)
+DB_REPLICA_MAX_LAG_SECONDS = float(os.getenv('DB_REPLICA_MAX_LAG_SECONDS', '5'))  # Большее отставание - чтения уходят в основную БД
+DB_REPLICA_CHECK_SECONDS = int(os.getenv('DB_REPLICA_CHECK_SECONDS', '10'))  # Период проверки отставания реплики
+DB_REPLICA_TIMEOUT_SECONDS = float(os.getenv('DB_REPLICA_TIMEOUT_SECONDS', '2'))  # Ожидание соединения с репликой, потом чтение идет в основную БД
 
 # Настройки батла
 MIN_VOTES = int(os.getenv('MIN_VOTES', '8'))  # Минимум голосов для прохода в след раунд
 VOTES_PER_REFERRAL = int(os.getenv('VOTES_PER_REFERRAL', '3'))  # Голосов за 1 реферала
+TALLY_STRIPES = int(os.getenv('TALLY_STRIPES', '8'))  # Полос счетчика голосов на сторону батла
+DEFAULT_PRIZE = os.getenv('DEFAULT_PRIZE', '777₽ или 350⭐')  # Приз, пока админ не задал свой через /set_prize
+
+# Фоновые задачи
+STATS_REFRESH_SECONDS = int(os.getenv('STATS_REFRESH_SECONDS', '60'))  # Период обновления снимка /stats и /admin
+TALLY_RECONCILE_SECONDS = int(os.getenv('TALLY_RECONCILE_SECONDS', '30'))  # Период сверки кэша голосов с БД
+
+# Исходящие запросы к Telegram
+BUTTON_EDIT_INTERVAL_SECONDS = float(os.getenv('BUTTON_EDIT_INTERVAL_SECONDS', '2'))  # Не чаще одной правки кнопок батла за столько секунд
+BUTTON_EDIT_SHARE = float(os.getenv('BUTTON_EDIT_SHARE', '0.5'))  # Доля TG_CHANNEL_PER_MINUTE на правки кнопок, остальное - публикация и удаление
+TG_RATE_OVERALL = float(os.getenv('TG_RATE_OVERALL', '30'))  # Сообщений в секунду на весь бот
+TG_RATE_PRIVATE = float(os.getenv('TG_RATE_PRIVATE', '1'))  # Сообщений в секунду в один личный чат
+TG_GROUP_PER_MINUTE = int(os.getenv('TG_GROUP_PER_MINUTE', '20'))  # Сообщений в минуту в одну группу/канал
+TG_CHANNEL_PER_MINUTE = int(os.getenv('TG_CHANNEL_PER_MINUTE', '60'))  # Запросов в минуту в канал батлов: публикация, правки кнопок, удаление
+TG_MAX_RETRIES = int(os.getenv('TG_MAX_RETRIES', '3'))  # Повторов запроса после RetryAfter
+NOTIFY_BATCH_SIZE = int(os.getenv('NOTIFY_BATCH_SIZE', '100'))  # Личных сообщений из очереди, отправляемых одновременно
+NOTIFY_POLL_SECONDS = int(os.getenv('NOTIFY_POLL_SECONDS', '5'))  # Период проверки очереди сообщений
+NOTIFY_LOCK_SECONDS = int(os.getenv('NOTIFY_LOCK_SECONDS', '300'))  # Через сколько взятое, но не отправленное сообщение вернется в очередь
+NOTIFY_MAX_ATTEMPTS = int(os.getenv('NOTIFY_MAX_ATTEMPTS', '3'))  # Попыток отправки сообщения из очереди
+NOTIFY_RETRY_SECONDS = float(os.getenv('NOTIFY_RETRY_SECONDS', '30'))  # Пауза перед повтором сообщения из очереди (растет с попыткой)
+BROADCAST_CHUNK_SIZE = int(os.getenv('BROADCAST_CHUNK_SIZE', '500'))  # Получателей рассылки в пачке (между контрольными точками)
+CLEANUP_MAX_ATTEMPTS = int(os.getenv('CLEANUP_MAX_ATTEMPTS', '3'))  # Попыток удалить пачку сообщений раунда из канала
+CLEANUP_RETRY_SECONDS = float(os.getenv('CLEANUP_RETRY_SECONDS', '30'))  # Пауза перед повтором удаления (растет с попыткой)
+
+# Кэши в памяти
+SUBSCRIPTION_TTL_SECONDS = int(os.getenv('SUBSCRIPTION_TTL_SECONDS', '600'))  # Сколько верить ответу get_chat_member
+SUBSCRIPTION_EVENT_TTL_SECONDS = int(os.getenv('SUBSCRIPTION_EVENT_TTL_SECONDS', '86400'))  # Сколько верить событию chat_member
+PROFILE_CACHE_SIZE = int(os.getenv('PROFILE_CACHE_SIZE', '10000'))  # Профилей в памяти максимум
+SUBSCRIBER_INDEX_SIZE = int(os.getenv('SUBSCRIBER_INDEX_SIZE', '100000'))  # Статусов подписки в памяти максимум
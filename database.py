@@ -1,31 +1,502 @@
-import psycopg2
-from psycopg2.extras import RealDictCursor
-from datetime import datetime
+from contextlib import asynccontextmanager
+from enum import Enum
+import asyncio
+import hashlib
+import json
+import random
+import uuid
+
+import psycopg
+from psycopg.conninfo import make_conninfo
+from psycopg import sql
+from psycopg.rows import dict_row, tuple_row
+from psycopg_pool import AsyncConnectionPool, PoolTimeout
+from cache import ProfileCache, StateCache, StatsSnapshot, TallyCache, VoterIndex
 import config
+import metrics
+
+
+# Горячие запросы: готовятся на сервере один раз на соединение
+# и дальше выполняются по имени через Database.run()
+STATEMENTS = {
+    'get_admin_ids': "SELECT telegram_id FROM admins",
+    'get_setting': "SELECT value FROM settings WHERE key = %s",
+    'get_user': "SELECT * FROM users WHERE telegram_id = %s",
+    'count_user_photos': """
+        SELECT COUNT(*) FROM photos
+        WHERE user_id = %s AND status != 'rejected'
+    """,
+    'get_current_round': "SELECT * FROM rounds WHERE status = 'active' ORDER BY id DESC LIMIT 1",
+    'get_round_by_id': "SELECT * FROM rounds WHERE id = %s",
+    'user_has_photo_in_queue': """
+        SELECT COUNT(*) FROM photos
+        WHERE user_id = %s AND is_queue = TRUE AND status != 'rejected'
+    """,
+    'user_has_photo_in_round': """
+        SELECT COUNT(*) FROM photos
+        WHERE user_id = %s AND round_id = %s AND status != 'rejected'
+    """,
+    'get_photo_by_id': "SELECT * FROM photos WHERE id = %s",
+    # LIMIT NULL - без ограничения
+    'get_approved_photos': """
+        SELECT * FROM photos
+        WHERE round_id = %s AND status = 'approved'
+        ORDER BY created_at
+        LIMIT %s
+    """,
+    'get_unpaired_photos': """
+        SELECT p.* FROM photos p
+        WHERE p.round_id = %(round_id)s
+          AND p.status = 'approved'
+          AND p.id NOT IN (
+              SELECT photo1_id FROM battles WHERE round_id = %(round_id)s
+              UNION
+              SELECT photo2_id FROM battles WHERE round_id = %(round_id)s
+          )
+        ORDER BY p.created_at
+    """,
+    'get_user_photo_in_round': """
+        SELECT * FROM photos
+        WHERE user_id = %s AND round_id = %s
+        ORDER BY created_at DESC
+        LIMIT 1
+    """,
+    'get_battle_by_id': "SELECT * FROM battles WHERE id = %s",
+    'get_battle_by_photo': """
+        SELECT * FROM battles
+        WHERE photo1_id = %s OR photo2_id = %s
+        ORDER BY created_at DESC
+        LIMIT 1
+    """,
+    'user_voted_in_battle': """
+        SELECT COUNT(*) FROM votes
+        WHERE user_id = %s AND battle_id = %s AND kind = 'regular'
+    """,
+    # Проверка повтора, запись в журнал и полоса счетчика одним запросом.
+    # Полоса выбирается по user_id, так что одновременные голоса разных
+    # людей почти не пишут в одну строку. Основной SELECT видит снимок до
+    # изменений, поэтому свой голос добавляем к счету сами. Принятый голос
+    # публикуется через pg_notify и уходит другим процессам вместе с коммитом
+    'cast_vote': """
+        WITH battle AS (
+            SELECT round_id, photo1_id, photo2_id, photo1_votes, photo2_votes
+            FROM battle_scores
+            WHERE battle_id = %(battle_id)s AND %(photo_id)s IN (photo1_id, photo2_id)
+        ),
+        vote AS (
+            INSERT INTO votes (round_id, user_id, battle_id, photo_id, weight, kind)
+            SELECT round_id, %(user_id)s, %(battle_id)s, %(photo_id)s, 1, 'regular' FROM battle
+            ON CONFLICT (round_id, user_id, battle_id) WHERE kind = 'regular' DO NOTHING
+            RETURNING photo_id
+        ),
+        tally AS (
+            INSERT INTO battle_tallies (battle_id, side, stripe, votes)
+            SELECT %(battle_id)s, CASE WHEN v.photo_id = b.photo1_id THEN 1 ELSE 2 END, %(stripe)s, 1
+            FROM vote v, battle b
+            ON CONFLICT (battle_id, side, stripe) DO UPDATE
+            SET votes = battle_tallies.votes + EXCLUDED.votes
+        ),
+        result AS (
+            SELECT
+                EXISTS (SELECT 1 FROM vote) AS accepted,
+                b.photo1_id,
+                b.photo2_id,
+                b.photo1_votes + (SELECT COUNT(*) FROM vote WHERE photo_id = b.photo1_id) AS photo1_votes,
+                b.photo2_votes + (SELECT COUNT(*) FROM vote WHERE photo_id = b.photo2_id) AS photo2_votes
+            FROM battle b
+        )
+        SELECT
+            r.*,
+            (SELECT pg_notify(%(channel)s::text, json_build_object(
+                'sender', %(sender)s::text,
+                'kind', 'vote',
+                'battle_id', %(battle_id)s::integer,
+                'user_id', %(user_id)s::bigint,
+                'photo1_votes', r.photo1_votes,
+                'photo2_votes', r.photo2_votes
+            )::text) FROM vote) AS notified
+        FROM result r
+    """,
+    'get_battle_scores': """
+        SELECT battle_id, round_id, photo1_id, photo2_id, photo1_votes, photo2_votes, message_id
+        FROM battle_scores WHERE battle_id = %s
+    """,
+    'get_round_scores': """
+        SELECT battle_id, photo1_id, photo2_id, photo1_votes, photo2_votes, message_id
+        FROM battle_scores WHERE round_id = %s
+    """,
+    # Доп. голоса: списываем с баланса и пишем в журнал одной записью
+    # с весом, только если фото сейчас в активном батле
+    'spend_extra_votes': """
+        WITH battle AS (
+            SELECT id, round_id, CASE WHEN photo1_id = %(photo_id)s THEN 1 ELSE 2 END AS side
+            FROM battles
+            WHERE (photo1_id = %(photo_id)s OR photo2_id = %(photo_id)s) AND status = 'active'
+            ORDER BY created_at DESC
+            LIMIT 1
+        ),
+        spent AS (
+            UPDATE users SET extra_votes = extra_votes - %(votes)s
+            WHERE telegram_id = %(user_id)s
+              AND extra_votes >= %(votes)s
+              AND EXISTS (SELECT 1 FROM battle)
+            RETURNING telegram_id
+        ),
+        ledger AS (
+            INSERT INTO votes (round_id, user_id, battle_id, photo_id, weight, kind)
+            SELECT b.round_id, %(user_id)s, b.id, %(photo_id)s, %(votes)s, 'extra'
+            FROM battle b, spent
+        ),
+        tally AS (
+            INSERT INTO battle_tallies (battle_id, side, stripe, votes)
+            SELECT b.id, b.side, %(stripe)s, %(votes)s
+            FROM battle b, spent
+            ON CONFLICT (battle_id, side, stripe) DO UPDATE
+            SET votes = battle_tallies.votes + EXCLUDED.votes
+        )
+        SELECT
+            b.id,
+            b.side,
+            pg_notify(%(channel)s::text, json_build_object(
+                'sender', %(sender)s::text,
+                'kind', 'extra',
+                'battle_id', b.id,
+                'side', b.side,
+                'weight', %(votes)s::integer,
+                'user_id', %(user_id)s::bigint
+            )::text)
+        FROM battle b, spent
+    """,
+    'get_user_stats': """
+        SELECT 
+            u.extra_votes,
+            COALESCE(s.active_referrals, 0) AS active_referrals,
+            COALESCE(s.played, 0) AS played,
+            COALESCE(s.wins, 0) AS wins
+        FROM users u
+        LEFT JOIN user_stats s ON s.telegram_id = u.telegram_id
+        WHERE u.telegram_id = %s
+    """,
+    # Регистрация/обновление пользователя с блокировкой его строки до конца
+    # транзакции, заодно активный раунд
+    'lock_submitter': """
+        WITH u AS (
+            INSERT INTO users (telegram_id, username)
+            VALUES (%s, %s)
+            ON CONFLICT (telegram_id) DO UPDATE
+            SET username = EXCLUDED.username, blocked_at = NULL
+            RETURNING referrer_id
+        )
+        SELECT u.referrer_id, r.id AS round_id, r.number AS round_number
+        FROM u
+        LEFT JOIN (
+            SELECT id, number FROM rounds
+            WHERE status = 'active'
+            ORDER BY id DESC
+            LIMIT 1
+        ) r ON TRUE
+    """,
+    # Проверка повтора, вставка фото и бонус рефереру за первое фото.
+    # round_id = NULL означает очередь
+    'submit_photo': """
+        WITH existing AS (
+            SELECT
+                COUNT(*) AS photos,
+                COUNT(*) FILTER (
+                    WHERE (%(round_id)s::integer IS NULL AND is_queue)
+                       OR round_id = %(round_id)s::integer
+                ) AS in_target
+            FROM photos
+            WHERE user_id = %(user_id)s AND status != 'rejected'
+        ),
+        photo AS (
+            INSERT INTO photos (user_id, file_id, round_id, status, is_queue)
+            SELECT %(user_id)s, %(file_id)s, %(round_id)s::integer, 'pending',
+                   %(round_id)s::integer IS NULL
+            FROM existing
+            WHERE NOT %(check_duplicate)s OR in_target = 0
+            RETURNING id
+        ),
+        referral AS (
+            UPDATE users
+            SET extra_votes = extra_votes + %(referral_votes)s
+            WHERE telegram_id = %(referrer_id)s::bigint
+              AND %(credit_referral)s
+              AND EXISTS (SELECT 1 FROM photo)
+              AND (SELECT photos FROM existing) = 0
+            RETURNING telegram_id
+        ),
+        -- Первое неотклоненное фото делает пользователя активным рефералом
+        activated AS (
+            INSERT INTO user_stats (telegram_id, active_referrals)
+            SELECT telegram_id, 1 FROM users
+            WHERE telegram_id = %(referrer_id)s::bigint
+              AND EXISTS (SELECT 1 FROM photo)
+              AND (SELECT photos FROM existing) = 0
+            ON CONFLICT (telegram_id) DO UPDATE
+            SET active_referrals = user_stats.active_referrals + 1, updated_at = NOW()
+        )
+        SELECT (SELECT id FROM photo) AS photo_id
+    """,
+}
+
+
+# Параметры для проверки планов (Database.check_plans): EXPLAIN без
+# ANALYZE ничего не выполняет, поэтому подходят и несуществующие ID
+PLAN_SAMPLES = {
+    'get_admin_ids': None,
+    'get_setting': ('prize',),
+    'get_user': (1,),
+    'count_user_photos': (1,),
+    'get_current_round': None,
+    'get_round_by_id': (1,),
+    'user_has_photo_in_queue': (1,),
+    'user_has_photo_in_round': (1, 1),
+    'get_photo_by_id': (1,),
+    'get_approved_photos': (1, None),
+    'get_unpaired_photos': {'round_id': 1},
+    'get_user_photo_in_round': (1, 1),
+    'get_battle_by_id': (1,),
+    'get_battle_by_photo': (1, 1),
+    'user_voted_in_battle': (1, 1),
+    'cast_vote': {
+        'user_id': 1, 'battle_id': 1, 'photo_id': 1, 'stripe': 0,
+        'channel': 'plan_check', 'sender': 'plan_check'
+    },
+    'get_battle_scores': (1,),
+    'get_round_scores': (1,),
+    'spend_extra_votes': {
+        'user_id': 1, 'photo_id': 1, 'votes': 1, 'stripe': 0,
+        'channel': 'plan_check', 'sender': 'plan_check'
+    },
+    'get_user_stats': (1,),
+    'lock_submitter': (1, 'plan_check'),
+    'submit_photo': {
+        'user_id': 1, 'file_id': 'plan_check', 'round_id': 1, 'check_duplicate': True,
+        'referrer_id': None, 'credit_referral': True, 'referral_votes': 3
+    },
+}
+
+
+def plan_nodes(plan: dict):
+    """Все узлы плана из EXPLAIN (FORMAT JSON)"""
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from plan_nodes(child)
+
+
+# Таблицы, для которых ведутся счетчики строк (bot_counters)
+COUNTED_TABLES = ('users', 'photos', 'battles', 'votes', 'admins')
+
+# Журнал голосов, секционированный по раунду: горячая только секция
+# активного раунда, секции завершенных отсоединяются (Database.archive_round)
+VOTES_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS votes (
+        id SERIAL,
+        round_id INTEGER NOT NULL REFERENCES rounds(id),
+        user_id BIGINT NOT NULL REFERENCES users(telegram_id),
+        battle_id INTEGER NOT NULL REFERENCES battles(id),
+        photo_id INTEGER REFERENCES photos(id),
+        weight INTEGER NOT NULL DEFAULT 1,
+        kind VARCHAR(20) NOT NULL DEFAULT 'regular',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (round_id, id)
+    ) PARTITION BY LIST (round_id)
+"""
+
+
+def votes_partition(round_id: int) -> str:
+    """Имя секции votes для раунда"""
+    return f"votes_r{round_id}"
+
+
+# Пересчет полос battle_tallies из журнала votes (вся история или
+# выбранные батлы через battle_filter)
+REBUILD_TALLIES_SQL = """
+    INSERT INTO battle_tallies (battle_id, side, stripe, votes)
+    SELECT
+        v.battle_id,
+        CASE WHEN v.photo_id = b.photo1_id THEN 1 ELSE 2 END,
+        v.user_id %% %(stripes)s,
+        SUM(v.weight)
+    FROM votes v
+    JOIN battles b ON b.id = v.battle_id
+    {battle_filter}
+    GROUP BY 1, 2, 3
+"""
+
+
+def battle_tiebreak(round_id: int, photo_id: int) -> str:
+    """Жребий при ничьей: тот же md5, что в SQL fetch_battle_results"""
+    return hashlib.md5(f"{round_id}:{photo_id}".encode()).hexdigest()
+
+
+class SubmitOutcome(Enum):
+    """Результат отправки фото пользователем"""
+    QUEUED = 'queued'                      # Раунда нет, фото в очереди
+    QUEUED_NEXT_BATTLE = 'queued_next'     # Идет не первый раунд, фото ждет следующий батл
+    SUBMITTED = 'submitted'                # Фото в текущем первом раунде
+    ALREADY_IN_QUEUE = 'already_in_queue'
+    ALREADY_IN_ROUND = 'already_in_round'
 
 
 class Database:
-    def __init__(self):
-        try:
-            self.conn = psycopg2.connect(
+    def __init__(self, conninfo: str = None, replica_conninfo: str = None):
+        # Пул открывается в connect() внутри event loop бота.
+        # conninfo и replica_conninfo - другие БД вместо настроек из config (тесты)
+        self.pool = AsyncConnectionPool(
+            conninfo or make_conninfo(
                 host=config.DB_HOST,
-                database=config.DB_NAME,
+                dbname=config.DB_NAME,
                 user=config.DB_USER,
                 password=config.DB_PASSWORD,
                 port=config.DB_PORT
+            ),
+            min_size=config.DB_POOL_MIN_SIZE,
+            max_size=config.DB_POOL_MAX_SIZE,
+            kwargs={'autocommit': True},
+            # Проверка соединения при выдаче из пула: оборванные соединения
+            # выбрасываются и пул переподключается сам
+            check=AsyncConnectionPool.check_connection,
+            reconnect_timeout=config.DB_RECONNECT_TIMEOUT,
+            open=False
+        )
+        # Реплика для чтений, которым не нужны только что записанные данные.
+        # replica_ok ведет check_replica: пока реплика отстает или недоступна,
+        # эти чтения идут в основную БД
+        self.replica = None
+        replica_conninfo = replica_conninfo or config.DB_REPLICA_DSN
+        if replica_conninfo:
+            self.replica = AsyncConnectionPool(
+                replica_conninfo,
+                min_size=1,
+                max_size=config.DB_POOL_MAX_SIZE,
+                kwargs={'autocommit': True},
+                check=AsyncConnectionPool.check_connection,
+                reconnect_timeout=config.DB_RECONNECT_TIMEOUT,
+                open=False
             )
-            self.conn.autocommit = True
-            self.create_tables()
-            self.init_admins()
+        self.replica_ok = False
+        # Метка процесса: свои уведомления слушатель пропускает
+        self.instance_id = uuid.uuid4().hex
+        self.stats = StatsSnapshot()
+        self.state = StateCache()
+        self.profiles = ProfileCache(config.PROFILE_CACHE_SIZE)
+        self.tallies = TallyCache()
+        self.voters = VoterIndex()
+    
+    async def connect(self):
+        """Открыть пул соединений и подготовить схему"""
+        try:
+            await self.pool.open(wait=True, timeout=config.DB_CONNECT_TIMEOUT)
+            await self.create_tables()
+            await self.init_admins()
         except Exception as e:
             print(f"❌ Ошибка подключения к БД: {e}")
             raise
+        
+        if self.replica:
+            # Недоступная реплика не мешает запуску: чтения пойдут в основную БД
+            await self.replica.open(wait=False)
+            await self.check_replica()
+    
+    async def close(self):
+        """Закрыть пулы соединений"""
+        if self.replica:
+            await self.replica.close()
+        await self.pool.close()
+    
+    @asynccontextmanager
+    async def cursor(self, row_factory=tuple_row):
+        """Курсор на соединении из пула основной БД"""
+        async with self.pool.connection() as conn:
+            async with conn.cursor(row_factory=row_factory) as cur:
+                yield cur
+    
+    async def read(self, fetch, row_factory=tuple_row, replica: bool = True):
+        """
+        Чтение, которому допустимо отставание: await fetch(cur) выполняется
+        на реплике, если она сейчас в норме. Если реплика не отвечает,
+        чтение с нее выключается до следующей удачной check_replica,
+        а fetch повторяется в основной БД
+        """
+        if replica and self.replica_ok:
+            try:
+                async with self.replica.connection(timeout=config.DB_REPLICA_TIMEOUT_SECONDS) as conn:
+                    async with conn.cursor(row_factory=row_factory) as cur:
+                        result = await fetch(cur)
+                metrics.inc('replica.reads')
+                return result
+            except (psycopg.OperationalError, PoolTimeout) as e:
+                self.disable_replica(e)
+                metrics.inc('replica.fallbacks')
+        
+        async with self.cursor(row_factory) as cur:
+            return await fetch(cur)
+    
+    def disable_replica(self, error: Exception):
+        """Перевести чтения в основную БД до следующей удачной check_replica"""
+        if self.replica_ok:
+            print(f"❌ Реплика недоступна, чтения идут в основную БД: {error}")
+        self.replica_ok = False
+        metrics.inc('replica.errors')
+        metrics.set_gauge('replica.ok', 0)
+    
+    async def check_replica(self):
+        """
+        Проверить отставание реплики и решить, читать ли с нее.
+        Отставание 0, если реплика уже применила WAL до текущей позиции
+        основной БД, иначе - секунды с последней примененной транзакции.
+        Возвращает отставание или None, если реплика недоступна
+        """
+        try:
+            async with self.cursor() as cur:
+                await cur.execute("SELECT pg_current_wal_lsn()::text")
+                primary_lsn = (await cur.fetchone())[0]
+            async with self.replica.connection(timeout=config.DB_REPLICA_TIMEOUT_SECONDS) as conn:
+                cur = await conn.execute("""
+                    SELECT 
+                        pg_is_in_recovery(),
+                        COALESCE(pg_last_wal_replay_lsn() >= %s::pg_lsn, FALSE),
+                        EXTRACT(EPOCH FROM NOW() - pg_last_xact_replay_timestamp())
+                """, (primary_lsn,))
+                in_recovery, caught_up, replay_age = await cur.fetchone()
+        except Exception as e:
+            self.disable_replica(e)
+            return None
+        
+        if not in_recovery:
+            # Не реплика (например, после promote) - данные могли разойтись
+            lag = None
+        elif caught_up:
+            lag = 0.0
+        else:
+            lag = float(replay_age) if replay_age is not None else float('inf')
+        
+        replica_ok = lag is not None and lag <= config.DB_REPLICA_MAX_LAG_SECONDS
+        if replica_ok != self.replica_ok:
+            print(f"{'✅' if replica_ok else '⚠️'} Чтение с реплики {'включено' if replica_ok else 'выключено'}, отставание: {lag}")
+        self.replica_ok = replica_ok
+        metrics.set_gauge('replica.lag_seconds', lag)
+        metrics.set_gauge('replica.ok', int(replica_ok))
+        return lag
+    
+    async def watch_replica(self):
+        """Периодическая проверка отставания реплики"""
+        while True:
+            await asyncio.sleep(config.DB_REPLICA_CHECK_SECONDS)
+            await self.check_replica()
     
-    def create_tables(self):
+    async def run(self, cur, name: str, params=None):
+        """Выполнить запрос из STATEMENTS как подготовленный"""
+        metrics.inc(f"sql.{name}")
+        await cur.execute(STATEMENTS[name], params, prepare=True)
+    
+    async def create_tables(self):
         """Создание всех таблиц БД"""
-        with self.conn.cursor() as cur:
+        async with self.cursor() as cur:
             # Таблица пользователей
-            cur.execute("""
+            await cur.execute("""
                 CREATE TABLE IF NOT EXISTS users (
                     id SERIAL PRIMARY KEY,
                     telegram_id BIGINT UNIQUE NOT NULL,
@@ -36,8 +507,12 @@ class Database:
                 )
             """)
             
+            # Когда рассылка получила Forbidden (бот заблокирован); сбрасывается,
+            # когда пользователь снова пишет боту
+            await cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS blocked_at TIMESTAMP")
+            
             # Таблица админов
-            cur.execute("""
+            await cur.execute("""
                 CREATE TABLE IF NOT EXISTS admins (
                     id SERIAL PRIMARY KEY,
                     telegram_id BIGINT UNIQUE NOT NULL,
@@ -45,8 +520,17 @@ class Database:
                 )
             """)
             
+            # Настройки бота (приз и т.п.), переживают перезапуск
+            await cur.execute("""
+                CREATE TABLE IF NOT EXISTS settings (
+                    key VARCHAR(50) PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            
             # Таблица раундов
-            cur.execute("""
+            await cur.execute("""
                 CREATE TABLE IF NOT EXISTS rounds (
                     id SERIAL PRIMARY KEY,
                     number INTEGER NOT NULL,
@@ -56,9 +540,17 @@ class Database:
                     ended_at TIMESTAMP
                 )
             """)
+            # Объявленное время окончания раунда, чтобы пережить перезапуск
+            await cur.execute("ALTER TABLE rounds ADD COLUMN IF NOT EXISTS ends_at TIMESTAMPTZ")
+            # Архив: когда раунд заархивирован и сколько строк журнала ушло
+            await cur.execute("""
+                ALTER TABLE rounds
+                ADD COLUMN IF NOT EXISTS archived_at TIMESTAMPTZ,
+                ADD COLUMN IF NOT EXISTS archived_votes BIGINT NOT NULL DEFAULT 0
+            """)
             
             # Таблица фотографий
-            cur.execute("""
+            await cur.execute("""
                 CREATE TABLE IF NOT EXISTS photos (
                     id SERIAL PRIMARY KEY,
                     user_id BIGINT NOT NULL,
@@ -73,7 +565,7 @@ class Database:
             
             # Миграция: добавляем колонку is_queue если её нет
             try:
-                cur.execute("""
+                await cur.execute("""
                     ALTER TABLE photos 
                     ADD COLUMN IF NOT EXISTS is_queue BOOLEAN DEFAULT FALSE
                 """)
@@ -81,7 +573,7 @@ class Database:
                 print(f"⚠️ Колонка is_queue уже существует или ошибка: {e}")
             
             # Таблица батлов
-            cur.execute("""
+            await cur.execute("""
                 CREATE TABLE IF NOT EXISTS battles (
                     id SERIAL PRIMARY KEY,
                     round_id INTEGER REFERENCES rounds(id),
@@ -94,20 +586,10 @@ class Database:
             """)
             
             # Таблица голосов
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS votes (
-                    id SERIAL PRIMARY KEY,
-                    user_id BIGINT NOT NULL,
-                    battle_id INTEGER REFERENCES battles(id),
-                    photo_id INTEGER REFERENCES photos(id),
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users(telegram_id),
-                    UNIQUE(user_id, battle_id)
-                )
-            """)
+            await cur.execute(VOTES_TABLE_SQL)
             
             # Таблица для хранения ID сообщений батлов
-            cur.execute("""
+            await cur.execute("""
                 CREATE TABLE IF NOT EXISTS battle_messages (
                     id SERIAL PRIMARY KEY,
                     battle_id INTEGER REFERENCES battles(id),
@@ -116,524 +598,1856 @@ class Database:
                 )
             """)
             
-            # Индексы для оптимизации
-            cur.execute("CREATE INDEX IF NOT EXISTS idx_photos_round ON photos(round_id)")
-            cur.execute("CREATE INDEX IF NOT EXISTS idx_photos_user ON photos(user_id)")
-            cur.execute("CREATE INDEX IF NOT EXISTS idx_battles_round ON battles(round_id)")
-            cur.execute("CREATE INDEX IF NOT EXISTS idx_votes_battle ON votes(battle_id)")
-            cur.execute("CREATE INDEX IF NOT EXISTS idx_votes_user ON votes(user_id)")
-            cur.execute("CREATE INDEX IF NOT EXISTS idx_battle_messages ON battle_messages(battle_id)")
+            # Миграция: votes - единый журнал голосов с весом. Обычный голос
+            # весит 1 и уникален на (user_id, battle_id), доп. голоса - записи
+            # kind = 'extra' с весом, равным числу потраченных голосов
+            await cur.execute("""
+                SELECT 1 FROM information_schema.columns
+                WHERE table_name = 'votes' AND column_name = 'weight'
+            """)
+            if not await cur.fetchone():
+                await cur.execute("""
+                    ALTER TABLE votes
+                    ADD COLUMN weight INTEGER NOT NULL DEFAULT 1,
+                    ADD COLUMN kind VARCHAR(20) NOT NULL DEFAULT 'regular'
+                """)
+                await cur.execute("ALTER TABLE votes DROP CONSTRAINT IF EXISTS votes_user_id_battle_id_key")
+                # Доп. голоса раньше попадали только в photos.votes:
+                # переносим разницу в журнал на последний батл фото
+                await cur.execute("""
+                    INSERT INTO votes (user_id, battle_id, photo_id, weight, kind)
+                    SELECT p.user_id, b.id, p.id, p.votes - COALESCE(v.regular, 0), 'extra'
+                    FROM photos p
+                    JOIN LATERAL (
+                        SELECT id FROM battles
+                        WHERE photo1_id = p.id OR photo2_id = p.id
+                        ORDER BY created_at DESC
+                        LIMIT 1
+                    ) b ON TRUE
+                    LEFT JOIN (
+                        SELECT photo_id, COUNT(*) AS regular FROM votes GROUP BY photo_id
+                    ) v ON v.photo_id = p.id
+                    WHERE p.votes > COALESCE(v.regular, 0)
+                """)
             
-            # Создаем индекс для is_queue после добавления колонки
-            try:
-                cur.execute("CREATE INDEX IF NOT EXISTS idx_photos_queue ON photos(is_queue)")
-            except Exception as e:
-                print(f"⚠️ Индекс idx_photos_queue уже существует или ошибка: {e}")
+            await cur.execute(sql.SQL("CREATE SCHEMA IF NOT EXISTS {}").format(
+                sql.Identifier(config.VOTES_ARCHIVE_SCHEMA)
+            ))
+            
+            # Миграция: обычная таблица votes -> секционированная по раунду.
+            # votes_legacy без обычной votes остается от прерванного переноса
+            # прежней версии - перенос дописывается
+            await cur.execute("""
+                SELECT 
+                    (SELECT relkind FROM pg_class WHERE oid = to_regclass('votes')),
+                    to_regclass('votes_legacy') IS NOT NULL
+            """)
+            votes_kind, legacy_left = await cur.fetchone()
+            if votes_kind == 'r' or legacy_left:
+                await self.migrate_votes_table(cur.connection)
+            
+            await cur.execute("SELECT id FROM rounds WHERE archived_at IS NULL")
+            for (round_id,) in await cur.fetchall():
+                await self.create_votes_partition(cur, round_id)
+            
+            await cur.execute("""
+                CREATE UNIQUE INDEX IF NOT EXISTS idx_votes_regular_unique
+                ON votes(user_id, battle_id, round_id) WHERE kind = 'regular'
+            """)
+            
+            # Счетчики голосов по сторонам батла, разбитые на полосы (stripe):
+            # параллельные голоса обновляют разные строки и не ждут друг друга
+            await cur.execute("""
+                SELECT 1 FROM information_schema.tables
+                WHERE table_name = 'battle_tallies'
+            """)
+            tallies_created = not await cur.fetchone()
+            await cur.execute("""
+                CREATE TABLE IF NOT EXISTS battle_tallies (
+                    battle_id INTEGER NOT NULL REFERENCES battles(id) ON DELETE CASCADE,
+                    side SMALLINT NOT NULL,
+                    stripe SMALLINT NOT NULL,
+                    votes INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (battle_id, side, stripe)
+                )
+            """)
+            if tallies_created:
+                await cur.execute(
+                    REBUILD_TALLIES_SQL.format(battle_filter=''),
+                    {'stripes': config.TALLY_STRIPES}
+                )
+            # Старые счетчики в battles больше не нужны
+            await cur.execute("""
+                ALTER TABLE battles
+                DROP COLUMN IF EXISTS photo1_votes,
+                DROP COLUMN IF EXISTS photo2_votes
+            """)
+            
+            # Итоги заархивированных раундов: счет батлов и результат каждого
+            # фото. Их полосы счетчиков и журнал голосов уже не в горячих таблицах
+            await cur.execute("""
+                CREATE TABLE IF NOT EXISTS battle_history (
+                    battle_id INTEGER PRIMARY KEY REFERENCES battles(id),
+                    round_id INTEGER NOT NULL REFERENCES rounds(id),
+                    photo1_votes INTEGER NOT NULL,
+                    photo2_votes INTEGER NOT NULL
+                )
+            """)
+            await cur.execute("""
+                CREATE TABLE IF NOT EXISTS photo_history (
+                    round_id INTEGER NOT NULL REFERENCES rounds(id),
+                    photo_id INTEGER NOT NULL REFERENCES photos(id),
+                    user_id BIGINT NOT NULL,
+                    battle_id INTEGER NOT NULL REFERENCES battles(id),
+                    votes INTEGER NOT NULL,
+                    is_winner BOOLEAN NOT NULL,
+                    PRIMARY KEY (round_id, photo_id)
+                )
+            """)
+            await cur.execute("CREATE INDEX IF NOT EXISTS idx_battle_history_round ON battle_history(round_id)")
+            await cur.execute("CREATE INDEX IF NOT EXISTS idx_photo_history_user ON photo_history(user_id)")
+            
+            # Голоса батла одной строкой: сумма полос по каждой стороне,
+            # для заархивированного батла - счет из battle_history
+            await cur.execute("""
+                CREATE OR REPLACE VIEW battle_scores AS
+                SELECT 
+                    b.id AS battle_id,
+                    b.round_id,
+                    b.status,
+                    b.photo1_id,
+                    b.photo2_id,
+                    COALESCE(h.photo1_votes, SUM(t.votes) FILTER (WHERE t.side = 1), 0) AS photo1_votes,
+                    COALESCE(h.photo2_votes, SUM(t.votes) FILTER (WHERE t.side = 2), 0) AS photo2_votes,
+                    b.message_id
+                FROM battles b
+                LEFT JOIN battle_tallies t ON t.battle_id = b.id
+                LEFT JOIN battle_history h ON h.battle_id = b.id
+                GROUP BY b.id, b.round_id, b.status, b.photo1_id, b.photo2_id, b.message_id, h.battle_id
+            """)
+            
+            # Индексы под запросы из STATEMENTS (проверка - /plans)
+            # Фото раунда по статусу в порядке отправки: get_approved_photos,
+            # get_unpaired_photos, count_photos_by_status
+            await cur.execute("""
+                CREATE INDEX IF NOT EXISTS idx_photos_round_status
+                ON photos(round_id, status, created_at)
+            """)
+            # Фото пользователя (в раунде, последнее): count_user_photos,
+            # user_has_photo_in_round, get_user_photo_in_round
+            await cur.execute("""
+                CREATE INDEX IF NOT EXISTS idx_photos_user_round
+                ON photos(user_id, round_id, created_at)
+            """)
+            # Очередь мала, поэтому частичный индекс только по ней:
+            # user_has_photo_in_queue, move_queue_to_round
+            await cur.execute("""
+                CREATE INDEX IF NOT EXISTS idx_photos_queue_user
+                ON photos(user_id, status) WHERE is_queue
+            """)
+            await cur.execute("CREATE INDEX IF NOT EXISTS idx_battles_round ON battles(round_id)")
+            # get_battle_by_photo и spend_extra_votes: OR по двум колонкам
+            # превращается в BitmapOr двух индексов
+            await cur.execute("CREATE INDEX IF NOT EXISTS idx_battles_photo1 ON battles(photo1_id, created_at)")
+            await cur.execute("CREATE INDEX IF NOT EXISTS idx_battles_photo2 ON battles(photo2_id, created_at)")
+            # Журнал по батлу и стороне с весом - для index-only сверки
+            # счетчиков (check_tallies, REBUILD_TALLIES_SQL)
+            await cur.execute("""
+                CREATE INDEX IF NOT EXISTS idx_votes_battle_photo
+                ON votes(battle_id, photo_id, weight)
+            """)
+            await cur.execute("CREATE INDEX IF NOT EXISTS idx_votes_user ON votes(user_id)")
+            await cur.execute("CREATE INDEX IF NOT EXISTS idx_battle_messages ON battle_messages(battle_id)")
+            await cur.execute("CREATE INDEX IF NOT EXISTS idx_rounds_active ON rounds(id) WHERE status = 'active'")
+            
+            # Индексы, которые покрываются составными выше
+            for index in ('idx_photos_round', 'idx_photos_user', 'idx_photos_queue', 'idx_votes_battle'):
+                await cur.execute(sql.SQL("DROP INDEX IF EXISTS {}").format(sql.Identifier(index)))
+            
+            # Накопленная статистика пользователя для профиля
+            await cur.execute("SELECT to_regclass('user_stats') IS NOT NULL")
+            stats_exist = (await cur.fetchone())[0]
+            await cur.execute("""
+                CREATE TABLE IF NOT EXISTS user_stats (
+                    telegram_id BIGINT PRIMARY KEY REFERENCES users(telegram_id),
+                    wins INTEGER NOT NULL DEFAULT 0,
+                    played INTEGER NOT NULL DEFAULT 0,
+                    active_referrals INTEGER NOT NULL DEFAULT 0,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            
+            # Счетчики строк для /stats. Триггеры уровня оператора пишут в полосу
+            # своего соединения, поэтому параллельные голоса не ждут друг друга
+            await cur.execute("SELECT to_regclass('bot_counters') IS NOT NULL")
+            counters_exist = (await cur.fetchone())[0]
+            await cur.execute("""
+                CREATE TABLE IF NOT EXISTS bot_counters (
+                    name VARCHAR(50) NOT NULL,
+                    stripe SMALLINT NOT NULL,
+                    value BIGINT NOT NULL DEFAULT 0,
+                    PRIMARY KEY (name, stripe)
+                )
+            """)
+            
+            # После переноса votes у новой таблицы еще нет триггеров
+            await cur.execute("""
+                SELECT 1 FROM pg_trigger
+                WHERE tgrelid = 'votes'::regclass AND tgname = 'votes_count_insert'
+            """)
+            votes_counted = bool(await cur.fetchone())
+            
+            if not counters_exist or not votes_counted:
+                await cur.execute("""
+                    CREATE OR REPLACE FUNCTION bump_bot_counter() RETURNS trigger AS $$
+                    DECLARE
+                        delta BIGINT;
+                    BEGIN
+                        IF TG_OP = 'INSERT' THEN
+                            SELECT COUNT(*) INTO delta FROM new_rows;
+                        ELSE
+                            SELECT -COUNT(*) INTO delta FROM old_rows;
+                        END IF;
+                        
+                        IF delta != 0 THEN
+                            INSERT INTO bot_counters (name, stripe, value)
+                            VALUES (TG_TABLE_NAME, pg_backend_pid() % 16, delta)
+                            ON CONFLICT (name, stripe) DO UPDATE
+                            SET value = bot_counters.value + EXCLUDED.value;
+                        END IF;
+                        RETURN NULL;
+                    END
+                    $$ LANGUAGE plpgsql
+                """)
+                
+                # После переноса votes триггеры нужны только новой таблице,
+                # счетчик голосов уже верный
+                for table in ('votes',) if counters_exist else COUNTED_TABLES:
+                    await cur.execute(f"""
+                        CREATE TRIGGER {table}_count_insert
+                        AFTER INSERT ON {table}
+                        REFERENCING NEW TABLE AS new_rows
+                        FOR EACH STATEMENT EXECUTE FUNCTION bump_bot_counter()
+                    """)
+                    await cur.execute(f"""
+                        CREATE TRIGGER {table}_count_delete
+                        AFTER DELETE ON {table}
+                        REFERENCING OLD TABLE AS old_rows
+                        FOR EACH STATEMENT EXECUTE FUNCTION bump_bot_counter()
+                    """)
+                    if not counters_exist:
+                        # Начальное значение - точный подсчет
+                        await cur.execute(f"""
+                            INSERT INTO bot_counters (name, stripe, value)
+                            SELECT '{table}', 0, COUNT(*) FROM {table}
+                        """)
+            
+            # Пул одобренных фото раунда, которым еще не нашлась пара
+            await cur.execute("SELECT to_regclass('pairing_pool') IS NOT NULL")
+            pool_exists = (await cur.fetchone())[0]
+            await cur.execute("""
+                CREATE TABLE IF NOT EXISTS pairing_pool (
+                    photo_id INTEGER PRIMARY KEY REFERENCES photos(id),
+                    round_id INTEGER NOT NULL REFERENCES rounds(id),
+                    added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            await cur.execute("CREATE INDEX IF NOT EXISTS idx_pairing_pool_round ON pairing_pool(round_id, added_at)")
+            
+            if not pool_exists:
+                # Миграция: фото без пары в активном раунде переносим в пул
+                await cur.execute("""
+                    INSERT INTO pairing_pool (photo_id, round_id, added_at)
+                    SELECT p.id, p.round_id, p.created_at
+                    FROM photos p
+                    JOIN rounds r ON r.id = p.round_id AND r.status = 'active'
+                    WHERE p.status = 'approved'
+                      AND NOT EXISTS (
+                          SELECT 1 FROM battles b
+                          WHERE b.photo1_id = p.id OR b.photo2_id = p.id
+                      )
+                """)
+            
+            # Очередь личных сообщений: пачка - одна рассылка со своей статистикой
+            await cur.execute("""
+                CREATE TABLE IF NOT EXISTS notification_batches (
+                    id SERIAL PRIMARY KEY,
+                    kind VARCHAR(50) NOT NULL,
+                    round_id INTEGER REFERENCES rounds(id),
+                    total INTEGER NOT NULL DEFAULT 0,
+                    sent INTEGER NOT NULL DEFAULT 0,
+                    failed INTEGER NOT NULL DEFAULT 0,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    finished_at TIMESTAMP
+                )
+            """)
+            await cur.execute("""
+                CREATE TABLE IF NOT EXISTS notification_jobs (
+                    id BIGSERIAL PRIMARY KEY,
+                    batch_id INTEGER NOT NULL REFERENCES notification_batches(id) ON DELETE CASCADE,
+                    chat_id BIGINT NOT NULL,
+                    text TEXT NOT NULL,
+                    reply_markup JSONB,
+                    status VARCHAR(20) NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    locked_until TIMESTAMP,
+                    error TEXT
+                )
+            """)
+            await cur.execute("""
+                CREATE INDEX IF NOT EXISTS idx_notification_jobs_pending
+                ON notification_jobs(id) WHERE status = 'pending'
+            """)
+            
+            # Рассылки всем пользователям. last_user_id - контрольная точка:
+            # все получатели до него включительно уже обработаны
+            await cur.execute("""
+                CREATE TABLE IF NOT EXISTS broadcasts (
+                    id SERIAL PRIMARY KEY,
+                    text TEXT NOT NULL,
+                    created_by BIGINT,
+                    status VARCHAR(20) NOT NULL DEFAULT 'running',
+                    last_user_id BIGINT NOT NULL DEFAULT 0,
+                    sent INTEGER NOT NULL DEFAULT 0,
+                    failed INTEGER NOT NULL DEFAULT 0,
+                    blocked INTEGER NOT NULL DEFAULT 0,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    finished_at TIMESTAMP
+                )
+            """)
+        
+        if not stats_exist:
+            # Миграция: первый раз считаем статистику по всей истории
+            await self.rebuild_user_stats()
     
-    def init_admins(self):
+    async def init_admins(self):
         """Инициализация начальных админов из config"""
-        with self.conn.cursor() as cur:
+        async with self.cursor() as cur:
             for admin_id in config.ADMIN_IDS:
-                cur.execute("""
+                await cur.execute("""
                     INSERT INTO admins (telegram_id)
                     VALUES (%s)
                     ON CONFLICT (telegram_id) DO NOTHING
                 """, (admin_id,))
+            await self.notify(cur, 'admins')
+        self.state.invalidate_admins()
     
-    def is_admin(self, telegram_id: int) -> bool:
+    async def get_admin_ids(self) -> set:
+        """Множество telegram_id админов (по кэшу)"""
+        admins = self.state.admins
+        if admins is None:
+            version = self.state.version
+            async with self.cursor() as cur:
+                await self.run(cur, 'get_admin_ids')
+                admins = {row[0] for row in await cur.fetchall()}
+            if version == self.state.version:
+                self.state.admins = admins
+        return admins
+    
+    async def is_admin(self, telegram_id: int) -> bool:
         """Проверить, является ли пользователь админом"""
-        with self.conn.cursor() as cur:
-            cur.execute("SELECT COUNT(*) FROM admins WHERE telegram_id = %s", (telegram_id,))
-            return cur.fetchone()[0] > 0
+        return telegram_id in await self.get_admin_ids()
     
-    def add_admin(self, telegram_id: int):
+    async def add_admin(self, telegram_id: int):
         """Добавить админа"""
-        with self.conn.cursor() as cur:
-            cur.execute("""
+        async with self.cursor() as cur:
+            await cur.execute("""
                 INSERT INTO admins (telegram_id)
                 VALUES (%s)
                 ON CONFLICT (telegram_id) DO NOTHING
             """, (telegram_id,))
+            await self.notify(cur, 'admins')
+        self.state.invalidate_admins()
     
-    def remove_admin(self, telegram_id: int):
+    async def remove_admin(self, telegram_id: int):
         """Удалить админа"""
-        with self.conn.cursor() as cur:
-            cur.execute("DELETE FROM admins WHERE telegram_id = %s", (telegram_id,))
+        async with self.cursor() as cur:
+            await cur.execute("DELETE FROM admins WHERE telegram_id = %s", (telegram_id,))
+            await self.notify(cur, 'admins')
+        self.state.invalidate_admins()
+    
+    async def get_prize(self) -> str:
+        """Текущий приз (из кэша, иначе из settings)"""
+        prize = self.state.prize
+        if prize is None:
+            version = self.state.version
+            async with self.cursor() as cur:
+                await self.run(cur, 'get_setting', ('prize',))
+                row = await cur.fetchone()
+            prize = row[0] if row else config.DEFAULT_PRIZE
+            if version == self.state.version:
+                self.state.prize = prize
+        return prize
     
-    def get_all_admins(self):
+    async def set_prize(self, prize: str):
+        """Сохранить приз"""
+        async with self.cursor() as cur:
+            await cur.execute("""
+                INSERT INTO settings (key, value)
+                VALUES ('prize', %s)
+                ON CONFLICT (key) DO UPDATE
+                SET value = EXCLUDED.value, updated_at = NOW()
+            """, (prize,))
+            await self.notify(cur, 'prize')
+        self.state.invalidate_prize()
+    
+    async def get_all_admins(self):
         """Получить список всех админов"""
-        with self.conn.cursor() as cur:
-            cur.execute("SELECT telegram_id FROM admins")
-            return [row[0] for row in cur.fetchall()]
+        return list(await self.get_admin_ids())
     
-    def add_user(self, telegram_id: int, username: str = None, referrer_id: int = None):
+    async def add_user(self, telegram_id: int, username: str = None, referrer_id: int = None):
         """Добавление нового пользователя"""
-        with self.conn.cursor() as cur:
+        async with self.cursor() as cur:
             try:
-                cur.execute("""
+                await cur.execute("""
                     INSERT INTO users (telegram_id, username, referrer_id)
                     VALUES (%s, %s, %s)
                     ON CONFLICT (telegram_id) DO UPDATE
-                    SET username = EXCLUDED.username
+                    SET username = EXCLUDED.username, blocked_at = NULL
                     RETURNING (xmax = 0) AS inserted
                 """, (telegram_id, username, referrer_id))
-                result = cur.fetchone()
+                result = await cur.fetchone()
                 return result[0] if result else False
             except Exception as e:
                 print(f"Ошибка добавления пользователя: {e}")
                 return False
     
-    def get_user(self, telegram_id: int):
+    async def get_user(self, telegram_id: int):
         """Получить пользователя по telegram_id"""
-        with self.conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute("SELECT * FROM users WHERE telegram_id = %s", (telegram_id,))
-            return cur.fetchone()
+        async with self.cursor(dict_row) as cur:
+            await self.run(cur, 'get_user', (telegram_id,))
+            return await cur.fetchone()
     
-    def get_all_users(self):
+    async def get_all_users(self):
         """Получить всех пользователей"""
-        with self.conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute("SELECT * FROM users")
-            return cur.fetchall()
+        async with self.cursor(dict_row) as cur:
+            await cur.execute("SELECT * FROM users")
+            return await cur.fetchall()
     
-    def add_referral_votes(self, referrer_id: int, votes: int):
+    async def add_referral_votes(self, referrer_id: int, votes: int):
         """Добавить дополнительные голоса рефереру"""
-        with self.conn.cursor() as cur:
-            cur.execute("""
+        async with self.cursor() as cur:
+            await cur.execute("""
                 UPDATE users 
                 SET extra_votes = extra_votes + %s
                 WHERE telegram_id = %s
             """, (votes, referrer_id))
+        self.profiles.invalidate(referrer_id)
     
-    def count_user_photos(self, user_id: int) -> int:
+    async def count_user_photos(self, user_id: int) -> int:
         """Подсчитать количество фото пользователя"""
-        with self.conn.cursor() as cur:
-            cur.execute("""
-                SELECT COUNT(*) FROM photos
-                WHERE user_id = %s AND status != 'rejected'
-            """, (user_id,))
-            return cur.fetchone()[0]
-    
-    def create_round(self, round_number: int = 1):
+        async with self.cursor() as cur:
+            await self.run(cur, 'count_user_photos', (user_id,))
+            return (await cur.fetchone())[0]
+    
+    async def create_round(self, round_number: int = 1):
         """Создать новый раунд"""
-        with self.conn.cursor() as cur:
-            # Завершаем предыдущий раунд
-            cur.execute("UPDATE rounds SET status = 'ended', ended_at = NOW() WHERE status = 'active'")
+        async with self.cursor() as cur:
+            # Завершаем предыдущий раунд, его фото без пары уже не сыграют
+            await cur.execute("UPDATE rounds SET status = 'ended', ended_at = NOW() WHERE status = 'active'")
+            await cur.execute("DELETE FROM pairing_pool")
             
             # Создаем новый раунд
-            cur.execute("""
+            await cur.execute("""
                 INSERT INTO rounds (number, status, min_votes)
                 VALUES (%s, 'active', %s)
                 RETURNING id
             """, (round_number, config.MIN_VOTES))
             
-            return cur.fetchone()[0]
+            round_id = (await cur.fetchone())[0]
+            await self.create_votes_partition(cur, round_id)
+            await self.notify(cur, 'round', round_id=round_id, active=True)
+        
+        self.on_round_changed(round_id, active=True)
+        return round_id
     
-    def get_current_round(self):
-        """Получить текущий активный раунд"""
-        with self.conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute("SELECT * FROM rounds WHERE status = 'active' ORDER BY id DESC LIMIT 1")
-            return cur.fetchone()
+    async def get_current_round(self):
+        """Получить текущий активный раунд (по кэшу)"""
+        if self.state.round_loaded:
+            return self.state.round
+        
+        version = self.state.version
+        async with self.cursor(dict_row) as cur:
+            await self.run(cur, 'get_current_round')
+            current_round = await cur.fetchone()
+        if version == self.state.version:
+            self.state.round = current_round
+            self.state.round_loaded = True
+        return current_round
     
-    def end_round(self, round_id: int):
+    async def end_round(self, round_id: int):
         """Завершить раунд"""
-        with self.conn.cursor() as cur:
-            cur.execute("""
+        async with self.cursor() as cur:
+            await cur.execute("""
                 UPDATE rounds 
                 SET status = 'ended', ended_at = NOW()
                 WHERE id = %s
             """, (round_id,))
+            await cur.execute("DELETE FROM pairing_pool WHERE round_id = %s", (round_id,))
+            await self.notify(cur, 'round', round_id=round_id, active=False)
+        
+        self.on_round_changed(round_id, active=False)
     
-    def update_round_status(self, round_id: int, status: str):
+    async def migrate_votes_table(self, conn):
+        """
+        Перенос голосов из обычной таблицы votes в секционированную одной
+        транзакцией: сбой посередине откатывает все, и при следующем запуске
+        перенос начинается заново. Голоса, которым нет секции (батл без
+        раунда или раунд уже в архиве), не теряются: votes_legacy с ними
+        уходит в схему архива под именем votes_unmigrated
+        """
+        async with conn.transaction(), conn.cursor() as cur:
+            await cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('votes')")
+            row = await cur.fetchone()
+            if row and row[0] == 'r':
+                await cur.execute("ALTER TABLE votes RENAME TO votes_legacy")
+            await cur.execute(VOTES_TABLE_SQL)
+            
+            await cur.execute("""
+                SELECT DISTINCT b.round_id
+                FROM votes_legacy v
+                JOIN battles b ON b.id = v.battle_id
+                JOIN rounds r ON r.id = b.round_id
+                WHERE r.archived_at IS NULL
+            """)
+            for (round_id,) in await cur.fetchall():
+                await self.create_votes_partition(cur, round_id)
+            
+            # Уже перенесенные голоса (дописывание после сбоя) пропускаются
+            await cur.execute("""
+                INSERT INTO votes (id, round_id, user_id, battle_id, photo_id, weight, kind, created_at)
+                SELECT v.id, b.round_id, v.user_id, v.battle_id, v.photo_id, v.weight, v.kind, v.created_at
+                FROM votes_legacy v
+                JOIN battles b ON b.id = v.battle_id
+                JOIN rounds r ON r.id = b.round_id
+                WHERE r.archived_at IS NULL
+                  AND NOT EXISTS (
+                      SELECT 1 FROM votes n WHERE n.round_id = b.round_id AND n.id = v.id
+                  )
+            """)
+            await cur.execute("""
+                SELECT COUNT(*)
+                FROM votes_legacy v
+                LEFT JOIN battles b ON b.id = v.battle_id
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM votes n WHERE n.round_id = b.round_id AND n.id = v.id
+                )
+            """)
+            lost = (await cur.fetchone())[0]
+            await cur.execute("""
+                SELECT setval(
+                    pg_get_serial_sequence('votes', 'id'),
+                    GREATEST(
+                        (SELECT COALESCE(MAX(id), 0) FROM votes),
+                        (SELECT COALESCE(MAX(id), 0) FROM votes_legacy)
+                    ) + 1,
+                    FALSE
+                )
+            """)
+            
+            if not lost:
+                await cur.execute("DROP TABLE votes_legacy")
+                return
+            
+            await cur.execute("ALTER TABLE votes_legacy RENAME TO votes_unmigrated")
+            await cur.execute(sql.SQL("ALTER TABLE votes_unmigrated SET SCHEMA {}").format(
+                sql.Identifier(config.VOTES_ARCHIVE_SCHEMA)
+            ))
+        print(
+            f"⚠️ {lost} голосов не перенесены в секционированную votes (нет раунда): "
+            f"исходная таблица сохранена как {config.VOTES_ARCHIVE_SCHEMA}.votes_unmigrated"
+        )
+    
+    async def create_votes_partition(self, cur, round_id: int):
+        """Секция журнала голосов для раунда"""
+        await cur.execute(sql.SQL("CREATE TABLE IF NOT EXISTS {} PARTITION OF votes FOR VALUES IN ({})").format(
+            sql.Identifier(votes_partition(round_id)), sql.Literal(round_id)
+        ))
+    
+    async def archive_round(self, round_id: int) -> bool:
+        """
+        Перенести завершенный раунд в архив: итоги батлов и фото - в
+        battle_history и photo_history, секцию журнала голосов - отсоединить
+        в схему VOTES_ARCHIVE_SCHEMA, полосы счетчиков удалить. ID сообщений
+        батлов остаются, пока их удаление из канала не подтверждено
+        (delete_battle_messages). battle_scores дальше отдает счет из battle_history.
+        Возвращает False, если раунд активен или уже в архиве
+        """
+        partition = votes_partition(round_id)
+        async with self.pool.connection() as conn:
+            async with conn.transaction(), conn.cursor() as cur:
+                await cur.execute(
+                    "SELECT status, archived_at FROM rounds WHERE id = %s FOR UPDATE",
+                    (round_id,)
+                )
+                row = await cur.fetchone()
+                if not row or row[0] == 'active' or row[1]:
+                    return False
+                
+                await cur.execute("""
+                    INSERT INTO battle_history (battle_id, round_id, photo1_votes, photo2_votes)
+                    SELECT battle_id, round_id, photo1_votes, photo2_votes
+                    FROM battle_scores WHERE round_id = %s
+                    ON CONFLICT (battle_id) DO NOTHING
+                """, (round_id,))
+                # Ничья - тем же жребием, что в fetch_battle_results
+                await cur.execute("""
+                    INSERT INTO photo_history (round_id, photo_id, user_id, battle_id, votes, is_winner)
+                    SELECT 
+                        h.round_id, s.photo_id, p.user_id, h.battle_id, s.votes,
+                        s.votes > s.rival_votes OR (
+                            s.votes = s.rival_votes
+                            AND md5(h.round_id || ':' || s.photo_id) < md5(h.round_id || ':' || s.rival_id)
+                        )
+                    FROM battle_history h
+                    JOIN battles b ON b.id = h.battle_id
+                    CROSS JOIN LATERAL (VALUES
+                        (b.photo1_id, h.photo1_votes, b.photo2_id, h.photo2_votes),
+                        (b.photo2_id, h.photo2_votes, b.photo1_id, h.photo1_votes)
+                    ) AS s(photo_id, votes, rival_id, rival_votes)
+                    JOIN photos p ON p.id = s.photo_id
+                    WHERE h.round_id = %s
+                    ON CONFLICT (round_id, photo_id) DO NOTHING
+                """, (round_id,))
+                await cur.execute("""
+                    DELETE FROM battle_tallies
+                    WHERE battle_id IN (SELECT id FROM battles WHERE round_id = %s)
+                """, (round_id,))
+                
+                archived_votes = 0
+                await cur.execute("SELECT to_regclass(%s) IS NOT NULL", (partition,))
+                if (await cur.fetchone())[0]:
+                    await cur.execute(sql.SQL("SELECT COUNT(*) FROM {}").format(sql.Identifier(partition)))
+                    archived_votes = (await cur.fetchone())[0]
+                    await cur.execute(sql.SQL("ALTER TABLE votes DETACH PARTITION {}").format(
+                        sql.Identifier(partition)
+                    ))
+                    await cur.execute(sql.SQL("ALTER TABLE {} SET SCHEMA {}").format(
+                        sql.Identifier(partition), sql.Identifier(config.VOTES_ARCHIVE_SCHEMA)
+                    ))
+                
+                await cur.execute("""
+                    UPDATE rounds SET archived_at = NOW(), archived_votes = %s
+                    WHERE id = %s
+                """, (archived_votes, round_id))
+        
+        metrics.inc('rounds.archived')
+        return True
+    
+    async def archive_ended_rounds(self):
+        """Заархивировать все завершенные раунды. Возвращает их ID"""
+        async with self.cursor() as cur:
+            await cur.execute("""
+                SELECT id FROM rounds
+                WHERE status != 'active' AND archived_at IS NULL
+                ORDER BY id
+            """)
+            round_ids = [row[0] for row in await cur.fetchall()]
+        
+        return [round_id for round_id in round_ids if await self.archive_round(round_id)]
+    
+    async def set_round_deadline(self, round_id: int, ends_at):
+        """
+        Запомнить время окончания раунда, если оно еще не задано.
+        Возвращает действующее время окончания
+        """
+        async with self.cursor() as cur:
+            await cur.execute("""
+                UPDATE rounds
+                SET ends_at = COALESCE(ends_at, %s)
+                WHERE id = %s
+                RETURNING ends_at
+            """, (ends_at, round_id))
+            row = await cur.fetchone()
+            await self.notify(cur, 'round', round_id=round_id, active=None)
+        
+        self.on_round_changed(round_id, active=None)
+        return row[0] if row else ends_at
+    
+    async def update_round_status(self, round_id: int, status: str):
         """Обновить статус раунда"""
-        with self.conn.cursor() as cur:
-            cur.execute("""
+        async with self.cursor() as cur:
+            await cur.execute("""
                 UPDATE rounds 
                 SET status = %s
                 WHERE id = %s
             """, (status, round_id))
+            await self.notify(cur, 'round', round_id=round_id, active=status == 'active')
+        
+        self.on_round_changed(round_id, active=status == 'active')
     
-    def add_photo(self, user_id: int, file_id: str, round_id: int):
+    async def add_photo(self, user_id: int, file_id: str, round_id: int):
         """Добавить фото на модерацию"""
-        with self.conn.cursor() as cur:
-            cur.execute("""
+        async with self.cursor() as cur:
+            await cur.execute("""
                 INSERT INTO photos (user_id, file_id, round_id, status, is_queue)
                 VALUES (%s, %s, %s, 'pending', FALSE)
                 RETURNING id
             """, (user_id, file_id, round_id))
-            return cur.fetchone()[0]
+            return (await cur.fetchone())[0]
     
-    def add_photo_to_queue(self, user_id: int, file_id: str):
+    async def add_photo_to_queue(self, user_id: int, file_id: str):
         """Добавить фото в очередь (без раунда)"""
-        with self.conn.cursor() as cur:
-            cur.execute("""
+        async with self.cursor() as cur:
+            await cur.execute("""
                 INSERT INTO photos (user_id, file_id, status, is_queue)
                 VALUES (%s, %s, 'pending', TRUE)
                 RETURNING id
             """, (user_id, file_id))
-            return cur.fetchone()[0]
+            return (await cur.fetchone())[0]
+    
+    async def submit_photo(self, user_id: int, username: str, file_id: str):
+        """
+        Принять фото от пользователя одной транзакцией: раунд, проверка
+        повтора, вставка и бонус рефереру. Строка пользователя блокируется,
+        поэтому параллельные отправки одного человека идут по очереди.
+        Возвращает (SubmitOutcome, photo_id)
+        """
+        async with self.pool.connection() as conn:
+            async with conn.pipeline(), conn.transaction(), conn.cursor() as cur:
+                await self.run(cur, 'lock_submitter', (user_id, username))
+                referrer_id, round_id, round_number = await cur.fetchone()
+                
+                if round_id and round_number > 1:
+                    # Не первый раунд - фото ждет следующий батл, без проверок и бонуса
+                    outcome = SubmitOutcome.QUEUED_NEXT_BATTLE
+                    round_id = None
+                    check_duplicate = False
+                    credit_referral = False
+                elif round_id:
+                    outcome = SubmitOutcome.SUBMITTED
+                    check_duplicate = True
+                    credit_referral = True
+                else:
+                    outcome = SubmitOutcome.QUEUED
+                    check_duplicate = True
+                    credit_referral = True
+                
+                await self.run(cur, 'submit_photo', {
+                    'user_id': user_id,
+                    'file_id': file_id,
+                    'round_id': round_id,
+                    'check_duplicate': check_duplicate,
+                    'referrer_id': referrer_id,
+                    'credit_referral': credit_referral,
+                    'referral_votes': config.VOTES_PER_REFERRAL
+                })
+                photo_id = (await cur.fetchone())[0]
+        
+        if photo_id and referrer_id:
+            self.profiles.invalidate(referrer_id)
+        if photo_id is None:
+            if outcome == SubmitOutcome.SUBMITTED:
+                return SubmitOutcome.ALREADY_IN_ROUND, None
+            return SubmitOutcome.ALREADY_IN_QUEUE, None
+        return outcome, photo_id
     
-    def user_has_photo_in_queue(self, user_id: int):
+    async def user_has_photo_in_queue(self, user_id: int):
         """Проверить, есть ли у пользователя фото в очереди"""
-        with self.conn.cursor() as cur:
-            cur.execute("""
-                SELECT COUNT(*) FROM photos
-                WHERE user_id = %s AND is_queue = TRUE AND status != 'rejected'
-            """, (user_id,))
-            return cur.fetchone()[0] > 0
-    
-    def move_queue_to_round(self, round_id: int):
+        async with self.cursor() as cur:
+            await self.run(cur, 'user_has_photo_in_queue', (user_id,))
+            return (await cur.fetchone())[0] > 0
+    
+    async def move_queue_to_round(self, round_id: int):
         """Перенести фото из очереди в раунд"""
-        with self.conn.cursor() as cur:
-            cur.execute("""
-                UPDATE photos
-                SET round_id = %s, is_queue = FALSE
-                WHERE is_queue = TRUE AND status = 'approved'
+        async with self.cursor() as cur:
+            await cur.execute("""
+                WITH moved AS (
+                    UPDATE photos
+                    SET round_id = %s, is_queue = FALSE
+                    WHERE is_queue = TRUE AND status = 'approved'
+                    RETURNING id, round_id, created_at
+                )
+                INSERT INTO pairing_pool (photo_id, round_id, added_at)
+                SELECT id, round_id, created_at FROM moved
+                ON CONFLICT (photo_id) DO NOTHING
             """, (round_id,))
+        self.profiles.clear()
     
-    def get_photo_by_id(self, photo_id: int):
+    async def get_photo_by_id(self, photo_id: int):
         """Получить фото по ID"""
-        with self.conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute("SELECT * FROM photos WHERE id = %s", (photo_id,))
-            return cur.fetchone()
-    
-    def update_photo_status(self, photo_id: int, status: str):
-        """Обновить статус фото (approved/rejected)"""
-        with self.conn.cursor() as cur:
-            cur.execute("""
-                UPDATE photos SET status = %s WHERE id = %s
-            """, (status, photo_id))
-    
-    def user_has_photo_in_round(self, user_id: int, round_id: int):
+        async with self.cursor(dict_row) as cur:
+            await self.run(cur, 'get_photo_by_id', (photo_id,))
+            return await cur.fetchone()
+    
+    async def update_photo_status(self, photo_id: int, status: str):
+        """
+        Обновить статус фото (approved/rejected).
+        Только что одобренное фото раунда попадает в пул для пар,
+        отклоненное - убирается из пула
+        """
+        async with self.cursor() as cur:
+            await cur.execute("""
+                WITH photo AS (
+                    UPDATE photos p SET status = %(status)s
+                    FROM photos old
+                    WHERE p.id = %(photo_id)s AND old.id = p.id
+                      AND p.status IS DISTINCT FROM %(status)s
+                    RETURNING p.id, p.user_id, p.round_id, p.is_queue, old.status AS old_status
+                ),
+                -- Реферал активен, пока у него есть неотклоненное фото
+                referral AS (
+                    UPDATE user_stats s
+                    SET active_referrals = GREATEST(
+                            s.active_referrals + CASE WHEN %(status)s = 'rejected' THEN -1 ELSE 1 END, 0
+                        ),
+                        updated_at = NOW()
+                    FROM photo ph
+                    JOIN users u ON u.telegram_id = ph.user_id
+                    WHERE s.telegram_id = u.referrer_id
+                      AND (ph.old_status = 'rejected') != (%(status)s = 'rejected')
+                      AND NOT EXISTS (
+                          SELECT 1 FROM photos o
+                          WHERE o.user_id = ph.user_id AND o.id != ph.id AND o.status != 'rejected'
+                      )
+                ),
+                pooled AS (
+                    INSERT INTO pairing_pool (photo_id, round_id)
+                    SELECT id, round_id FROM photo
+                    WHERE %(status)s = 'approved' AND round_id IS NOT NULL AND NOT is_queue
+                    ON CONFLICT (photo_id) DO NOTHING
+                ),
+                unpooled AS (
+                    DELETE FROM pairing_pool
+                    WHERE %(status)s != 'approved' AND photo_id IN (SELECT id FROM photo)
+                )
+                SELECT ph.user_id, u.referrer_id
+                FROM photo ph
+                JOIN users u ON u.telegram_id = ph.user_id
+            """, {'status': status, 'photo_id': photo_id})
+            row = await cur.fetchone()
+        
+        if row:
+            # Статус фото виден в профиле автора, активность реферала - у реферера
+            self.profiles.invalidate(*[user_id for user_id in row if user_id])
+    
+    async def user_has_photo_in_round(self, user_id: int, round_id: int):
         """Проверить, отправлял ли пользователь фото в этом раунде"""
-        with self.conn.cursor() as cur:
-            cur.execute("""
-                SELECT COUNT(*) FROM photos
-                WHERE user_id = %s AND round_id = %s AND status != 'rejected'
-            """, (user_id, round_id))
-            return cur.fetchone()[0] > 0
-    
-    def count_photos_by_status(self, status: str, round_id: int = None):
+        async with self.cursor() as cur:
+            await self.run(cur, 'user_has_photo_in_round', (user_id, round_id))
+            return (await cur.fetchone())[0] > 0
+    
+    async def count_photos_by_status(self, status: str, round_id: int = None, replica: bool = True):
         """Подсчет фото по статусу"""
-        with self.conn.cursor() as cur:
+        async def fetch(cur):
             if round_id:
-                cur.execute("""
+                await cur.execute("""
                     SELECT COUNT(*) FROM photos
                     WHERE status = %s AND round_id = %s
                 """, (status, round_id))
             else:
-                cur.execute("SELECT COUNT(*) FROM photos WHERE status = %s", (status,))
-            return cur.fetchone()[0]
+                await cur.execute("SELECT COUNT(*) FROM photos WHERE status = %s", (status,))
+            return (await cur.fetchone())[0]
+        
+        return await self.read(fetch, replica=replica)
     
-    def count_approved_photos(self, round_id: int):
+    async def count_approved_photos(self, round_id: int):
         """Подсчет одобренных фото в раунде"""
-        return self.count_photos_by_status('approved', round_id)
+        return await self.count_photos_by_status('approved', round_id, replica=False)
     
-    def get_approved_photos(self, round_id: int, limit: int = None):
+    async def get_approved_photos(self, round_id: int, limit: int = None):
         """Получить одобренные фото"""
-        with self.conn.cursor(cursor_factory=RealDictCursor) as cur:
-            query = """
-                SELECT * FROM photos
-                WHERE round_id = %s AND status = 'approved'
-                ORDER BY created_at
-            """
-            if limit:
-                query += f" LIMIT {limit}"
-            
-            cur.execute(query, (round_id,))
-            return cur.fetchall()
-    
-    def get_unpaired_photos(self, round_id: int):
+        async with self.cursor(dict_row) as cur:
+            await self.run(cur, 'get_approved_photos', (round_id, limit or None))
+            return await cur.fetchall()
+    
+    async def get_unpaired_photos(self, round_id: int):
         """Получить одобренные фото которые еще не в батлах"""
-        with self.conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute("""
-                SELECT p.* FROM photos p
-                WHERE p.round_id = %s 
-                  AND p.status = 'approved'
-                  AND p.id NOT IN (
-                      SELECT photo1_id FROM battles WHERE round_id = %s
-                      UNION
-                      SELECT photo2_id FROM battles WHERE round_id = %s
-                  )
-                ORDER BY p.created_at
-            """, (round_id, round_id, round_id))
-            return cur.fetchall()
+        async with self.cursor(dict_row) as cur:
+            await self.run(cur, 'get_unpaired_photos', {'round_id': round_id})
+            return await cur.fetchall()
     
-    def count_battles_in_round(self, round_id: int):
+    async def count_battles_in_round(self, round_id: int):
         """Подсчитать количество батлов в раунде"""
-        with self.conn.cursor() as cur:
-            cur.execute("""
+        async def fetch(cur):
+            await cur.execute("""
                 SELECT COUNT(*) FROM battles WHERE round_id = %s
             """, (round_id,))
-            return cur.fetchone()[0]
+            return (await cur.fetchone())[0]
+        
+        return await self.read(fetch)
     
-    def get_round_battles(self, round_id: int):
+    async def get_round_battles(self, round_id: int):
         """Получить все батлы раунда"""
-        with self.conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute("""
+        async with self.cursor(dict_row) as cur:
+            await cur.execute("""
                 SELECT * FROM battles
                 WHERE round_id = %s
                 ORDER BY id
             """, (round_id,))
-            return cur.fetchall()
+            return await cur.fetchall()
     
-    def get_battle_by_id(self, battle_id: int):
+    async def get_battle_by_id(self, battle_id: int):
         """Получить батл по ID"""
-        with self.conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute("""
-                SELECT * FROM battles WHERE id = %s
-            """, (battle_id,))
-            return cur.fetchone()
+        async with self.cursor(dict_row) as cur:
+            await self.run(cur, 'get_battle_by_id', (battle_id,))
+            return await cur.fetchone()
     
-    def create_battle(self, round_id: int, photo1_id: int, photo2_id: int):
+    async def create_battle(self, round_id: int, photo1_id: int, photo2_id: int):
         """Создать батл между двумя фото"""
-        with self.conn.cursor() as cur:
-            cur.execute("""
+        async with self.cursor() as cur:
+            await cur.execute("""
                 INSERT INTO battles (round_id, photo1_id, photo2_id, status)
                 VALUES (%s, %s, %s, 'active')
                 RETURNING id
             """, (round_id, photo1_id, photo2_id))
-            return cur.fetchone()[0]
+            battle_id = (await cur.fetchone())[0]
+        
+        self.track_battle(round_id, battle_id, photo1_id, photo2_id)
+        return battle_id
     
-    def update_battle_message_id(self, battle_id: int, message_id: int):
+    async def create_battles(self, round_id: int, pairs: list):
+        """
+        Создать все батлы раунда одним INSERT: либо вся сетка, либо ничего.
+        pairs - список (photo1_id, photo2_id), возвращает ID батлов в том же порядке
+        """
+        if not pairs:
+            return []
+        
+        async with self.pool.connection() as conn:
+            battle_ids = await self.insert_battles(conn, round_id, pairs)
+        
+        for battle_id, (photo1_id, photo2_id) in zip(battle_ids, pairs):
+            self.track_battle(round_id, battle_id, photo1_id, photo2_id)
+        return battle_ids
+    
+    async def insert_battles(self, conn, round_id: int, pairs: list):
+        """INSERT батлов на переданном соединении (внутри чужой транзакции)"""
+        async with conn.cursor() as cur:
+            await cur.execute("""
+                INSERT INTO battles (round_id, photo1_id, photo2_id, status)
+                SELECT %s, pair.photo1_id, pair.photo2_id, 'active'
+                FROM unnest(%s::integer[], %s::integer[]) AS pair(photo1_id, photo2_id)
+                RETURNING id, photo1_id
+            """, (round_id, [p[0] for p in pairs], [p[1] for p in pairs]))
+            battle_ids = {photo1_id: battle_id for battle_id, photo1_id in await cur.fetchall()}
+            return [battle_ids[photo1_id] for photo1_id, _ in pairs]
+    
+    async def create_battles_from_pool(self, round_id: int):
+        """
+        Забрать из пула фото без пары и создать для них батлы одной транзакцией.
+        Разбор пула раунда идет по одному (advisory-блокировка транзакции):
+        параллельные одобрения не могут поставить одно фото в два батла, а
+        последний разбор видит все одобренные фото, так что без пары остается
+        не больше одного. Возвращает список (battle_id, photo1, photo2)
+        """
+        async with self.pool.connection() as conn:
+            async with conn.transaction(), conn.cursor(row_factory=dict_row) as cur:
+                await cur.execute("SELECT pg_advisory_xact_lock(hashtext('pairing'), %s)", (round_id,))
+                await cur.execute("""
+                    SELECT p.*
+                    FROM pairing_pool pp
+                    JOIN photos p ON p.id = pp.photo_id
+                    WHERE pp.round_id = %s
+                    ORDER BY pp.added_at
+                """, (round_id,))
+                photos = await cur.fetchall()
+                
+                # Нечетное фото остается в пуле до следующего одобрения
+                photos = photos[:len(photos) // 2 * 2]
+                if not photos:
+                    return []
+                
+                random.shuffle(photos)
+                await cur.execute(
+                    "DELETE FROM pairing_pool WHERE photo_id = ANY(%s)",
+                    ([photo['id'] for photo in photos],)
+                )
+                
+                pairs = [(photos[i], photos[i + 1]) for i in range(0, len(photos), 2)]
+                battle_ids = await self.insert_battles(conn, round_id, [(p1['id'], p2['id']) for p1, p2 in pairs])
+        
+        for battle_id, (p1, p2) in zip(battle_ids, pairs):
+            self.track_battle(round_id, battle_id, p1['id'], p2['id'])
+        return [(battle_id, p1, p2) for battle_id, (p1, p2) in zip(battle_ids, pairs)]
+    
+    async def update_battle_message_id(self, battle_id: int, message_id: int):
         """Сохранить message_id батла"""
-        with self.conn.cursor() as cur:
-            cur.execute("""
+        async with self.cursor() as cur:
+            await cur.execute("""
                 UPDATE battles SET message_id = %s WHERE id = %s
             """, (message_id, battle_id))
     
-    def add_vote(self, user_id: int, battle_id: int, photo_id: int):
-        """Добавить голос"""
-        with self.conn.cursor() as cur:
+    async def cast_vote(self, user_id: int, battle_id: int, photo_id: int):
+        """
+        Проголосовать за один запрос.
+        Возвращает (accepted, photo1_id, photo2_id, votes1, votes2) или None,
+        если фото не из этого батла или голос записать нельзя
+        """
+        async with self.cursor() as cur:
             try:
-                # Добавляем голос
-                cur.execute("""
-                    INSERT INTO votes (user_id, battle_id, photo_id)
-                    VALUES (%s, %s, %s)
-                """, (user_id, battle_id, photo_id))
-                
-                # Увеличиваем счетчик голосов у фото
-                cur.execute("""
-                    UPDATE photos SET votes = votes + 1 WHERE id = %s
-                """, (photo_id,))
-                
-                return True
-            except psycopg2.IntegrityError:
-                # Пользователь уже голосовал в этом батле
-                return False
+                await self.run(cur, 'cast_vote', {
+                    'user_id': user_id,
+                    'battle_id': battle_id,
+                    'photo_id': photo_id,
+                    'stripe': user_id % config.TALLY_STRIPES,
+                    'channel': config.DB_NOTIFY_CHANNEL,
+                    'sender': self.instance_id
+                })
+                result = await cur.fetchone()
+            except psycopg.IntegrityError:
+                # Пользователя нет в users (не запускал бота)
+                return None
+        
+        if result:
+            # И принятый, и отклоненный как повтор голос значат, что
+            # пользователь в этом батле уже голосовал
+            self.voters.add(battle_id, user_id)
+            self.tallies.update(battle_id, result[3], result[4])
+            return result[:5]
+        return result
+    
+    async def add_vote(self, user_id: int, battle_id: int, photo_id: int):
+        """Добавить голос"""
+        result = await self.cast_vote(user_id, battle_id, photo_id)
+        return bool(result and result[0])
     
-    def user_voted_in_battle(self, user_id: int, battle_id: int):
+    async def user_voted_in_battle(self, user_id: int, battle_id: int):
         """Проверить, голосовал ли пользователь в этом батле"""
-        with self.conn.cursor() as cur:
-            cur.execute("""
-                SELECT COUNT(*) FROM votes
-                WHERE user_id = %s AND battle_id = %s
-            """, (user_id, battle_id))
-            return cur.fetchone()[0] > 0
-    
-    def get_battle_votes(self, battle_id: int):
+        voted = self.voters.has(battle_id, user_id)
+        if voted is not None:
+            return voted
+        
+        async with self.cursor() as cur:
+            await self.run(cur, 'user_voted_in_battle', (user_id, battle_id))
+            return (await cur.fetchone())[0] > 0
+    
+    async def get_battle_tally(self, battle_id: int):
+        """
+        Счет батла: {'photo1_id', 'photo2_id', 'photo1', 'photo2', 'message_id'}.
+        Батлы активного раунда отдаются из кэша без запроса
+        """
+        entry = self.tallies.get(battle_id)
+        if entry:
+            metrics.inc('tallies.hit')
+            return entry
+        
+        metrics.inc('tallies.miss')
+        async with self.cursor(dict_row) as cur:
+            await self.run(cur, 'get_battle_scores', (battle_id,))
+            row = await cur.fetchone()
+        if not row:
+            return None
+        
+        self.tallies.add(row['round_id'], battle_id, row['photo1_id'], row['photo2_id'])
+        self.tallies.update(battle_id, row['photo1_votes'], row['photo2_votes'])
+        self.tallies.set_message(battle_id, row['message_id'])
+        return self.tallies.get(battle_id) or TallyCache.entry(row)
+    
+    async def get_battle_votes(self, battle_id: int):
         """Получить количество голосов в батле"""
-        with self.conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute("""
+        tally = await self.get_battle_tally(battle_id)
+        if not tally:
+            return {'photo1': 0, 'photo2': 0}
+        
+        return {'photo1': tally['photo1'], 'photo2': tally['photo2']}
+    
+    async def fetch_round_scores(self, round_id: int):
+        """Счет всех батлов раунда из battle_scores"""
+        async with self.cursor(dict_row) as cur:
+            await self.run(cur, 'get_round_scores', (round_id,))
+            return await cur.fetchall()
+    
+    async def load_tallies(self, round_id: int):
+        """Загрузить счет батлов раунда в кэш"""
+        self.tallies.load(round_id, await self.fetch_round_scores(round_id))
+    
+    async def hydrate(self):
+        """
+        Прогрев кэшей после старта: активный раунд, админы, приз, счет и
+        message_id батлов и голосовавшие - пятью запросами в одном пайплайне
+        (один обмен с сервером). Возвращает активный раунд или None
+        """
+        active_round = "(SELECT id FROM rounds WHERE status = 'active' ORDER BY id DESC LIMIT 1)"
+        async with self.pool.connection() as conn:
+            round_cur = conn.cursor(row_factory=dict_row)
+            admins_cur = conn.cursor()
+            prize_cur = conn.cursor()
+            scores_cur = conn.cursor(row_factory=dict_row)
+            votes_cur = conn.cursor()
+            async with conn.pipeline():
+                await self.run(round_cur, 'get_current_round')
+                await self.run(admins_cur, 'get_admin_ids')
+                await self.run(prize_cur, 'get_setting', ('prize',))
+                await scores_cur.execute(f"""
+                    SELECT battle_id, photo1_id, photo2_id, photo1_votes, photo2_votes, message_id
+                    FROM battle_scores WHERE round_id = {active_round}
+                """)
+                await votes_cur.execute(f"""
+                    SELECT battle_id, user_id
+                    FROM votes
+                    WHERE round_id = {active_round} AND kind = 'regular'
+                """)
+            current_round = await round_cur.fetchone()
+            admins = {row[0] for row in await admins_cur.fetchall()}
+            prize = await prize_cur.fetchone()
+            scores = await scores_cur.fetchall()
+            votes = await votes_cur.fetchall()
+        
+        self.state.round = current_round
+        self.state.round_loaded = True
+        self.state.admins = admins
+        self.state.prize = prize[0] if prize else config.DEFAULT_PRIZE
+        if current_round:
+            self.tallies.load(current_round['id'], scores)
+            self.voters.load(current_round['id'], [row['battle_id'] for row in scores], votes)
+        metrics.set_gauge('voters.size', self.voters.size())
+        return current_round
+    
+    def track_battle(self, round_id: int, battle_id: int, photo1_id: int, photo2_id: int):
+        """Добавить новый батл в кэш счета и индекс голосовавших"""
+        self.tallies.add(round_id, battle_id, photo1_id, photo2_id)
+        self.voters.track(round_id, battle_id)
+    
+    def forget_round(self, round_id: int):
+        """Сбросить кэши раунда, когда он перестал быть активным"""
+        if self.tallies.round_id == round_id:
+            self.tallies.clear()
+        if self.voters.round_id == round_id:
+            self.voters.clear()
+    
+    def on_round_changed(self, round_id: int, active):
+        """
+        Сбросить кэши после изменения раунда. active=True - раунд начат,
+        False - завершен, None - изменилась только строка раунда
+        """
+        self.state.invalidate_round()
+        if active is None:
+            return
+        
+        self.profiles.clear()
+        if active:
+            if self.tallies.round_id != round_id:
+                self.tallies.load(round_id, [])
+            if self.voters.round_id != round_id:
+                self.voters.load(round_id, [], [])
+        else:
+            self.forget_round(round_id)
+    
+    async def notify(self, cur, kind: str, **data):
+        """Сообщить другим процессам об изменении общего состояния"""
+        payload = json.dumps({'sender': self.instance_id, 'kind': kind, **data})
+        await cur.execute("SELECT pg_notify(%s, %s)", (config.DB_NOTIFY_CHANNEL, payload))
+    
+    def apply_notification(self, payload: str):
+        """Применить к локальным кэшам изменение из другого процесса"""
+        event = json.loads(payload)
+        if event.get('sender') == self.instance_id:
+            return
+        
+        kind = event['kind']
+        metrics.inc(f"notify.{kind}")
+        if kind == 'round':
+            self.on_round_changed(event['round_id'], event['active'])
+        elif kind == 'admins':
+            self.state.invalidate_admins()
+        elif kind == 'prize':
+            self.state.invalidate_prize()
+        elif kind == 'vote':
+            self.voters.add(event['battle_id'], event['user_id'])
+            self.tallies.update(event['battle_id'], event['photo1_votes'], event['photo2_votes'])
+        elif kind == 'extra':
+            self.tallies.bump(event['battle_id'], event['side'], event['weight'])
+            self.profiles.invalidate(event['user_id'])
+    
+    async def listen(self, hydrated: asyncio.Future = None):
+        """
+        Слушать уведомления других процессов. LISTEN держит соединение,
+        поэтому оно отдельное, не из пула. Пока соединения нет, уведомления
+        теряются, поэтому кэши прогреваются после каждого LISTEN, в том числе
+        первого. hydrated получает результат первого прогрева (активный раунд)
+        """
+        listen_sql = sql.SQL("LISTEN {}").format(sql.Identifier(config.DB_NOTIFY_CHANNEL))
+        while True:
+            try:
+                conn = await psycopg.AsyncConnection.connect(self.pool.conninfo, autocommit=True)
+                async with conn:
+                    await conn.execute(listen_sql)
+                    current_round = await self.hydrate()
+                    if hydrated is not None and not hydrated.done():
+                        hydrated.set_result(current_round)
+                    async for notification in conn.notifies():
+                        try:
+                            self.apply_notification(notification.payload)
+                        except (ValueError, KeyError) as e:
+                            print(f"❌ Некорректное уведомление {notification.payload!r}: {e}")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"❌ Слушатель уведомлений отключился: {e}")
+            await asyncio.sleep(config.DB_NOTIFY_RECONNECT_SECONDS)
+    
+    async def reconcile_tallies(self):
+        """
+        Сверить кэш счета с БД и принять значения из БД (поэлементным
+        максимумом, см. TallyCache.reconcile). Расхождение пишется в метрики
+        tallies.drift (последний проход) и tallies.drift_total (накопленное)
+        """
+        round_id = self.tallies.round_id
+        if round_id is None:
+            return 0
+        
+        rows = await self.fetch_round_scores(round_id)
+        if self.tallies.round_id != round_id:
+            # Раунд сменился, пока шел запрос
+            return 0
+        
+        drift = self.tallies.reconcile(rows)
+        metrics.set_gauge('tallies.drift', drift)
+        metrics.inc('tallies.drift_total', drift)
+        metrics.set_gauge('voters.size', self.voters.size())
+        return drift
+    
+    async def get_battle_results(self, round_id: int):
+        """
+        Итоги всех батлов раунда: по строке на каждое фото с username,
+        голосами в батле и флагом is_winner. Для раунда в кэше голоса
+        берутся из кэша, из БД читаются только фото; ничья решается
+        тем же жребием, что и в fetch_battle_results
+        """
+        if self.tallies.round_id != round_id:
+            return await self.fetch_battle_results(round_id)
+        
+        async with self.cursor(dict_row) as cur:
+            await cur.execute("""
                 SELECT 
-                    b.photo1_id,
-                    b.photo2_id,
-                    COALESCE(SUM(CASE WHEN v.photo_id = b.photo1_id THEN 1 ELSE 0 END), 0) as photo1_votes,
-                    COALESCE(SUM(CASE WHEN v.photo_id = b.photo2_id THEN 1 ELSE 0 END), 0) as photo2_votes
+                    p.id, p.user_id, p.file_id, p.round_id, p.status, p.is_queue, p.created_at,
+                    u.username,
+                    b.id AS battle_id,
+                    s.side
                 FROM battles b
-                LEFT JOIN votes v ON v.battle_id = b.id
-                WHERE b.id = %s
-                GROUP BY b.id, b.photo1_id, b.photo2_id
-            """, (battle_id,))
-            
-            result = cur.fetchone()
-            if not result:
-                return {'photo1': 0, 'photo2': 0}
-            
-            return {
-                'photo1': result['photo1_votes'],
-                'photo2': result['photo2_votes']
-            }
+                CROSS JOIN (VALUES (1), (2)) AS s(side)
+                JOIN photos p ON p.id = CASE s.side WHEN 1 THEN b.photo1_id ELSE b.photo2_id END
+                LEFT JOIN users u ON u.telegram_id = p.user_id
+                WHERE b.round_id = %s
+            """, (round_id,))
+            photos = await cur.fetchall()
+        
+        if {photo['battle_id'] for photo in photos} - self.tallies.battles.keys():
+            await self.load_tallies(round_id)
+        
+        battles = {}
+        for photo in photos:
+            tally = self.tallies.get(photo['battle_id']) or {}
+            photo['votes'] = tally.get(f"photo{photo.pop('side')}", 0)
+            battles.setdefault(photo['battle_id'], []).append(photo)
+        
+        results = []
+        for battle_id in sorted(battles):
+            ranked = sorted(
+                battles[battle_id],
+                key=lambda photo: (-photo['votes'], battle_tiebreak(round_id, photo['id']))
+            )
+            for place, photo in enumerate(ranked):
+                photo['is_winner'] = place == 0
+                results.append(photo)
+        return results
+    
+    async def fetch_battle_results(self, round_id: int):
+        """
+        Итоги всех батлов раунда одним запросом по battle_scores.
+        Ничья решается жребием, который зависит только от раунда и фото,
+        поэтому повторный подсчет дает тот же результат
+        """
+        async with self.cursor(dict_row) as cur:
+            await cur.execute("""
+                WITH sides AS (
+                    SELECT b.battle_id, b.photo1_id AS photo_id, b.photo1_votes AS votes
+                    FROM battle_scores b
+                    WHERE b.round_id = %(round_id)s
+                    UNION ALL
+                    SELECT b.battle_id, b.photo2_id, b.photo2_votes
+                    FROM battle_scores b
+                    WHERE b.round_id = %(round_id)s
+                ),
+                ranked AS (
+                    SELECT 
+                        s.*,
+                        ROW_NUMBER() OVER (
+                            PARTITION BY s.battle_id
+                            ORDER BY s.votes DESC, md5(%(round_id)s::text || ':' || s.photo_id)
+                        ) AS place
+                    FROM sides s
+                )
+                SELECT 
+                    p.id, p.user_id, p.file_id, p.round_id, p.status, p.is_queue, p.created_at,
+                    u.username,
+                    r.battle_id,
+                    r.votes,
+                    r.place = 1 AS is_winner
+                FROM ranked r
+                JOIN photos p ON p.id = r.photo_id
+                LEFT JOIN users u ON u.telegram_id = p.user_id
+                ORDER BY r.battle_id, r.place
+            """, {'round_id': round_id})
+            return await cur.fetchall()
     
-    def get_round_winners(self, round_id: int, min_votes: int = 8):
+    async def get_round_winners(self, round_id: int, min_votes: int = 8):
         """Получить победителей раунда (фото с минимальным кол-вом голосов)"""
-        with self.conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute("""
-                SELECT p.*, u.username
-                FROM photos p
-                JOIN users u ON u.telegram_id = p.user_id
-                WHERE p.round_id = %s 
-                  AND p.status = 'approved'
-                  AND p.votes >= %s
-                ORDER BY p.votes DESC
-            """, (round_id, min_votes))
-            return cur.fetchall()
-    
-    def get_round_photos_with_votes(self, round_id: int):
-        """Получить все фото раунда с количеством голосов"""
-        with self.conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute("""
-                SELECT p.*, u.username
-                FROM photos p
-                JOIN users u ON u.telegram_id = p.user_id
-                WHERE p.round_id = %s 
-                  AND p.status = 'approved'
-                ORDER BY p.votes DESC
+        results = await self.get_battle_results(round_id)
+        winners = [photo for photo in results if photo['votes'] >= min_votes]
+        return sorted(winners, key=lambda photo: photo['votes'], reverse=True)
+    
+    async def get_round_photos_with_votes(self, round_id: int):
+        """
+        Все фото батлов раунда с количеством голосов. По ним выбирают
+        победителя, поэтому счет - из основной БД, а не из кэша: кэш
+        сверяется максимумом и не исправляет завышенный счет
+        """
+        results = await self.fetch_battle_results(round_id)
+        return sorted(results, key=lambda photo: photo['votes'], reverse=True)
+    
+    async def get_user_stats(self, telegram_id: int, replica: bool = True):
+        """
+        Статистика пользователя (поиск по первичному ключу). replica=False -
+        перед изменением баланса и для кэша профиля, где нужны свежие данные
+        """
+        async def fetch(cur):
+            await self.run(cur, 'get_user_stats', (telegram_id,))
+            return await cur.fetchone()
+        
+        stats = await self.read(fetch, dict_row, replica)
+        if not stats:
+            return {'active_referrals': 0, 'played': 0, 'wins': 0, 'extra_votes': 0}
+        return stats
+    
+    async def get_profile(self, user_id: int):
+        """
+        Данные профиля: статистика из get_user_stats и photo_approved -
+        одобрено ли фото пользователя в активном раунде. Из кэша, пока
+        ничего из этого не менялось
+        """
+        profile = self.profiles.get(user_id)
+        if profile is not None:
+            metrics.inc('profiles.hit')
+            return profile
+        
+        metrics.inc('profiles.miss')
+        version = self.profiles.version
+        profile = dict(await self.get_user_stats(user_id, replica=False))
+        
+        current_round = await self.get_current_round()
+        photo = None
+        if current_round:
+            photo = await self.get_user_photo_in_round(user_id, current_round['id'])
+        profile['photo_approved'] = bool(photo and photo['status'] == 'approved')
+        
+        if version == self.profiles.version:
+            self.profiles.put(user_id, profile)
+        return profile
+    
+    async def end_round_battles(self, round_id: int):
+        """
+        Завершить батлы раунда и добавить их в статистику участников.
+        Возвращает telegram_id участников, чья статистика изменилась
+        """
+        async with self.cursor() as cur:
+            await cur.execute("""
+                WITH ended AS (
+                    UPDATE battles SET status = 'ended'
+                    WHERE round_id = %s AND status != 'ended'
+                    RETURNING id
+                ),
+                scores AS (
+                    SELECT s.* FROM battle_scores s
+                    JOIN ended e ON e.id = s.battle_id
+                ),
+                sides AS (
+                    SELECT photo1_id AS photo_id, photo1_votes > photo2_votes AS won FROM scores
+                    UNION ALL
+                    SELECT photo2_id, photo2_votes > photo1_votes FROM scores
+                ),
+                per_user AS (
+                    SELECT p.user_id, COUNT(*) AS played, COUNT(*) FILTER (WHERE s.won) AS wins
+                    FROM sides s
+                    JOIN photos p ON p.id = s.photo_id
+                    GROUP BY p.user_id
+                )
+                INSERT INTO user_stats (telegram_id, played, wins)
+                SELECT user_id, played, wins FROM per_user
+                ON CONFLICT (telegram_id) DO UPDATE
+                SET played = user_stats.played + EXCLUDED.played,
+                    wins = user_stats.wins + EXCLUDED.wins,
+                    updated_at = NOW()
+                RETURNING telegram_id
             """, (round_id,))
-            return cur.fetchall()
-    
-    def get_user_stats(self, telegram_id: int):
-        """Статистика пользователя"""
-        with self.conn.cursor(cursor_factory=RealDictCursor) as cur:
-            # Получаем extra_votes из таблицы пользователей
-            cur.execute("""
-                SELECT extra_votes FROM users WHERE telegram_id = %s
-            """, (telegram_id,))
-            user = cur.fetchone()
-            extra_votes = user['extra_votes'] if user else 0
-            
-            # Количество активных рефералов
-            cur.execute("""
-                SELECT COUNT(DISTINCT u.telegram_id) as active_referrals
-                FROM users u
-                WHERE u.referrer_id = %s
-                  AND EXISTS (
-                      SELECT 1 FROM photos p 
-                      WHERE p.user_id = u.telegram_id 
-                        AND p.status != 'rejected'
-                  )
-            """, (telegram_id,))
-            active_referrals = cur.fetchone()['active_referrals']
-            
-            # Количество сыгранных батлов
-            cur.execute("""
-                SELECT COUNT(DISTINCT b.id) as played
-                FROM battles b
-                JOIN photos p ON (p.id = b.photo1_id OR p.id = b.photo2_id)
-                WHERE p.user_id = %s AND b.status = 'ended'
-            """, (telegram_id,))
-            played = cur.fetchone()['played']
-            
-            # Количество побед
-            cur.execute("""
-                SELECT COUNT(*) as wins
-                FROM (
+            user_ids = [row[0] for row in await cur.fetchall()]
+        
+        self.profiles.invalidate(*user_ids)
+        return user_ids
+    
+    async def rebuild_user_stats(self):
+        """Пересчитать user_stats с нуля по всей истории"""
+        async with self.pool.connection() as conn:
+            async with conn.transaction(), conn.cursor() as cur:
+                await cur.execute("DELETE FROM user_stats")
+                await cur.execute("""
+                    INSERT INTO user_stats (telegram_id, wins, played, active_referrals)
                     SELECT 
-                        b.id,
-                        p1.votes as votes1,
-                        p2.votes as votes2,
-                        p1.user_id as user1,
-                        p2.user_id as user2
-                    FROM battles b
-                    JOIN photos p1 ON p1.id = b.photo1_id
-                    JOIN photos p2 ON p2.id = b.photo2_id
-                    WHERE b.status = 'ended'
-                ) sub
-                WHERE (votes1 > votes2 AND user1 = %s) OR (votes2 > votes1 AND user2 = %s)
-            """, (telegram_id, telegram_id))
-            wins = cur.fetchone()['wins']
-            
-            return {
-                'active_referrals': active_referrals,
-                'played': played,
-                'wins': wins,
-                'extra_votes': extra_votes
-            }
-    
-    def get_round_by_id(self, round_id: int):
+                        u.telegram_id,
+                        COALESCE(g.wins, 0),
+                        COALESCE(g.played, 0),
+                        COALESCE(r.active_referrals, 0)
+                    FROM users u
+                    LEFT JOIN (
+                        SELECT 
+                            p.user_id,
+                            COUNT(DISTINCT s.battle_id) AS played,
+                            COUNT(DISTINCT s.battle_id) FILTER (WHERE s.won) AS wins
+                        FROM (
+                            SELECT battle_id, photo1_id AS photo_id, photo1_votes > photo2_votes AS won
+                            FROM battle_scores WHERE status = 'ended'
+                            UNION ALL
+                            SELECT battle_id, photo2_id, photo2_votes > photo1_votes
+                            FROM battle_scores WHERE status = 'ended'
+                        ) s
+                        JOIN photos p ON p.id = s.photo_id
+                        GROUP BY p.user_id
+                    ) g ON g.user_id = u.telegram_id
+                    LEFT JOIN (
+                        SELECT ref.referrer_id, COUNT(*) AS active_referrals
+                        FROM users ref
+                        WHERE ref.referrer_id IS NOT NULL
+                          AND EXISTS (
+                              SELECT 1 FROM photos p
+                              WHERE p.user_id = ref.telegram_id
+                                AND p.status != 'rejected'
+                          )
+                        GROUP BY ref.referrer_id
+                    ) r ON r.referrer_id = u.telegram_id
+                    WHERE g.user_id IS NOT NULL OR r.referrer_id IS NOT NULL
+                """)
+                rows = cur.rowcount
+        
+        self.profiles.clear()
+        return rows
+    
+    async def get_round_by_id(self, round_id: int):
         """Получить раунд по ID"""
-        with self.conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute("SELECT * FROM rounds WHERE id = %s", (round_id,))
-            return cur.fetchone()
-    
-    def save_battle_messages(self, battle_id: int, message_ids: list):
-        """Сохранить ID сообщений батла"""
-        with self.conn.cursor() as cur:
-            for msg_id in message_ids:
-                cur.execute("""
+        async with self.cursor(dict_row) as cur:
+            await self.run(cur, 'get_round_by_id', (round_id,))
+            return await cur.fetchone()
+    
+    async def save_battle_messages(self, published: list):
+        """
+        Сохранить ID сообщений опубликованных батлов одной транзакцией.
+        published - список (battle_id, message_id поста с кнопками, все message_id)
+        """
+        if not published:
+            return
+        
+        battle_ids = [battle_id for battle_id, _, message_ids in published for _ in message_ids]
+        message_ids = [msg_id for _, _, ids in published for msg_id in ids]
+        
+        async with self.pool.connection() as conn:
+            async with conn.pipeline(), conn.transaction(), conn.cursor() as cur:
+                await cur.execute("""
                     INSERT INTO battle_messages (battle_id, message_id)
-                    VALUES (%s, %s)
-                """, (battle_id, msg_id))
+                    SELECT * FROM unnest(%s::integer[], %s::bigint[])
+                """, (battle_ids, message_ids))
+                await cur.execute("""
+                    UPDATE battles b
+                    SET message_id = post.message_id
+                    FROM unnest(%s::integer[], %s::bigint[]) AS post(battle_id, message_id)
+                    WHERE b.id = post.battle_id
+                """, ([p[0] for p in published], [p[1] for p in published]))
+        
+        for battle_id, post_message_id, _ in published:
+            self.tallies.set_message(battle_id, post_message_id)
     
-    def add_battle_message(self, battle_id: int, message_id: int):
+    async def add_battle_message(self, battle_id: int, message_id: int):
         """Добавить ID сообщения батла"""
-        with self.conn.cursor() as cur:
-            cur.execute("""
+        async with self.cursor() as cur:
+            await cur.execute("""
                 INSERT INTO battle_messages (battle_id, message_id)
                 VALUES (%s, %s)
             """, (battle_id, message_id))
     
-    def get_round_messages(self, round_id: int):
+    async def get_round_messages(self, round_id: int):
         """Получить все ID сообщений раунда"""
-        with self.conn.cursor() as cur:
-            cur.execute("""
+        async with self.cursor() as cur:
+            await cur.execute("""
                 SELECT bm.message_id
                 FROM battle_messages bm
                 JOIN battles b ON b.id = bm.battle_id
                 WHERE b.round_id = %s
             """, (round_id,))
-            return [row[0] for row in cur.fetchall()]
+            return [row[0] for row in await cur.fetchall()]
+    
+    async def delete_battle_messages(self, message_ids: list):
+        """Забыть ID сообщений, удаление которых из канала подтверждено"""
+        async with self.cursor() as cur:
+            await cur.execute(
+                "DELETE FROM battle_messages WHERE message_id = ANY(%s)",
+                (message_ids,)
+            )
     
-    def get_user_photo_in_round(self, user_id: int, round_id: int):
+    async def get_uncleaned_rounds(self):
+        """ID завершенных раундов, сообщения которых еще не удалены из канала"""
+        async with self.cursor() as cur:
+            await cur.execute("""
+                SELECT DISTINCT b.round_id
+                FROM battle_messages bm
+                JOIN battles b ON b.id = bm.battle_id
+                JOIN rounds r ON r.id = b.round_id
+                WHERE r.status != 'active'
+                ORDER BY b.round_id
+            """)
+            return [row[0] for row in await cur.fetchall()]
+    
+    async def get_user_photo_in_round(self, user_id: int, round_id: int):
         """Получить фото пользователя в раунде"""
-        with self.conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute("""
-                SELECT * FROM photos
-                WHERE user_id = %s AND round_id = %s
-                ORDER BY created_at DESC
-                LIMIT 1
-            """, (user_id, round_id))
-            return cur.fetchone()
-    
-    def get_battle_by_photo(self, photo_id: int):
+        async with self.cursor(dict_row) as cur:
+            await self.run(cur, 'get_user_photo_in_round', (user_id, round_id))
+            return await cur.fetchone()
+    
+    async def get_battle_by_photo(self, photo_id: int):
         """Получить батл по ID фото"""
-        with self.conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute("""
-                SELECT * FROM battles
-                WHERE photo1_id = %s OR photo2_id = %s
-                ORDER BY created_at DESC
-                LIMIT 1
-            """, (photo_id, photo_id))
-            return cur.fetchone()
-    
-    def use_extra_votes(self, user_id: int, photo_id: int, votes_count: int):
-        """Использовать дополнительные голоса на свое фото"""
-        with self.conn.cursor() as cur:
-            # Убираем голоса у пользователя
-            cur.execute("""
-                UPDATE users
-                SET extra_votes = GREATEST(extra_votes - %s, 0)
-                WHERE telegram_id = %s
-            """, (votes_count, user_id))
-            
-            # Добавляем голоса к фото
-            cur.execute("""
-                UPDATE photos
-                SET votes = votes + %s
-                WHERE id = %s
-            """, (votes_count, photo_id))
+        async with self.cursor(dict_row) as cur:
+            await self.run(cur, 'get_battle_by_photo', (photo_id, photo_id))
+            return await cur.fetchone()
     
-    def get_bot_stats(self):
-        """Общая статистика бота"""
-        with self.conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute("SELECT COUNT(*) as total_users FROM users")
-            total_users = cur.fetchone()['total_users']
-            
-            cur.execute("SELECT COUNT(*) as total_photos FROM photos")
-            total_photos = cur.fetchone()['total_photos']
+    async def use_extra_votes(self, user_id: int, photo_id: int, votes_count: int):
+        """
+        Использовать дополнительные голоса на свое фото.
+        Голоса уходят в журнал одной записью с весом votes_count.
+        Возвращает id батла или None, если фото сейчас не в батле
+        или голосов на балансе уже не хватает
+        """
+        async with self.cursor() as cur:
+            await self.run(cur, 'spend_extra_votes', {
+                'user_id': user_id,
+                'photo_id': photo_id,
+                'votes': votes_count,
+                'stripe': user_id % config.TALLY_STRIPES,
+                'channel': config.DB_NOTIFY_CHANNEL,
+                'sender': self.instance_id
+            })
+            row = await cur.fetchone()
+        if not row:
+            return None
+        
+        battle_id, side, _ = row
+        self.tallies.bump(battle_id, side, votes_count)
+        self.profiles.invalidate(user_id)
+        return battle_id
+    
+    async def check_tallies(self, round_id: int, repair: bool = False):
+        """
+        Сверить полосы battle_tallies с журналом votes по батлам раунда.
+        Возвращает расхождения (battle_id, side, ledger_votes, tally_votes).
+        repair=True пересобирает счетчики расходящихся батлов из журнала;
+        на время пересборки новые голоса ждут блокировку таблицы счетчиков
+        """
+        check_sql = """
+            WITH ledger AS (
+                SELECT v.battle_id, CASE WHEN v.photo_id = b.photo1_id THEN 1 ELSE 2 END AS side,
+                       SUM(v.weight) AS votes
+                FROM votes v
+                JOIN battles b ON b.id = v.battle_id
+                WHERE v.round_id = %s
+                GROUP BY 1, 2
+            ),
+            tallies AS (
+                SELECT t.battle_id, t.side, SUM(t.votes) AS votes
+                FROM battle_tallies t
+                JOIN battles b ON b.id = t.battle_id
+                WHERE b.round_id = %s
+                GROUP BY 1, 2
+            )
+            SELECT 
+                COALESCE(l.battle_id, t.battle_id) AS battle_id,
+                COALESCE(l.side, t.side) AS side,
+                COALESCE(l.votes, 0) AS ledger_votes,
+                COALESCE(t.votes, 0) AS tally_votes
+            FROM ledger l
+            FULL JOIN tallies t ON t.battle_id = l.battle_id AND t.side = l.side
+            WHERE COALESCE(l.votes, 0) != COALESCE(t.votes, 0)
+            ORDER BY 1, 2
+        """
+        async with self.pool.connection() as conn:
+            async with conn.transaction(), conn.cursor(row_factory=dict_row) as cur:
+                if repair:
+                    await cur.execute("LOCK TABLE battle_tallies IN SHARE ROW EXCLUSIVE MODE")
+                await cur.execute(check_sql, (round_id, round_id))
+                drift = await cur.fetchall()
+                
+                if repair and drift:
+                    battle_ids = sorted({row['battle_id'] for row in drift})
+                    await cur.execute(
+                        "DELETE FROM battle_tallies WHERE battle_id = ANY(%s)",
+                        (battle_ids,)
+                    )
+                    await cur.execute(
+                        REBUILD_TALLIES_SQL.format(battle_filter="WHERE v.battle_id = ANY(%(battle_ids)s)"),
+                        {'stripes': config.TALLY_STRIPES, 'battle_ids': battle_ids}
+                    )
+        
+        if repair and drift and self.tallies.round_id == round_id:
+            await self.load_tallies(round_id)
+        return drift
+    
+    async def check_plans(self):
+        """
+        EXPLAIN (FORMAT JSON) каждого запроса из STATEMENTS на текущих
+        данных и статистике. Возвращает список проблем: Seq Scan по таблице
+        от PLAN_SEQSCAN_MIN_ROWS строк или стоимость выше PLAN_COST_BUDGET
+        """
+        problems = []
+        async with self.cursor() as cur:
+            await cur.execute("SELECT relname, reltuples FROM pg_class WHERE relkind IN ('r', 'p')")
+            table_rows = dict(await cur.fetchall())
             
-            cur.execute("SELECT COUNT(*) as total_battles FROM battles")
-            total_battles = cur.fetchone()['total_battles']
+            for name, params in PLAN_SAMPLES.items():
+                await cur.execute("EXPLAIN (FORMAT JSON) " + STATEMENTS[name], params)
+                plan = (await cur.fetchone())[0][0]['Plan']
+                
+                cost = plan['Total Cost']
+                if cost > config.PLAN_COST_BUDGET:
+                    problems.append(f"{name}: стоимость {cost:.0f} > {config.PLAN_COST_BUDGET}")
+                for node in plan_nodes(plan):
+                    table = node.get('Relation Name')
+                    if node['Node Type'] == 'Seq Scan' and table_rows.get(table, 0) >= config.PLAN_SEQSCAN_MIN_ROWS:
+                        problems.append(f"{name}: Seq Scan по {table} (~{table_rows[table]:.0f} строк)")
+        
+        return problems
+    
+    async def enqueue_notifications(self, kind: str, round_id: int, messages: list):
+        """
+        Поставить пачку личных сообщений в очередь одной транзакцией.
+        messages - список (chat_id, text, reply_markup как dict или None).
+        Возвращает id пачки или None, если сообщений нет
+        """
+        if not messages:
+            return None
+        
+        async with self.pool.connection() as conn:
+            async with conn.transaction(), conn.cursor() as cur:
+                await cur.execute("""
+                    INSERT INTO notification_batches (kind, round_id, total)
+                    VALUES (%s, %s, %s)
+                    RETURNING id
+                """, (kind, round_id, len(messages)))
+                batch_id = (await cur.fetchone())[0]
+                await cur.execute("""
+                    INSERT INTO notification_jobs (batch_id, chat_id, text, reply_markup)
+                    SELECT %s, * FROM unnest(%s::bigint[], %s::text[], %s::text[]::jsonb[])
+                """, (
+                    batch_id,
+                    [chat_id for chat_id, _, _ in messages],
+                    [text for _, text, _ in messages],
+                    [json.dumps(markup) if markup else None for _, _, markup in messages],
+                ))
+        
+        metrics.inc('notifications.enqueued', len(messages))
+        return batch_id
+    
+    async def claim_notifications(self, limit: int):
+        """
+        Забрать до limit ожидающих сообщений на NOTIFY_LOCK_SECONDS.
+        Несколько процессов разбирают очередь, не мешая друг другу;
+        сообщение упавшего процесса вернется в работу после блокировки
+        """
+        async with self.cursor(dict_row) as cur:
+            await cur.execute("""
+                UPDATE notification_jobs
+                SET locked_until = NOW() + make_interval(secs => %s), attempts = attempts + 1
+                WHERE id IN (
+                    SELECT id FROM notification_jobs
+                    WHERE status = 'pending' AND (locked_until IS NULL OR locked_until < NOW())
+                    ORDER BY id
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id, batch_id, chat_id, text, reply_markup, attempts
+            """, (config.NOTIFY_LOCK_SECONDS, limit))
+            return await cur.fetchall()
+    
+    async def finish_notifications(self, results: list):
+        """
+        Записать результаты отправки: список (job_id, sent, error).
+        sent=None - повторить позже, если попытки не исчерпаны: через
+        NOTIFY_RETRY_SECONDS, дальше пауза удваивается с каждой попыткой.
+        Счетчики пачек обновляются тем же запросом
+        """
+        if not results:
+            return
+        
+        async with self.cursor() as cur:
+            await cur.execute("""
+                WITH result AS (
+                    SELECT * FROM unnest(%s::bigint[], %s::boolean[], %s::text[]) AS r(id, sent, error)
+                ),
+                done AS (
+                    UPDATE notification_jobs j
+                    SET status = CASE
+                            WHEN r.sent THEN 'sent'
+                            WHEN r.sent = FALSE OR j.attempts >= %s THEN 'failed'
+                            ELSE 'pending'
+                        END,
+                        error = r.error,
+                        locked_until = CASE
+                            WHEN r.sent IS NULL AND j.attempts < %s
+                            THEN NOW() + make_interval(secs => %s * power(2, j.attempts - 1))
+                        END
+                    FROM result r
+                    WHERE j.id = r.id AND j.status = 'pending'
+                    RETURNING j.batch_id, j.status
+                ),
+                counts AS (
+                    SELECT 
+                        batch_id,
+                        COUNT(*) FILTER (WHERE status = 'sent') AS sent,
+                        COUNT(*) FILTER (WHERE status = 'failed') AS failed
+                    FROM done
+                    GROUP BY batch_id
+                )
+                UPDATE notification_batches b
+                SET sent = b.sent + c.sent,
+                    failed = b.failed + c.failed,
+                    finished_at = CASE
+                        WHEN b.sent + c.sent + b.failed + c.failed >= b.total THEN NOW()
+                    END
+                FROM counts c
+                WHERE b.id = c.batch_id
+            """, (
+                [job_id for job_id, _, _ in results],
+                [sent for _, sent, _ in results],
+                [error for _, _, error in results],
+                config.NOTIFY_MAX_ATTEMPTS,
+                config.NOTIFY_MAX_ATTEMPTS,
+                config.NOTIFY_RETRY_SECONDS,
+            ))
+    
+    async def get_notification_batches(self, limit: int = 10):
+        """Последние пачки сообщений со статистикой доставки"""
+        async def fetch(cur):
+            await cur.execute("""
+                SELECT id, kind, round_id, total, sent, failed, created_at, finished_at
+                FROM notification_batches
+                ORDER BY id DESC
+                LIMIT %s
+            """, (limit,))
+            return await cur.fetchall()
+        
+        return await self.read(fetch, dict_row)
+    
+    async def create_broadcast(self, text: str, created_by: int):
+        """Создать рассылку всем пользователям. Возвращает ее id"""
+        async with self.cursor() as cur:
+            await cur.execute("""
+                INSERT INTO broadcasts (text, created_by)
+                VALUES (%s, %s)
+                RETURNING id
+            """, (text, created_by))
+            return (await cur.fetchone())[0]
+    
+    async def get_broadcast(self, broadcast_id: int):
+        """Рассылка с прогрессом"""
+        async with self.cursor(dict_row) as cur:
+            await cur.execute("SELECT * FROM broadcasts WHERE id = %s", (broadcast_id,))
+            return await cur.fetchone()
+    
+    async def get_running_broadcasts(self):
+        """ID незавершенных рассылок (для продолжения после перезапуска)"""
+        async with self.cursor() as cur:
+            await cur.execute("SELECT id FROM broadcasts WHERE status = 'running' ORDER BY id")
+            return [row[0] for row in await cur.fetchall()]
+    
+    async def broadcast_recipients(self, broadcast_id: int, chunk_size: int):
+        """
+        Получатели рассылки пачками по chunk_size, начиная после контрольной
+        точки. Читаются серверным курсором WITH HOLD на отдельном соединении,
+        поэтому в памяти только текущая пачка и транзакция не висит всю
+        рассылку. Рассылку ведет один процесс: он держит advisory-блокировку,
+        остальные сразу получают пустой поток. Когда получатели кончились,
+        рассылка помечается завершенной
+        """
+        conn = await psycopg.AsyncConnection.connect(self.pool.conninfo, autocommit=True)
+        async with conn:
+            cur = await conn.execute("SELECT pg_try_advisory_lock(hashtext('broadcast'), %s)", (broadcast_id,))
+            if not (await cur.fetchone())[0]:
+                return
             
-            cur.execute("SELECT COUNT(*) as total_votes FROM votes")
-            total_votes = cur.fetchone()['total_votes']
+            cur = await conn.execute(
+                "SELECT last_user_id FROM broadcasts WHERE id = %s AND status = 'running'",
+                (broadcast_id,)
+            )
+            row = await cur.fetchone()
+            if not row:
+                return
             
-            cur.execute("SELECT COUNT(*) as total_admins FROM admins")
-            total_admins = cur.fetchone()['total_admins']
+            async with conn.cursor(name=f"broadcast_{broadcast_id}", withhold=True) as recipients:
+                await recipients.execute("""
+                    SELECT telegram_id FROM users
+                    WHERE telegram_id > %s AND blocked_at IS NULL
+                    ORDER BY telegram_id
+                """, (row[0],))
+                while True:
+                    chunk = await recipients.fetchmany(chunk_size)
+                    if not chunk:
+                        break
+                    yield [user_id for (user_id,) in chunk]
             
-            return {
-                'total_users': total_users,
-                'total_photos': total_photos,
-                'total_battles': total_battles,
-                'total_votes': total_votes,
-                'total_admins': total_admins
-            }
+            await conn.execute("""
+                UPDATE broadcasts SET status = 'done', finished_at = NOW()
+                WHERE id = %s
+            """, (broadcast_id,))
+    
+    async def checkpoint_broadcast(self, broadcast_id: int, last_user_id: int,
+                                   sent: int, failed: int, blocked_ids: list):
+        """Сохранить прогресс рассылки и отметить заблокировавших бота"""
+        async with self.pool.connection() as conn:
+            async with conn.pipeline(), conn.transaction(), conn.cursor() as cur:
+                if blocked_ids:
+                    await cur.execute(
+                        "UPDATE users SET blocked_at = NOW() WHERE telegram_id = ANY(%s)",
+                        (blocked_ids,)
+                    )
+                await cur.execute("""
+                    UPDATE broadcasts
+                    SET last_user_id = %s,
+                        sent = sent + %s,
+                        failed = failed + %s,
+                        blocked = blocked + %s
+                    WHERE id = %s
+                """, (last_user_id, sent, failed, len(blocked_ids), broadcast_id))
+    
+    async def get_bot_stats(self, exact: bool = False):
+        """
+        Общая статистика бота. По умолчанию из счетчиков bot_counters
+        (константное время), exact=True - точный COUNT(*) по таблицам.
+        Читается с реплики
+        """
+        async def fetch(cur):
+            if exact:
+                # Голоса заархивированных раундов уже не в votes
+                await cur.execute("SELECT " + ", ".join(
+                    "(SELECT COUNT(*) FROM votes) + (SELECT COALESCE(SUM(archived_votes), 0) FROM rounds)"
+                    if table == 'votes' else f"(SELECT COUNT(*) FROM {table})"
+                    for table in COUNTED_TABLES
+                ))
+                return dict(zip(COUNTED_TABLES, await cur.fetchone()))
+            await cur.execute("SELECT name, SUM(value) FROM bot_counters GROUP BY name")
+            return dict(await cur.fetchall())
+        
+        counts = await self.read(fetch)
+        return {f"total_{table}": int(counts.get(table, 0)) for table in COUNTED_TABLES}
+    
+    async def refresh_stats(self, exact: bool = False):
+        """Обновить снимок статистики для /stats и /admin"""
+        data = await self.get_bot_stats(exact=exact)
+        
+        current_round = await self.get_current_round()
+        round_id = current_round['id'] if current_round else None
+        data['round_number'] = current_round['number'] if current_round else None
+        data['pending'] = await self.count_photos_by_status('pending', round_id)
+        data['approved'] = await self.count_photos_by_status('approved', round_id)
+        data['battles'] = await self.count_battles_in_round(round_id) if round_id else 0
+        
+        self.stats.update(data, exact=exact)
+        return self.stats
+
+
+# Общий экземпляр на весь процесс (бот, утилиты)
+db = Database()
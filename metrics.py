@@ -0,0 +1,35 @@
+"""
+Простые метрики процесса бота: счетчики и текущие значения
+"""
+from collections import Counter
+
+counters = Counter()
+gauges = {}
+
+
+def inc(name, value=1):
+    """
+    Увеличивает счетчик
+    """
+    counters[name] += value
+
+
+def set_gauge(name, value):
+    """
+    Запоминает текущее значение метрики
+    """
+    gauges[name] = value
+
+
+def render(prefix=''):
+    """
+    Текстовый отчет по метрикам с заданным префиксом
+    """
+    lines = []
+    for name, value in counters.most_common():
+        if name.startswith(prefix):
+            lines.append(f"{name}: {value}")
+    for name in sorted(gauges):
+        if name.startswith(prefix):
+            lines.append(f"{name} = {gauges[name]}")
+    return "\n".join(lines) if lines else "Нет данных"
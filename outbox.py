@@ -0,0 +1,477 @@
+"""
+Исходящие запросы к Telegram: планировщик отправки и правки кнопок в канале
+"""
+import asyncio
+from collections import Counter
+from enum import IntEnum
+import heapq
+import itertools
+import logging
+import time
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class Priority(IntEnum):
+    """Класс приоритета запроса (rate_limit_args): меньше - раньше"""
+    INTERACTIVE = 0  # Кнопки голосования
+    NORMAL = 1       # Публикация батлов, ответы и личные сообщения
+    BULK = 2         # Рассылки и удаление сообщений
+
+
+# Приоритет по умолчанию для методов API
+ENDPOINT_PRIORITY = {
+    'editMessageReplyMarkup': Priority.INTERACTIVE,
+    'deleteMessage': Priority.BULK,
+    'deleteMessages': Priority.BULK,
+}
+
+# Через очередь идут только методы, которые создают, меняют или удаляют
+# сообщения. Остальные (getUpdates, answerCallbackQuery, getChatMember)
+# выполняются сразу
+LIMITED_PREFIXES = ('send', 'edit', 'delete', 'copy', 'forward')
+
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity подряд"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+
+    def wait_time(self, now: float) -> float:
+        """Сколько секунд ждать до следующего токена (0 - есть сейчас)"""
+        if now < self.paused_until:
+            return self.paused_until - now
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        """Забрать токен"""
+        self.tokens -= 1
+
+    def pause(self, until: float):
+        """Не выдавать токены до until (RetryAfter), после паузы - один токен"""
+        self.paused_until = max(self.paused_until, until)
+        self.tokens = min(self.tokens, 1)
+        self.updated = self.paused_until
+
+    def full(self, now: float) -> bool:
+        """Ведро снова полное: новое ведро вело бы себя так же"""
+        return self.wait_time(now) == 0 and self.tokens >= self.capacity
+
+
+class SendScheduler(BaseRateLimiter):
+    """
+    Единая очередь запросов бота к Telegram (ApplicationBuilder.rate_limiter).
+    Запрос ждет токен общего ведра, а запрос с chat_id (отправка, правка,
+    удаление) - еще и ведра своего чата (личный чат, группа/канал или чат
+    со своим лимитом из chat_limits). Ожидающие выпускаются по приоритету,
+    в пределах приоритета - по порядку; каждая ступень приоритета весит
+    AGING_SECONDS ожидания, так что поток правок не задерживает публикацию
+    и удаление навсегда. Запрос в исчерпанный чат не держит запросы
+    в другие чаты. RetryAfter
+    ставит на паузу ведро чата запроса (без чата - общее ведро), запрос
+    повторяется до max_retries раз. Ведра чатов, которые снова полны,
+    забываются раз в SWEEP_SECONDS
+    """
+
+    SWEEP_SECONDS = 60
+    AGING_SECONDS = 5
+
+    def __init__(self, overall_rate: float, private_rate: float, group_per_minute: int, max_retries: int,
+                 chat_limits: dict = None):
+        self.overall = TokenBucket(overall_rate, overall_rate)
+        self.private_rate = private_rate
+        self.group_per_minute = group_per_minute
+        # {chat_id: запросов в минуту} - чаты со своим лимитом (канал батлов)
+        self.chat_limits = chat_limits or {}
+        self.max_retries = max_retries
+        self.chats = {}
+        self.waiting = []
+        self.depth = Counter()
+        self.seq = itertools.count()
+        self.next_sweep = time.monotonic() + self.SWEEP_SECONDS
+        self.changed = None
+        self.dispatcher = None
+
+    async def initialize(self):
+        """Запуск диспетчера очереди"""
+        self.changed = asyncio.Event()
+        self.dispatcher = asyncio.create_task(self.dispatch())
+
+    async def shutdown(self):
+        """Остановка диспетчера, ожидающие запросы отменяются"""
+        if self.dispatcher:
+            self.dispatcher.cancel()
+        for *_, future in self.waiting:
+            future.cancel()
+        self.waiting = []
+        self.depth.clear()
+
+    def chat_bucket(self, chat_id):
+        """
+        Ведро чата: личные чаты - положительные ID, группы и каналы - остальные.
+        Группе доступен минутный лимит сразу, дальше - равномерно
+        """
+        bucket = self.chats.get(chat_id)
+        if bucket is None:
+            per_minute = self.chat_limits.get(chat_id)
+            if per_minute:
+                bucket = TokenBucket(per_minute / 60, per_minute)
+            elif isinstance(chat_id, int) and chat_id > 0:
+                bucket = TokenBucket(self.private_rate, 3)
+            else:
+                bucket = TokenBucket(self.group_per_minute / 60, self.group_per_minute)
+            self.chats[chat_id] = bucket
+        return bucket
+
+    def sweep(self, now: float):
+        """Забыть ведра чатов, которые снова полны"""
+        full = [chat_id for chat_id, bucket in self.chats.items() if bucket.full(now)]
+        for chat_id in full:
+            del self.chats[chat_id]
+        metrics.inc('sender.buckets_evicted', len(full))
+        metrics.set_gauge('sender.buckets', len(self.chats))
+        self.next_sweep = now + self.SWEEP_SECONDS
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        """Выполнить запрос, когда до него дойдет очередь"""
+        if not endpoint.startswith(LIMITED_PREFIXES):
+            return await callback(*args, **kwargs)
+
+        priority = Priority(rate_limit_args) if rate_limit_args is not None else ENDPOINT_PRIORITY.get(endpoint, Priority.NORMAL)
+        chat_id = data.get('chat_id')
+
+        for attempt in range(self.max_retries + 1):
+            await self.acquire(priority, chat_id)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                # С каждой повторной попыткой пауза чуть длиннее
+                metrics.inc('sender.retry_after')
+                bucket = self.chat_bucket(chat_id) if chat_id is not None else self.overall
+                bucket.pause(time.monotonic() + e.retry_after + attempt)
+                self.changed.set()
+
+    async def acquire(self, priority: Priority, chat_id):
+        """Встать в очередь и дождаться своей очереди"""
+        future = asyncio.get_running_loop().create_future()
+        # Ключ очереди - время постановки плюс штраф за приоритет: запрос
+        # пониже приоритетом уступает только тем, кто пришел не позже
+        # чем AGING_SECONDS за ступень после него
+        due = time.monotonic() + priority * self.AGING_SECONDS
+        heapq.heappush(self.waiting, (due, next(self.seq), priority, chat_id, future))
+        self.depth[priority] += 1
+        metrics.set_gauge(f"sender.queue.{priority.name.lower()}", self.depth[priority])
+        self.changed.set()
+        await future
+
+    def release(self, now: float):
+        """
+        Выпустить ожидающих, на кого есть токены.
+        Возвращает, через сколько секунд пробовать снова (None - некого ждать)
+        """
+        if now >= self.next_sweep:
+            self.sweep(now)
+
+        delay = None
+        blocked = []
+        while self.waiting:
+            wait = self.overall.wait_time(now)
+            if wait:
+                delay = wait if delay is None else min(delay, wait)
+                break
+
+            item = heapq.heappop(self.waiting)
+            _, _, priority, chat_id, future = item
+            # Ведро берется по chat_id здесь, а не при постановке в очередь:
+            # так его можно забыть, пока запрос чата ждет общего ведра
+            bucket = self.chat_bucket(chat_id) if chat_id is not None and not future.done() else None
+            chat_wait = bucket.wait_time(now) if bucket else 0
+            if chat_wait:
+                blocked.append(item)
+                delay = chat_wait if delay is None else min(delay, chat_wait)
+                continue
+
+            self.depth[priority] -= 1
+            metrics.set_gauge(f"sender.queue.{priority.name.lower()}", self.depth[priority])
+            if future.done():
+                # Ожидающий отменен
+                continue
+            self.overall.take()
+            if bucket:
+                bucket.take()
+            metrics.inc('sender.requests')
+            future.set_result(None)
+
+        for item in blocked:
+            heapq.heappush(self.waiting, item)
+        return delay
+
+    async def dispatch(self):
+        """Выпускать запросы по мере появления токенов"""
+        while True:
+            delay = self.release(time.monotonic())
+            self.changed.clear()
+            try:
+                await asyncio.wait_for(self.changed.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+
+class EditCoalescer:
+    """
+    Правки кнопок батлов: не чаще одной на батл за interval секунд, а все
+    батлы вместе - не больше rate правок в секунду (доля лимита канала):
+    при N батлах с голосами каждый правится раз в max(interval, N / rate).
+    mark() только отмечает батл, правку делает одна задача на батл.
+    Кнопки строятся в момент отправки по последнему счету, поэтому
+    свежий счет всегда выигрывает, а правки одного батла не обгоняют
+    друг друга. Правка с теми же кнопками, что уже показаны, не отправляется.
+
+    render(battle_id) - кнопки батла (любое сравнимое значение) или None,
+    edit(battle_id, message_id, buttons) - отправка правки
+    """
+
+    def __init__(self, interval: float, render, edit, rate: float = None):
+        self.interval = interval
+        self.rate = rate
+        self.render = render
+        self.edit = edit
+        self.dirty = {}
+        self.shown = {}
+        self.last_edit = {}
+        self.tasks = {}
+
+    def mark(self, battle_id: int, message_id: int):
+        """Батл нужно перерисовать"""
+        metrics.inc('edits.marked')
+        self.dirty[battle_id] = message_id
+        if battle_id not in self.tasks:
+            self.tasks[battle_id] = asyncio.create_task(self.flush(battle_id))
+
+    async def flush(self, battle_id: int):
+        """Отправлять правки батла, пока он отмечен, выдерживая интервал"""
+        try:
+            while battle_id in self.dirty:
+                wait = self.last_edit.get(battle_id, 0) + self.cadence() - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+
+                message_id = self.dirty.pop(battle_id)
+                try:
+                    # Ошибка чтения счета не должна останавливать задачу:
+                    # батл могут отметить снова, пока она работает
+                    buttons = await self.render(battle_id)
+                    if buttons is None or buttons == self.shown.get(battle_id):
+                        metrics.inc('edits.skipped')
+                        continue
+                    await self.edit(battle_id, message_id, buttons)
+                except Exception as e:
+                    retry_after = getattr(e, 'retry_after', None)
+                    if retry_after is None:
+                        metrics.inc('edits.failed')
+                        logger.error(f"Ошибка обновления кнопок батла #{battle_id}: {e}")
+                    else:
+                        # Флуд-контроль: повторим с последним счетом после паузы
+                        metrics.inc('edits.retry_after')
+                        self.dirty.setdefault(battle_id, message_id)
+                        await asyncio.sleep(retry_after)
+                else:
+                    metrics.inc('edits.sent')
+                    self.shown[battle_id] = buttons
+                self.last_edit[battle_id] = time.monotonic()
+        finally:
+            self.tasks.pop(battle_id, None)
+
+    def cadence(self) -> float:
+        """Интервал между правками одного батла при текущем числе батлов с голосами"""
+        if not self.rate:
+            return self.interval
+        return max(self.interval, len(self.tasks) / self.rate)
+
+    def forget(self):
+        """Забыть показанные кнопки батлов без ожидающих правок (раунд завершен)"""
+        self.shown = {battle_id: buttons for battle_id, buttons in self.shown.items() if battle_id in self.tasks}
+        self.last_edit = {battle_id: at for battle_id, at in self.last_edit.items() if battle_id in self.tasks}
+
+    def close(self):
+        """Отменить ожидающие правки"""
+        for task in list(self.tasks.values()):
+            task.cancel()
+
+
+if __name__ == "__main__":
+    # Проверка: 50 голосов за 0.3 сек дают не больше 3 правок (сразу, через 0.2
+    # и 0.4 сек), последняя - с итоговым счетом
+    async def check():
+        count = {'votes': 0}
+        sent = []
+
+        async def render(battle_id):
+            return count['votes']
+
+        async def edit(battle_id, message_id, buttons):
+            await asyncio.sleep(0.01)
+            sent.append(buttons)
+
+        coalescer = EditCoalescer(0.2, render, edit)
+        for _ in range(50):
+            count['votes'] += 1
+            coalescer.mark(1, 100)
+            await asyncio.sleep(0.006)
+        while coalescer.tasks:
+            await asyncio.sleep(0.05)
+
+        assert sent[-1] == 50, sent
+        assert len(sent) <= 3, sent
+        assert sent == sorted(sent), sent
+
+        coalescer.mark(1, 100)
+        while coalescer.tasks:
+            await asyncio.sleep(0.05)
+        assert len(sent) <= 3, "правка без изменений не должна отправляться"
+        print(f"Правок: {len(sent)} на 50 голосов")
+
+        # Ошибка render не теряет отметки, сделанные после нее
+        async def flaky_render(battle_id):
+            if battle_id == 2 and not failed:
+                failed.append(battle_id)
+                coalescer.mark(2, 200)
+                raise ConnectionError("БД недоступна")
+            return count['votes']
+
+        failed = []
+        count['votes'] += 1
+        coalescer.render = flaky_render
+        coalescer.mark(2, 200)
+        while coalescer.tasks:
+            await asyncio.sleep(0.05)
+        assert failed and sent[-1] == 51, sent
+
+        # Раунд из 10 батлов с голосами все время: правки всех батлов вместе
+        # укладываются в rate, каждый батл правится регулярно и с итоговым счетом
+        scores = {}
+        edits = []
+
+        async def render_battle(battle_id):
+            return scores[battle_id]
+
+        async def edit_battle(battle_id, message_id, buttons):
+            edits.append((time.monotonic(), battle_id, buttons))
+
+        round_edits = EditCoalescer(0.05, render_battle, edit_battle, rate=20)
+        started = time.monotonic()
+        while time.monotonic() - started < 2:
+            for battle_id in range(10):
+                scores[battle_id] = scores.get(battle_id, 0) + 1
+                round_edits.mark(battle_id, battle_id)
+            await asyncio.sleep(0.01)
+        while round_edits.tasks:
+            await asyncio.sleep(0.05)
+
+        elapsed = edits[-1][0] - edits[0][0]
+        assert len(edits) <= 20 * elapsed + 10 + 1, (len(edits), elapsed)
+        for battle_id in range(10):
+            shown = [buttons for _, battle, buttons in edits if battle == battle_id]
+            assert len(shown) >= 4, f"батл {battle_id} правился {len(shown)} раз"
+            assert shown[-1] == scores[battle_id]
+        print(f"Правок: {len(edits)} за {elapsed:.1f} сек на 10 батлов при лимите 20 в секунду")
+
+    # Проверка: RetryAfter одного чата не держит другие, правки в канале
+    # ждут ведра канала, поток правок не задерживает публикацию навсегда,
+    # полные ведра забываются
+    async def check_scheduler():
+        scheduler = SendScheduler(overall_rate=1000, private_rate=1000, group_per_minute=2, max_retries=1,
+                                  chat_limits={-200: 600})
+        await scheduler.initialize()
+        done = []
+
+        async def call(endpoint, chat_id, retry_after=0):
+            async def callback():
+                if retry_after and not any(chat == chat_id for chat, _ in done):
+                    done.append((chat_id, 'retry'))
+                    raise RetryAfter(retry_after)
+                done.append((chat_id, endpoint))
+            await scheduler.process_request(callback, (), {}, endpoint, {'chat_id': chat_id}, None)
+
+        slow = asyncio.create_task(call('sendMessage', 1, retry_after=1))
+        await asyncio.sleep(0.05)
+        await asyncio.wait_for(call('sendMessage', 2), 0.5)
+        assert not slow.done(), "чат на паузе должен ждать"
+        await asyncio.wait_for(slow, 2)
+
+        await call('sendMessage', -100)
+        await call('sendPhoto', -100)
+        edit = asyncio.create_task(call('editMessageReplyMarkup', -100))
+        await asyncio.sleep(0.2)
+        assert not edit.done(), "правка в канале должна ждать лимита канала"
+
+        # Канал со своим лимитом (10 в секунду): 10 батлов все время держат
+        # по правке в очереди, публикация все равно выходит
+        scheduler.AGING_SECONDS = 0.2
+        scheduler.chat_bucket(-200).tokens = 0
+        storm = True
+
+        async def edits():
+            while storm:
+                await call('editMessageReplyMarkup', -200)
+
+        editors = [asyncio.create_task(edits()) for _ in range(10)]
+        await asyncio.sleep(0.3)
+        await asyncio.wait_for(call('sendMessage', -200), 3)
+        storm = False
+        await asyncio.gather(*editors)
+
+        # Через 5 секунд личные ведра снова полны, а ведра группы и канала - еще нет
+        scheduler.sweep(time.monotonic() + 5)
+        assert set(scheduler.chats) == {-100, -200}, scheduler.chats
+        await scheduler.shutdown()
+
+    # Проверка памяти: рассылка на 200 тыс. получателей пачками по 500
+    # (как run_broadcast) по часам планировщика, без реальных пауз.
+    # Ведра личных чатов забываются, память не растет с числом получателей
+    async def check_broadcast_memory():
+        import tracemalloc
+
+        scheduler = SendScheduler(overall_rate=30, private_rate=1, group_per_minute=20, max_retries=0)
+        scheduler.changed = asyncio.Event()
+        clock = time.monotonic()
+        tracemalloc.start()
+        for start in range(0, 200_000, 500):
+            if start == 10_000:
+                baseline, _ = tracemalloc.get_traced_memory()
+            sends = [
+                asyncio.create_task(scheduler.acquire(Priority.BULK, user_id))
+                for user_id in range(start + 1, start + 501)
+            ]
+            await asyncio.sleep(0)
+            while scheduler.waiting:
+                clock += 1
+                scheduler.release(clock)
+                await asyncio.sleep(0)
+            await asyncio.gather(*sends)
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        growth = (current - baseline) / 1024 / 1024
+        print(f"Рассылка на 200 тыс.: ведер чатов {len(scheduler.chats)}, рост памяти {growth:.2f} МБ")
+        assert len(scheduler.chats) <= 30 * scheduler.SWEEP_SECONDS, len(scheduler.chats)
+        assert growth < 1, "память планировщика растет с числом получателей"
+
+    asyncio.run(check())
+    asyncio.run(check_scheduler())
+    asyncio.run(check_broadcast_memory())
+    print("✅ Все тесты пройдены!")
@@ -0,0 +1,37 @@
+"""
+Уведомления между процессами: изменение, сделанное другим процессом
+во время прогрева кэшей, не теряется
+"""
+import asyncio
+
+from conftest import Database
+
+
+def test_change_during_hydration_reaches_cache(run_db):
+    async def scenario(db):
+        await db.set_prize("старый приз")
+        other = Database(db.pool.conninfo)
+        await other.pool.open()
+        hydrate = db.hydrate
+
+        async def hydrate_then_change():
+            # Другой процесс меняет приз сразу после того, как прогрев его прочитал
+            current_round = await hydrate()
+            await other.set_prize("новый приз")
+            return current_round
+
+        db.hydrate = hydrate_then_change
+        hydrated = asyncio.get_running_loop().create_future()
+        listener = asyncio.create_task(db.listen(hydrated))
+        try:
+            await asyncio.wait_for(hydrated, 5)
+            for _ in range(50):
+                if db.state.prize is None:
+                    break
+                await asyncio.sleep(0.1)
+            assert await db.get_prize() == "новый приз"
+        finally:
+            listener.cancel()
+            await other.pool.close()
+
+    run_db(scenario)
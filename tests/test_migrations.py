@@ -0,0 +1,114 @@
+"""
+Перенос обычной таблицы votes в секционированную по раунду
+"""
+from conftest import add_battles, add_users, config, query
+
+LEGACY_VOTES_SQL = """
+    CREATE TABLE {table} (
+        id SERIAL PRIMARY KEY,
+        user_id BIGINT NOT NULL REFERENCES users(telegram_id),
+        battle_id INTEGER REFERENCES battles(id),
+        photo_id INTEGER REFERENCES photos(id),
+        weight INTEGER NOT NULL DEFAULT 1,
+        kind VARCHAR(20) NOT NULL DEFAULT 'regular',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+"""
+
+
+async def seed_votes(db):
+    """Раунд с голосами и батл без раунда. Возвращает (round_id, battle_ids, orphan_battle_id)"""
+    round_id = await db.create_round()
+    battle_ids = await add_battles(db, round_id, [101, 102, 103, 104])
+    await add_users(db, range(500, 520))
+    for battle_id in battle_ids:
+        photo1_id, = (await query(db, "SELECT photo1_id FROM battles WHERE id = %s", (battle_id,)))[0]
+        for user_id in range(500, 520):
+            await db.cast_vote(user_id, battle_id, photo1_id)
+    orphan, = (await query(db, """
+        INSERT INTO battles (round_id, photo1_id, photo2_id, status)
+        SELECT NULL, photo1_id, photo2_id, 'ended' FROM battles WHERE id = %s
+        RETURNING id
+    """, (battle_ids[0],)))[0]
+    return round_id, battle_ids, orphan
+
+
+def test_plain_votes_table_is_partitioned(run_db):
+    async def scenario(db):
+        round_id, battle_ids, orphan = await seed_votes(db)
+        before = await query(db, "SELECT id, user_id, battle_id, photo_id FROM votes ORDER BY id")
+
+        # Таблица votes, как до секционирования
+        async with db.cursor() as cur:
+            await cur.execute(LEGACY_VOTES_SQL.format(table='votes_plain'))
+            await cur.execute("""
+                INSERT INTO votes_plain (id, user_id, battle_id, photo_id, weight, kind, created_at)
+                SELECT id, user_id, battle_id, photo_id, weight, kind, created_at FROM votes
+            """)
+            await cur.execute("""
+                INSERT INTO votes_plain (id, user_id, battle_id, photo_id)
+                SELECT 90000, 500, id, photo1_id FROM battles WHERE id = %s
+            """, (orphan,))
+            await cur.execute("DROP TABLE votes")
+            await cur.execute("ALTER TABLE votes_plain RENAME TO votes")
+            await cur.execute("ALTER INDEX votes_plain_pkey RENAME TO votes_pkey")
+            await cur.execute("""
+                CREATE UNIQUE INDEX idx_votes_regular_unique
+                ON votes(user_id, battle_id) WHERE kind = 'regular'
+            """)
+            await cur.execute("CREATE INDEX idx_votes_user ON votes(user_id)")
+
+        await db.create_tables()
+
+        assert await query(db, "SELECT relkind FROM pg_class WHERE oid = to_regclass('votes')") == [('p',)]
+        assert await query(db, "SELECT to_regclass('votes_legacy')") == [(None,)]
+        assert await query(db, "SELECT id, user_id, battle_id, photo_id FROM votes ORDER BY id") == before
+        unmigrated = await query(db, f"SELECT battle_id FROM {config.VOTES_ARCHIVE_SCHEMA}.votes_unmigrated WHERE battle_id = %s", (orphan,))
+        assert unmigrated == [(orphan,)], "голос без раунда потерян"
+        assert await query(db, """
+            SELECT indexname FROM pg_indexes
+            WHERE schemaname = 'public' AND tablename = 'votes' AND indexname = 'idx_votes_regular_unique'
+        """) == [('idx_votes_regular_unique',)]
+
+        # Новые голоса пишутся в секцию и не пересекаются с перенесенными id
+        await add_users(db, [600])
+        photo1_id, = (await query(db, "SELECT photo1_id FROM battles WHERE id = %s", (battle_ids[0],)))[0]
+        assert (await db.cast_vote(600, battle_ids[0], photo1_id))[0] is True
+        assert (await db.cast_vote(600, battle_ids[0], photo1_id))[0] is False
+        assert await db.check_tallies(round_id) == []
+        assert await query(db, """
+            SELECT (SELECT SUM(value) FROM bot_counters WHERE name = 'votes'), (SELECT COUNT(*) FROM votes)
+        """) == [(len(before) + 1, len(before) + 1)], "счетчик голосов для /stats разошелся"
+
+    run_db(scenario)
+
+
+def test_interrupted_migration_is_finished(run_db):
+    async def scenario(db):
+        round_id, battle_ids, _ = await seed_votes(db)
+        await add_users(db, [700])
+        photo1_id, = (await query(db, "SELECT photo1_id FROM battles WHERE id = %s", (battle_ids[1],)))[0]
+
+        # Прерванный перенос прежней версии: votes уже секционирована,
+        # votes_legacy с голосом, который не успел перенестись
+        async with db.cursor() as cur:
+            await cur.execute(LEGACY_VOTES_SQL.format(table='votes_legacy'))
+            await cur.execute("""
+                INSERT INTO votes_legacy (id, user_id, battle_id, photo_id, weight, kind, created_at)
+                SELECT id, user_id, battle_id, photo_id, weight, kind, created_at FROM votes
+            """)
+            await cur.execute("""
+                INSERT INTO votes_legacy (id, user_id, battle_id, photo_id)
+                VALUES (100000, 700, %s, %s)
+            """, (battle_ids[1], photo1_id))
+        total = len(await query(db, "SELECT 1 FROM votes_legacy"))
+
+        await db.create_tables()
+
+        assert await query(db, "SELECT to_regclass('votes_legacy')") == [(None,)]
+        assert len(await query(db, "SELECT 1 FROM votes")) == total
+        assert await query(db, "SELECT round_id, user_id FROM votes WHERE id = 100000") == [(round_id, 700)]
+        next_id, = (await query(db, "SELECT nextval(pg_get_serial_sequence('votes', 'id'))"))[0]
+        assert next_id > 100000
+
+    run_db(scenario)
@@ -0,0 +1,41 @@
+"""
+Очередь личных сообщений: повтор после временной ошибки с растущей паузой
+"""
+from conftest import add_users, config, query
+
+
+async def retry_delay(db, job_id: int) -> float:
+    """Секунд до повтора сообщения"""
+    delay, = (await query(db, """
+        SELECT EXTRACT(EPOCH FROM locked_until - NOW()) FROM notification_jobs WHERE id = %s
+    """, (job_id,)))[0]
+    return float(delay)
+
+
+def test_retry_is_delayed_with_backoff(run_db):
+    async def scenario(db):
+        await add_users(db, [101, 102])
+        await db.enqueue_notifications('round_results', None, [(101, "Итоги", None), (102, "Итоги", None)])
+
+        sent_job, retry_job = await db.claim_notifications(10)
+        await db.finish_notifications([(sent_job['id'], True, None), (retry_job['id'], None, "timeout")])
+        delays = [await retry_delay(db, retry_job['id'])]
+        assert await db.claim_notifications(10) == [], "повтор раньше паузы"
+
+        for attempt in range(2, config.NOTIFY_MAX_ATTEMPTS):
+            await query(db, "UPDATE notification_jobs SET locked_until = NOW() WHERE id = %s RETURNING id", (retry_job['id'],))
+            job, = await db.claim_notifications(10)
+            assert job['attempts'] == attempt
+            await db.finish_notifications([(job['id'], None, "timeout")])
+            delays.append(await retry_delay(db, job['id']))
+
+        assert config.NOTIFY_RETRY_SECONDS - 5 < delays[0] <= config.NOTIFY_RETRY_SECONDS
+        assert all(later > earlier * 1.5 for earlier, later in zip(delays, delays[1:])), delays
+
+        # Последняя попытка исчерпывает лимит - сообщение больше не ждет
+        await query(db, "UPDATE notification_jobs SET locked_until = NOW() WHERE id = %s RETURNING id", (retry_job['id'],))
+        job, = await db.claim_notifications(10)
+        await db.finish_notifications([(job['id'], None, "timeout")])
+        assert await query(db, "SELECT status, locked_until FROM notification_jobs WHERE id = %s", (job['id'],)) == [('failed', None)]
+
+    run_db(scenario)
@@ -0,0 +1,65 @@
+"""
+Разбор пула одобренных фото при параллельных одобрениях
+"""
+import asyncio
+
+from conftest import add_photos, query
+
+
+async def approve_all(db, round_id: int, photo_ids):
+    """Одобрить фото одновременно, после каждого одобрения - разбор пула"""
+    async def approve(photo_id):
+        await db.update_photo_status(photo_id, 'approved')
+        return await db.create_battles_from_pool(round_id)
+
+    await asyncio.gather(*(approve(photo_id) for photo_id in photo_ids))
+
+
+async def paired_photos(db, round_id: int):
+    """Все фото из батлов раунда (с повторами, если они есть)"""
+    rows = await query(db, "SELECT photo1_id, photo2_id FROM battles WHERE round_id = %s", (round_id,))
+    return [photo_id for row in rows for photo_id in row]
+
+
+def test_concurrent_approvals_pair_every_photo_once(run_db):
+    async def scenario(db):
+        round_id = await db.create_round()
+        photo_ids = await add_photos(db, round_id, range(1001, 1041), approve=False)
+
+        await approve_all(db, round_id, photo_ids)
+
+        paired = await paired_photos(db, round_id)
+        assert len(paired) == len(set(paired)), "фото попало в два батла"
+        assert sorted(paired) == sorted(photo_ids), "одобренное фото осталось без пары"
+        assert await query(db, "SELECT photo_id FROM pairing_pool") == []
+
+    run_db(scenario)
+
+
+def test_odd_photo_waits_in_pool(run_db):
+    async def scenario(db):
+        round_id = await db.create_round()
+        photo_ids = await add_photos(db, round_id, range(2001, 2022), approve=False)
+
+        await approve_all(db, round_id, photo_ids)
+
+        paired = await paired_photos(db, round_id)
+        assert len(paired) == len(set(paired)) == 20
+        pool = [row[0] for row in await query(db, "SELECT photo_id FROM pairing_pool")]
+        assert len(pool) == 1 and pool[0] not in paired
+
+    run_db(scenario)
+
+
+def test_parallel_pool_runs_do_not_double_pair(run_db):
+    async def scenario(db):
+        round_id = await db.create_round()
+        photo_ids = await add_photos(db, round_id, range(3001, 3031))
+
+        await asyncio.gather(*(db.create_battles_from_pool(round_id) for _ in range(10)))
+
+        paired = await paired_photos(db, round_id)
+        assert len(paired) == len(set(paired))
+        assert sorted(paired) == sorted(photo_ids)
+
+    run_db(scenario)
@@ -0,0 +1,254 @@
+"""
+Планы запросов на реалистичном объеме данных: каждый запрос, который
+выполняют методы Database, проходит EXPLAIN перед выполнением. Тест падает
+на Seq Scan по большой таблице, из которой нужна малая часть строк, и на
+стоимости выше бюджета
+"""
+from conftest import config, database, psycopg, query
+
+USERS = 50_000
+HISTORY_ROUNDS = 10
+HISTORY_PHOTOS = 500      # Фото в каждом прошлом раунде
+HISTORY_VOTERS = 20       # Голосов на батл прошлого раунда
+ACTIVE_BATTLES = 1000
+ACTIVE_VOTERS = 100       # Голосов на батл активного раунда
+POOL_PHOTOS = 500         # Одобренные фото активного раунда без пары
+NOTIFICATIONS = 20_000
+
+# Запросы на весь раунд (итоги, завершение, архив) и на всех пользователей
+# (рассылка) стоят пропорционально объему, остальные укладываются в
+# PLAN_COST_BUDGET
+BULK_COST_PER_ROW = 0.5
+# Seq Scan допустим, если запросу нужна заметная доля таблицы
+SEQSCAN_MAX_SHARE = 0.2
+
+
+class PlanRecorder:
+    """
+    EXPLAIN (FORMAT JSON) каждого запроса перед его выполнением.
+    label задает группу запросов для бюджета: 'hot' - запросы на одно
+    действие пользователя, 'bulk' - на весь раунд или всех пользователей
+    """
+
+    PLANNABLE = ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE')
+
+    def __init__(self):
+        self.label = None
+        self.plans = []
+
+    def install(self, monkeypatch):
+        """Перехватить execute обычных и серверных курсоров psycopg"""
+        execute = psycopg.AsyncCursor.execute
+        server_execute = psycopg.AsyncServerCursor.execute
+        recorder = self
+
+        async def explain(cur, query, params):
+            text = query if isinstance(query, str) else query.as_string(cur.connection)
+            if recorder.label is None or not text.lstrip().upper().startswith(recorder.PLANNABLE):
+                return
+            explain_cur = psycopg.AsyncCursor(cur.connection)
+            await execute(explain_cur, "EXPLAIN (FORMAT JSON) " + text, params)
+            plan = (await explain_cur.fetchone())[0][0]['Plan']
+            recorder.plans.append((recorder.label, text, plan))
+
+        async def recorded_execute(cur, query, params=None, **kwargs):
+            await explain(cur, query, params)
+            return await execute(cur, query, params, **kwargs)
+
+        async def recorded_server_execute(cur, query, params=None, **kwargs):
+            await explain(cur, query, params)
+            return await server_execute(cur, query, params, **kwargs)
+
+        monkeypatch.setattr(psycopg.AsyncCursor, 'execute', recorded_execute)
+        monkeypatch.setattr(psycopg.AsyncServerCursor, 'execute', recorded_server_execute)
+
+
+async def seed_dataset(db):
+    """
+    История из HISTORY_ROUNDS заархивированных раундов и активный раунд
+    на ACTIVE_BATTLES батлов с голосами, пулом, сообщениями и очередью
+    уведомлений. Возвращает ID активного раунда
+    """
+    async with db.cursor() as cur:
+        await cur.execute("""
+            INSERT INTO users (telegram_id, username, extra_votes)
+            SELECT 1000000 + n, 'user' || n, 10 FROM generate_series(1, %s) n
+        """, (USERS,))
+        await cur.execute("""
+            INSERT INTO rounds (number, status, ended_at)
+            SELECT n, 'completed', NOW() FROM generate_series(1, %s) n
+            RETURNING id
+        """, (HISTORY_ROUNDS,))
+        for (round_id,) in await cur.fetchall():
+            await db.create_votes_partition(cur, round_id)
+        await seed_round(cur, "status != 'active'", HISTORY_PHOTOS, 'ended', HISTORY_VOTERS)
+        await cur.execute(
+            database.REBUILD_TALLIES_SQL.format(battle_filter=''),
+            {'stripes': config.TALLY_STRIPES}
+        )
+    await db.archive_ended_rounds()
+
+    round_id = await db.create_round(round_number=HISTORY_ROUNDS + 1)
+    async with db.cursor() as cur:
+        await seed_round(cur, "status = 'active'", ACTIVE_BATTLES * 2, 'active', ACTIVE_VOTERS)
+        await cur.execute(
+            database.REBUILD_TALLIES_SQL.format(battle_filter="WHERE b.round_id = %(round_id)s"),
+            {'stripes': config.TALLY_STRIPES, 'round_id': round_id}
+        )
+        await cur.execute("""
+            WITH photo AS (
+                INSERT INTO photos (user_id, file_id, round_id, status)
+                SELECT 1000001 + (n %% %(users)s), 'pool', %(round_id)s, 'approved'
+                FROM generate_series(1, %(pool)s) n
+                RETURNING id, round_id
+            )
+            INSERT INTO pairing_pool (photo_id, round_id) SELECT id, round_id FROM photo
+        """, {'users': USERS, 'round_id': round_id, 'pool': POOL_PHOTOS})
+        await cur.execute("""
+            INSERT INTO battle_messages (battle_id, message_id)
+            SELECT b.id, b.id * 3 + n FROM battles b, generate_series(0, 2) n
+            WHERE b.round_id = %s
+        """, (round_id,))
+    await db.rebuild_user_stats()
+
+    await db.enqueue_notifications('round_results', round_id, [
+        (1000001 + n % USERS, f"Итоги {n}", None) for n in range(NOTIFICATIONS)
+    ])
+    async with db.cursor() as cur:
+        await cur.execute("UPDATE notification_jobs SET status = 'sent' WHERE id % 40 != 0")
+        await cur.execute("ANALYZE")
+    await db.load_tallies(round_id)
+    return round_id
+
+
+async def seed_round(cur, round_filter: str, photos: int, battle_status: str, voters: int):
+    """Фото, батлы (соседние фото парой) и голоса для раундов из round_filter"""
+    await cur.execute(f"""
+        INSERT INTO photos (user_id, file_id, round_id, status)
+        SELECT 1000001 + ((r.id * %(photos)s + n) %% %(users)s), 'file', r.id, 'approved'
+        FROM rounds r, generate_series(0, %(photos)s - 1) n
+        WHERE r.{round_filter}
+    """, {'photos': photos, 'users': USERS})
+    await cur.execute(f"""
+        INSERT INTO battles (round_id, photo1_id, photo2_id, status)
+        SELECT round_id, MIN(id), MAX(id), %(status)s
+        FROM (
+            SELECT p.id, p.round_id, (ROW_NUMBER() OVER (PARTITION BY p.round_id ORDER BY p.id) - 1) / 2 AS pair
+            FROM photos p JOIN rounds r ON r.id = p.round_id
+            WHERE r.{round_filter}
+        ) paired
+        GROUP BY round_id, pair
+    """, {'status': battle_status})
+    await cur.execute(f"""
+        INSERT INTO votes (round_id, user_id, battle_id, photo_id, weight, kind)
+        SELECT b.round_id, 1000001 + ((b.id * 37 + n) %% %(users)s), b.id,
+               CASE WHEN n %% 3 = 0 THEN b.photo2_id ELSE b.photo1_id END, 1, 'regular'
+        FROM battles b JOIN rounds r ON r.id = b.round_id, generate_series(0, %(voters)s - 1) n
+        WHERE r.{round_filter}
+    """, {'users': USERS, 'voters': voters})
+
+
+async def exercise(db, recorder: PlanRecorder, round_id: int):
+    """Вызвать методы Database так, как их вызывает бот"""
+    battles = await query(db, "SELECT id, photo1_id, photo2_id FROM battles WHERE round_id = %s ORDER BY id", (round_id,))
+    battle_id, photo1_id, photo2_id = battles[len(battles) // 2]
+    owner, = (await query(db, "SELECT user_id FROM photos WHERE id = %s", (photo1_id,)))[0]
+    voter = 1000000 + USERS
+    newcomer = 2000000
+
+    recorder.label = 'hot'
+    db.state.invalidate_round()
+    db.state.invalidate_admins()
+    db.state.invalidate_prize()
+    await db.get_current_round()
+    await db.get_admin_ids()
+    await db.get_prize()
+    await db.get_round_by_id(round_id)
+    await db.get_user(voter)
+    await db.add_user(newcomer, 'newcomer')
+    await db.count_user_photos(owner)
+    await db.user_has_photo_in_queue(owner)
+    await db.user_has_photo_in_round(owner, round_id)
+    await db.get_user_photo_in_round(owner, round_id)
+    await db.get_photo_by_id(photo1_id)
+    await db.get_battle_by_id(battle_id)
+    await db.get_battle_by_photo(photo1_id)
+    await db.get_user_stats(owner, replica=False)
+    db.profiles.clear()
+    await db.get_profile(owner)
+    db.voters.clear()
+    await db.user_voted_in_battle(voter, battle_id)
+    db.tallies.clear()
+    await db.get_battle_tally(battle_id)
+    await db.cast_vote(voter, battle_id, photo2_id)
+    await db.use_extra_votes(owner, photo1_id, 1)
+    _, photo_id = await db.submit_photo(newcomer, 'newcomer', 'file_newcomer')
+    await db.update_photo_status(photo_id, 'approved')
+    await db.create_battles_from_pool(round_id)
+    jobs = await db.claim_notifications(config.NOTIFY_BATCH_SIZE)
+    await db.finish_notifications([(job['id'], True, None) for job in jobs])
+    await db.get_notification_batches()
+    broadcast_id = await db.create_broadcast("Новости", None)
+    await db.get_broadcast(broadcast_id)
+    await db.get_running_broadcasts()
+
+    recorder.label = 'bulk'
+    recipients = db.broadcast_recipients(broadcast_id, config.BROADCAST_CHUNK_SIZE)
+    user_ids = await recipients.__anext__()
+    recorder.label = 'hot'
+    await db.checkpoint_broadcast(broadcast_id, user_ids[-1], len(user_ids), 0, [])
+    await recipients.aclose()
+
+    recorder.label = 'bulk'
+    await db.get_approved_photos(round_id)
+    await db.get_unpaired_photos(round_id)
+    await db.get_round_battles(round_id)
+    await db.fetch_round_scores(round_id)
+    await db.check_tallies(round_id)
+    await db.fetch_battle_results(round_id)
+    await db.load_tallies(round_id)
+    await db.get_battle_results(round_id)
+    await db.get_round_messages(round_id)
+    await db.end_round_battles(round_id)
+    await db.end_round(round_id)
+    await db.archive_round(round_id)
+    recorder.label = None
+
+
+def test_query_plans(run_db, monkeypatch):
+    recorder = PlanRecorder()
+
+    async def scenario(db):
+        round_id = await seed_dataset(db)
+        async with db.cursor() as cur:
+            await cur.execute("SELECT relname, reltuples FROM pg_class WHERE relkind IN ('r', 'p')")
+            table_rows = dict(await cur.fetchall())
+
+        recorder.install(monkeypatch)
+        await exercise(db, recorder, round_id)
+        return table_rows
+
+    table_rows = run_db(scenario)
+
+    executed = {text for _, text, _ in recorder.plans}
+    missing = [name for name, statement in database.STATEMENTS.items() if statement not in executed]
+    assert not missing, f"запросы без проверки плана: {missing}"
+
+    budgets = {
+        'hot': config.PLAN_COST_BUDGET,
+        'bulk': BULK_COST_PER_ROW * ACTIVE_BATTLES * ACTIVE_VOTERS,
+    }
+    problems = []
+    for label, text, plan in recorder.plans:
+        name = next((name for name, statement in database.STATEMENTS.items() if statement == text), None)
+        name = name or ' '.join(text.split())[:80]
+        if plan['Total Cost'] > budgets[label]:
+            problems.append(f"{name}: стоимость {plan['Total Cost']:.0f} > {budgets[label]}")
+        for node in database.plan_nodes(plan):
+            table = node.get('Relation Name')
+            rows = table_rows.get(table, 0)
+            if (node['Node Type'] == 'Seq Scan' and rows >= config.PLAN_SEQSCAN_MIN_ROWS
+                    and node['Plan Rows'] < rows * SEQSCAN_MAX_SHARE):
+                problems.append(f"{name}: Seq Scan по {table} ({node['Plan Rows']} из ~{rows:.0f} строк)")
+    assert not problems, "\n".join(problems)
+
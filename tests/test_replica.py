@@ -0,0 +1,89 @@
+"""
+Чтения с реплики: переход в основную БД, когда реплика не отвечает,
+и отказ читать с БД, которая не является репликой
+"""
+import asyncio
+
+import pytest
+
+from conftest import TEST_DSN, TEST_REPLICA_DSN, add_photos, add_users, config, metrics, psycopg
+
+# Порт, на котором никто не слушает
+UNREACHABLE_DSN = "postgresql://postgres@127.0.0.1:1/photobattle"
+
+
+def test_unreachable_replica_falls_back_to_primary(run_db, monkeypatch):
+    monkeypatch.setattr(config, 'DB_REPLICA_TIMEOUT_SECONDS', 0.5)
+
+    async def scenario(db):
+        round_id = await db.create_round()
+        await add_photos(db, round_id, [101, 102, 103])
+        assert db.replica_ok is False
+
+        # Реплика признана здоровой, но соединения с ней не получить
+        db.replica_ok = True
+        fallbacks = metrics.counters['replica.fallbacks']
+        assert await db.count_photos_by_status('approved', round_id) == 3
+        assert db.replica_ok is False
+        assert metrics.counters['replica.fallbacks'] == fallbacks + 1
+
+        # Дальше чтения сразу идут в основную БД
+        assert (await db.get_bot_stats())['total_users'] == 3
+        assert metrics.counters['replica.fallbacks'] == fallbacks + 1
+
+    run_db(scenario, UNREACHABLE_DSN)
+
+
+def test_replica_error_mid_read_retries_on_primary(run_db):
+    async def scenario(db):
+        await add_users(db, [101])
+        db.replica_ok = True
+        attempts = []
+
+        async def fetch(cur):
+            # На реплике соединение обрывается посреди чтения
+            attempts.append(cur)
+            if len(attempts) == 1:
+                await cur.execute("SELECT pg_terminate_backend(pg_backend_pid())")
+            await cur.execute("SELECT COUNT(*) FROM users")
+            return (await cur.fetchone())[0]
+
+        assert await db.read(fetch) == 1
+        assert len(attempts) == 2
+        assert db.replica_ok is False
+
+    # Реплика - та же БД, чтобы обрыв был в настоящем соединении
+    run_db(scenario, TEST_DSN)
+
+
+def test_primary_is_not_used_as_replica(run_db):
+    async def scenario(db):
+        assert await db.check_replica() is None
+        assert db.replica_ok is False
+
+    run_db(scenario, TEST_DSN)
+
+
+def test_reads_go_to_streaming_replica(run_db):
+    if not TEST_REPLICA_DSN:
+        pytest.skip("TEST_REPLICA_DATABASE_URL не задан")
+
+    async def scenario(db):
+        round_id = await db.create_round()
+        await add_photos(db, round_id, [101, 102])
+        for _ in range(50):
+            if await db.check_replica() == 0:
+                break
+            await asyncio.sleep(0.1)
+        assert db.replica_ok is True
+
+        reads = metrics.counters['replica.reads']
+        assert await db.count_photos_by_status('approved', round_id) == 2
+        assert (await db.get_user_stats(101))['extra_votes'] == 0
+        assert metrics.counters['replica.reads'] == reads + 2
+
+        # Итоги для выбора победителя - из основной БД
+        assert len(await db.get_round_photos_with_votes(round_id)) == 0
+        assert metrics.counters['replica.reads'] == reads + 2
+
+    run_db(scenario, TEST_REPLICA_DSN)
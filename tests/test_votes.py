@@ -0,0 +1,135 @@
+"""
+Голоса: повторный голос, доп. голоса с весом и сверка счетчиков с журналом
+"""
+import asyncio
+
+from conftest import Database, add_battles, add_users, config, query
+
+
+def test_repeat_vote_is_rejected(run_db):
+    async def scenario(db):
+        round_id = await db.create_round()
+        battle_id, = await add_battles(db, round_id, [101, 102])
+        photo1_id, photo2_id = (await query(db, "SELECT photo1_id, photo2_id FROM battles WHERE id = %s", (battle_id,)))[0]
+        await add_users(db, [500])
+
+        first = await db.cast_vote(500, battle_id, photo1_id)
+        again = await db.cast_vote(500, battle_id, photo1_id)
+        other_side = await db.cast_vote(500, battle_id, photo2_id)
+
+        assert first == (True, photo1_id, photo2_id, 1, 0)
+        assert again[0] is False and other_side[0] is False
+        assert other_side[3:] == (1, 0)
+        assert db.voters.has(battle_id, 500) is True
+        assert await db.get_battle_votes(battle_id) == {'photo1': 1, 'photo2': 0}
+
+        # Процесс без индекса голосовавших: повтор отсекает БД
+        fresh = Database(db.pool.conninfo)
+        await fresh.pool.open()
+        try:
+            assert fresh.voters.has(battle_id, 500) is None
+            assert await fresh.user_voted_in_battle(500, battle_id) is True
+            assert (await fresh.cast_vote(500, battle_id, photo2_id))[0] is False
+        finally:
+            await fresh.pool.close()
+
+    run_db(scenario)
+
+
+def test_concurrent_taps_count_once(run_db):
+    async def scenario(db):
+        round_id = await db.create_round()
+        battle_id, = await add_battles(db, round_id, [111, 112])
+        photo1_id, = (await query(db, "SELECT photo1_id FROM battles WHERE id = %s", (battle_id,)))[0]
+        await add_users(db, [600])
+
+        results = await asyncio.gather(*(db.cast_vote(600, battle_id, photo1_id) for _ in range(8)))
+
+        assert sum(1 for result in results if result[0]) == 1
+        rows = await db.fetch_round_scores(round_id)
+        assert (rows[0]['photo1_votes'], rows[0]['photo2_votes']) == (1, 0)
+        assert await db.check_tallies(round_id) == []
+
+    run_db(scenario)
+
+
+def test_extra_votes_count_with_weight(run_db):
+    async def scenario(db):
+        round_id = await db.create_round()
+        battle_id, = await add_battles(db, round_id, [121, 122])
+        photo1_id, photo2_id = (await query(db, "SELECT photo1_id, photo2_id FROM battles WHERE id = %s", (battle_id,)))[0]
+        owner, = (await query(db, "SELECT user_id FROM photos WHERE id = %s", (photo2_id,)))[0]
+        await add_users(db, [700])
+        await db.add_referral_votes(owner, 5)
+
+        await db.cast_vote(700, battle_id, photo1_id)
+        assert await db.use_extra_votes(owner, photo2_id, 3) == battle_id
+        assert await db.use_extra_votes(owner, photo2_id, 3) is None, "на балансе осталось 2 голоса"
+        assert await db.use_extra_votes(owner, photo2_id, 2) == battle_id
+
+        assert await db.get_battle_votes(battle_id) == {'photo1': 1, 'photo2': 5}
+        rows = await db.fetch_round_scores(round_id)
+        assert (rows[0]['photo1_votes'], rows[0]['photo2_votes']) == (1, 5)
+        ledger = await query(db, """
+            SELECT kind, SUM(weight), COUNT(*) FROM votes WHERE battle_id = %s GROUP BY kind ORDER BY kind
+        """, (battle_id,))
+        assert ledger == [('extra', 5, 2), ('regular', 1, 1)]
+        assert (await db.get_user_stats(owner, replica=False))['extra_votes'] == 0
+        assert await db.check_tallies(round_id) == []
+
+    run_db(scenario)
+
+
+def test_check_tallies_repairs_drift(run_db):
+    async def scenario(db):
+        round_id = await db.create_round()
+        battle_ids = await add_battles(db, round_id, [131, 132, 133, 134])
+        voters = list(range(800, 810))
+        await add_users(db, voters)
+        for battle_id in battle_ids:
+            photo1_id, = (await query(db, "SELECT photo1_id FROM battles WHERE id = %s", (battle_id,)))[0]
+            for user_id in voters:
+                await db.cast_vote(user_id, battle_id, photo1_id)
+
+        broken = battle_ids[0]
+        async with db.cursor() as cur:
+            await cur.execute("UPDATE battle_tallies SET votes = votes + 7 WHERE battle_id = %s AND side = 1", (broken,))
+            await cur.execute("DELETE FROM battle_tallies WHERE battle_id = %s", (battle_ids[1],))
+
+        drift = await db.check_tallies(round_id)
+        assert [(row['battle_id'], row['ledger_votes'], row['tally_votes']) for row in drift] == [
+            (broken, 10, 10 + 7 * len({user_id % config.TALLY_STRIPES for user_id in voters})),
+            (battle_ids[1], 10, 0),
+        ]
+
+        assert await db.check_tallies(round_id, repair=True) == drift
+        assert await db.check_tallies(round_id) == []
+        rows = {row['battle_id']: row for row in await db.fetch_round_scores(round_id)}
+        assert all(rows[battle_id]['photo1_votes'] == 10 for battle_id in battle_ids)
+        assert (await db.get_battle_votes(broken))['photo1'] == 10
+
+    run_db(scenario)
+
+
+def test_winner_is_decided_by_primary_not_cache(run_db):
+    async def scenario(db):
+        round_id = await db.create_round()
+        battle_id, = await add_battles(db, round_id, [101, 102])
+        photo1_id, photo2_id = (await query(db, "SELECT photo1_id, photo2_id FROM battles WHERE id = %s", (battle_id,)))[0]
+        await add_users(db, [500, 501, 502])
+        await db.cast_vote(500, battle_id, photo1_id)
+        await db.cast_vote(501, battle_id, photo2_id)
+        await db.cast_vote(502, battle_id, photo2_id)
+
+        # Кэш завысил счет левого фото, сверка максимумом его не снизит
+        db.tallies.update(battle_id, 5, 2)
+        await db.reconcile_tallies()
+        assert db.tallies.get(battle_id)['photo1'] == 5
+
+        results = await db.get_round_photos_with_votes(round_id)
+        assert [(photo['id'], photo['votes'], photo['is_winner']) for photo in results] == [
+            (photo2_id, 2, True),
+            (photo1_id, 1, False),
+        ]
+
+    run_db(scenario)
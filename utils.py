@@ -5,6 +5,9 @@ import asyncio
 from datetime import datetime, timedelta
 import logging
 
+from outbox import Priority
+import config
+
 logger = logging.getLogger(__name__)
 
 
@@ -89,23 +92,28 @@ def create_progress_bar(current, total, length=10):
     return f"{bar} {percentage}%"
 
 
-async def send_mass_message(bot, user_ids, message, delay=0.1):
+async def send_mass_message(bot, user_ids, message, chunk_size: int = None):
     """
-    Отправляет сообщение множеству пользователей с задержкой
+    Отправляет сообщение множеству пользователей. Темп задает планировщик
+    отправки бота (outbox.SendScheduler), рассылка идет с низким приоритетом.
+    Одновременно ждут отправки не больше chunk_size сообщений
+    (по умолчанию BROADCAST_CHUNK_SIZE)
     """
-    success = 0
-    failed = 0
-    
-    for user_id in user_ids:
+    async def send(user_id):
         try:
-            await bot.send_message(chat_id=user_id, text=message)
-            success += 1
-            await asyncio.sleep(delay)  # Защита от rate limit
+            await bot.send_message(chat_id=user_id, text=message, rate_limit_args=Priority.BULK)
+            return True
         except Exception as e:
             logger.error(f"Ошибка отправки пользователю {user_id}: {e}")
-            failed += 1
+            return False
     
-    return success, failed
+    user_ids = list(user_ids)
+    chunk_size = chunk_size or config.BROADCAST_CHUNK_SIZE
+    success = 0
+    for start in range(0, len(user_ids), chunk_size):
+        results = await asyncio.gather(*(send(user_id) for user_id in user_ids[start:start + chunk_size]))
+        success += sum(results)
+    return success, len(user_ids) - success
 
 
 def calculate_win_rate(wins, total_battles):
@@ -221,11 +229,11 @@ def admin_only(func):
     Декоратор для проверки прав админа
     """
     async def wrapper(update, context, *args, **kwargs):
-        from database import Database
-        db = Database()
+        # Общий пул соединений, без нового подключения на каждую команду
+        from database import db
         
         user_id = update.effective_user.id
-        if not db.is_admin(user_id):
+        if not await db.is_admin(user_id):
             await update.message.reply_text("❌ Доступ запрещен!")
             return
         